@@ -15,18 +15,30 @@ Several modes of operation.
 
 from .chatrunner import *
 from .sandbox import runAnswer
+import os, sys
 import json
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import toml
 from . import helper
+from . import cache
+from . import metrics
+from . import journal as journal_
+from . import batchapi
+from . import store
 
 def batchfeedback( *a, config={}, **kw ):
-    r = testProgram( *a, sandbox=config, raw=True, **kw ).getFeedbackObject()
+    with metrics.record( config, model=config["model"], mode=kw.get( "mode" ) ):
+        r = testProgram( *a, sandbox=config, raw=True, **kw ).getFeedbackObject()
     r["model"] = config["model"]
     return r
 
-def batchprocess( qalist, lit, cfg, count, **kw ):
+def modelconfigs( cfg ):
+    """
+    Return a list of configs, one per model listed in `cfg`.
+    """
     modellist = cfg["model"]
     if isinstance(modellist,str):
         modellist = [ modellist ]
@@ -35,18 +47,146 @@ def batchprocess( qalist, lit, cfg, count, **kw ):
         c = cfg.copy()
         c["model"] = m
         config.append( c )
-    for q in qalist["questions"]:
-        prob = q["question"]
-        for a in q["answers"]:
-            ans = a["ans"]
-            criteria = a.get( "criteria", "" )
-            a["feedback"] = [ batchfeedback( prob, ans, lit
-                            , config=c, criteria=criteria, **kw ) 
-                            for _ in range(count)
-                            for c in config ]
+    return config
+
+def modelcaps( cfg, jobs ):
+    """
+    Return a dict giving the maximum number of concurrent requests
+    per model.  The `maxjobs` key in the config can be an integer,
+    applying to every model, or a table mapping model names to caps.
+    Models without a cap are limited by `jobs` only.
+    """
+    maxjobs = cfg.get( "maxjobs", jobs )
+    caps = {}
+    for c in modelconfigs( cfg ):
+        m = c["model"]
+        if isinstance( maxjobs, dict ):
+            caps[m] = min( jobs, int( maxjobs.get( m, jobs ) ) )
+        else:
+            caps[m] = min( jobs, int( maxjobs ) )
+    return caps
+
+def batchtasks( qalist, config, count, journal=None ):
+    """
+    Generate the tasks of a batch run as tuples (answer, index, question,
+    config, key), where `index` is the position of the result in
+    `answer["feedback"]` and `key` is the journal key.
+    The order is the same as in the sequential run.
+    The repetition number is used as `cache_salt`, so that repeated queries
+    are cached separately.
+    With a journal, tasks already in the journal are skipped, and
+    the feedback lists are not allocated.
+    """
+    for qno, q in enumerate( qalist["questions"] ):
+        for ano, a in enumerate( q["answers"] ):
+            if journal is None:
+                a["feedback"] = [ None ] * ( count * len(config) )
+            for r in range(count):
+                for i, c in enumerate(config):
+                    key = journal_.makeKey( qno, q, ano, a, c["model"], r )
+                    if journal is not None and key in journal: continue
+                    c = c.copy()
+                    c["cache_salt"] = r
+                    yield ( a, r*len(config) + i, q, c, key )
+
+def batchprocess( qalist, lit, cfg, count, jobs=1, journal=None, **kw ):
+    """
+    Run the batch test, adding the feedback to each answer in `qalist`.
+    With `jobs` > 1, the queries are made concurrently, with at most
+    `jobs` requests in flight and at most the cap from `modelcaps()`
+    for each model.  The order of the feedback list is independent of 
+    the order in which the responses arrive.
+
+    If a `journal.Journal` is given, each result is appended to the
+    journal instead of `qalist`, and results already in the journal
+    are not recomputed.  Use `journal.compose()` to make the output.
+    """
+    if jobs > int( cfg.get( "pool_size", 10 ) ):
+        cfg = cfg.copy()
+        cfg["pool_size"] = jobs
+    config = modelconfigs( cfg )
+
+    def run( task ):
+        a, idx, q, c, key = task
+        r = batchfeedback( q["question"], a["ans"], lit
+                            , config=c, criteria=a.get( "criteria", "" ), **kw ) 
+        if journal is None:
+            a["feedback"][idx] = r
+        else:
+            journal.append( key, r )
+
+    tasks = list( batchtasks( qalist, config, count, journal ) )
+    if jobs <= 1:
+        for t in tasks:
+            run( t )
+        return qalist
+
+    slots = threading.Semaphore( jobs )
+    def limited( task ):
+        with slots:
+            run( task )
+
+    caps = modelcaps( cfg, jobs )
+    pools = { m: ThreadPoolExecutor( max_workers=n ) for m, n in caps.items() }
+    try:
+        futures = [ pools[t[3]["model"]].submit( limited, t ) for t in tasks ]
+        for f in futures:
+            f.result()
+    finally:
+        for p in pools.values():
+            p.shutdown( cancel_futures=True )
     return qalist
 
+def batchapiprocess( qalist, lit, cfg, count, reqfile, jobs=1, journal=None,
+                     resume=False, **kw ):
+    """
+    Run the batch test through the Batch API, as described in the
+    `batchapi` module.  The requests are written to `reqfile`, and
+    the batch id to `reqfile.id`, so that a resumed run waits for
+    the batch already submitted instead of submitting a new one.
+    The results are added as in `batchprocess()`.
+    """
+    collector = batchapi.Collector()
+    with batchapi.active( collector ), metrics.attach( metrics.newRecord() ):
+        for a, idx, q, c, key in batchtasks( qalist, modelconfigs( cfg ),
+                                             count, journal ):
+            try:
+                testProgram( q["question"], a["ans"], lit, sandbox=c,
+                             criteria=a.get( "criteria", "" ), raw=True, **kw )
+            except batchapi.Collected:
+                pass
+    backend = batchapi.getBackend( cfg )
+    idfn = reqfile + ".id"
+    if resume and os.path.exists( idfn ):
+        with open( idfn ) as f:
+            bid = f.read().strip()
+        print( f"Resuming batch {bid}." )
+    elif collector.requests:
+        n = collector.write( reqfile )
+        bid = backend.submit( reqfile )
+        with open( idfn, "w" ) as f:
+            f.write( bid )
+        print( f"Submitted batch {bid} with {n} requests from {reqfile}." )
+    else:
+        bid = None
+    if bid is not None:
+        output = batchapi.wait( backend, bid, float( cfg.get( "batch_poll", 30 ) ) )
+        failed = collector.load( output )
+        print( f"Batch {bid} completed with {failed} failed requests." )
+    else:
+        collector.load( [] )
+    with batchapi.active( collector ):
+        return batchprocess( qalist, lit, cfg, count, jobs=jobs,
+                             journal=journal, **kw )
+
 if __name__ == "__main__":
+    if sys.argv[1:2] == [ "warmup" ]:
+        from . import warmup
+        sys.exit( warmup.main( sys.argv[1:] ) )
+    if sys.argv[1:2] == [ "serve" ]:
+        from . import daemon
+        sys.exit( daemon.main( sys.argv[1:] ) )
+
     parser = argparse.ArgumentParser(
     prog = 'chatrunner',
     description = 'Get AI feedback on a student answer',
@@ -56,7 +196,8 @@ if __name__ == "__main__":
     parser.add_argument('criteria',help="Answer file",nargs="?")
     parser.add_argument('-m','--model',help="Model")
     parser.add_argument('-l','--literature',help="Literature file (json)")
-    parser.add_argument('-u','--url',help="URL for the LLM OpenAPI.")
+    parser.add_argument('-u','--url',
+                        help="URL for the LLM OpenAPI (comma separated for several endpoints).")
     parser.add_argument('-k','--api-key',dest="key",help="Key for API access.")
     parser.add_argument('-A','--api',help="The API to use for AI connection.")
     parser.add_argument('-C','--config',help="Config file (json).")
@@ -76,6 +217,29 @@ if __name__ == "__main__":
                         help="Question/answer set for batch ruin (toml file).")
     parser.add_argument('-n','--count',default=1,
                         help="Numer of repetition of the batch test.")
+    parser.add_argument('-j','--jobs',default=1,type=int,
+                        help="Number of concurrent queries in batch mode.")
+    parser.add_argument('--cache',choices=cache.modes.keys(),
+                        help="Use of the response cache (off/read/write/readwrite).")
+    parser.add_argument('--cache-dir',dest="cachedir",
+                        help="Directory for the response cache.")
+    parser.add_argument('--metrics',
+                        help="JSONL file for latency and token metrics.")
+    parser.add_argument('--metrics-prom',dest="metrics_prom",
+                        help="Prometheus textfile for aggregated metrics, written after a batch run.")
+    parser.add_argument('--journal',
+                        help="JSONL journal for batch results (default: outfile.jsonl).")
+    parser.add_argument('--resume',action="store_true",
+                        help="Resume a batch run, skipping results in the journal.")
+    parser.add_argument('--overwrite',action="store_true",
+                        help="Discard the results in an existing journal.")
+    parser.add_argument('--sqlite',
+                        help="SQLite store for batch results, instead of the journal.")
+    parser.add_argument('--batch-api',dest="batch_api",
+                        help="Submit the batch through the Batch API, writing the requests to this JSONL file.")
+    parser.add_argument('--batch-backend',dest="batch_backend",
+                        choices=batchapi.backends.keys(),
+                        help="Backend for the Batch API (default: openai).")
     args = parser.parse_args()
 
     if args.batch:
@@ -113,9 +277,20 @@ if __name__ == "__main__":
     if args.key:
         cfg["OPENAI_API_KEY"] = args.key
     if args.url:
-        cfg["url"] = args.url
+        urls = args.url.split( "," )
+        cfg["url"] = urls[0] if len(urls) == 1 else urls
     if args.model:
         cfg["model"] = args.model
+    if args.cache:
+        cfg["cache"] = args.cache
+    if args.cachedir:
+        cfg["cachedir"] = args.cachedir
+    if args.metrics:
+        cfg["metrics"] = args.metrics
+    if args.metrics_prom:
+        cfg["metrics_prom"] = args.metrics_prom
+    if args.batch_backend:
+        cfg["batch_backend"] = args.batch_backend
 
     # Set default URLs
     if cfg.get( "url" ) is None: 
@@ -141,11 +316,42 @@ if __name__ == "__main__":
 
     # Run the test
     if args.batch:
-        r = batchprocess( qalist, lit, cfg=cfg, count=int(args.count)
-                        , gs=graderstate_string, mode=mode 
-                        , debug=args.verbose )
-        with open(args.outfile, "w") as f:
-             toml.dump(qalist,f)
+        if args.sqlite:
+            jfn = args.sqlite
+            journal = store.Store( jfn, resume=args.resume,
+                                   source=args.batch, config=cfg )
+            journal.addQuestions( qalist )
+        elif args.outfile is None:
+            raise Exception( "Batch mode needs an outfile." )
+        else:
+            jfn = args.journal or args.outfile + ".jsonl"
+            journal = journal_.Journal( jfn, resume=args.resume,
+                                        overwrite=args.overwrite )
+        if args.resume:
+            print( f"Resuming with {len(journal)} results from {jfn}." )
+        try:
+            if args.batch_api:
+                batchapiprocess( qalist, lit, cfg=cfg, count=int(args.count)
+                               , reqfile=args.batch_api, resume=args.resume
+                               , jobs=args.jobs, journal=journal
+                               , gs=graderstate_string, mode=mode 
+                               , debug=args.verbose )
+            else:
+                batchprocess( qalist, lit, cfg=cfg, count=int(args.count)
+                            , jobs=args.jobs, journal=journal
+                            , gs=graderstate_string, mode=mode 
+                            , debug=args.verbose )
+            if args.outfile:
+                journal_.compose( qalist, journal,
+                                  [ c["model"] for c in modelconfigs(cfg) ],
+                                  int(args.count), args.outfile )
+        finally:
+            journal.close()
+        if cache.cacheMode(cfg) != (False,False):
+            print( cache.statString() )
+        print( metrics.summary() )
+        if cfg.get( "metrics_prom" ):
+            metrics.writeProm( cfg["metrics_prom"] )
     elif mode == "moodle":
         r = runAnswer( prob, ans, lit, criteria, graderstate_string, cfg, 
                       debug=args.verbose, markdown=args.markdown ) 
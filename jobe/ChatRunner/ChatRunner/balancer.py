@@ -0,0 +1,137 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Load balancing across several LLM endpoints.
+
+The `url` key in the sandbox dict may be a list of endpoints instead
+of a single URL.  Each endpoint is either a URL or a table with the
+keys `url`, `weight` (default 1), and optionally `OPENAI_API_KEY`
+to override the key for that endpoint.  All the endpoints must
+speak the same API, as given by `API`.  For example, in TOML,
+```toml
+url = [ { url = "http://gpu1:11434/api/chat", weight = 2 },
+        "http://gpu2:11434/api/chat" ]
+```
+
+For each request, the endpoint is chosen by the `balance` key:
+
++ `least` - fewest outstanding requests relative to the weight (default)
++ `ewma` - lowest expected latency, i.e. the moving average of the
+  latency times the number of outstanding requests plus one,
+  relative to the weight
+
+Health is checked passively.  An endpoint failing `eject_after`
+consecutive requests (default 3) is ejected for `eject_time` seconds
+(default 30), doubled for every further ejection in a row.
+If all endpoints are ejected, the one due back first is used.
+"""
+
+import time, json, threading
+
+_balancers = {}
+_lock = threading.Lock()
+
+class Endpoint:
+    """An endpoint with its passive health and load statistics."""
+    alpha = 0.3
+    def __init__(self,url,weight=1.0,key=None):
+        self.url = url
+        self.weight = float(weight)
+        self.key = key
+        self.outstanding = 0
+        self.ewma = None
+        self.failures = 0
+        self.ejections = 0
+        self.ejected = 0.0
+    def __repr__(self):
+        return f"Endpoint({self.url!r}, weight={self.weight})"
+    def asdict(self):
+        return { "url": self.url, "weight": self.weight,
+                 "outstanding": self.outstanding, "ewma": self.ewma,
+                 "failures": self.failures, "ejected": self.ejected > time.time() }
+
+class Balancer:
+    """Choose endpoints for requests and track their health."""
+    def __init__(self,endpoints,policy="least",ejectafter=3,ejecttime=30.0):
+        if not endpoints:
+            raise Exception( "No endpoints given." )
+        if policy not in [ "least", "ewma" ]:
+            raise Exception( f"Unknown balancing policy {policy}." )
+        self.endpoints = endpoints
+        self.policy = policy
+        self.ejectafter = ejectafter
+        self.ejecttime = ejecttime
+        self.lock = threading.Lock()
+    def score(self,ep):
+        if self.policy == "ewma":
+            # Untried endpoints score zero, so that each gets tried.
+            return (ep.ewma or 0.0) * (ep.outstanding + 1) / ep.weight
+        return ep.outstanding / ep.weight
+    def acquire(self,exclude=()):
+        """
+        Choose an endpoint, avoiding those in `exclude` if possible,
+        and count the request as outstanding.
+        """
+        now = time.time()
+        with self.lock:
+            healthy = [ ep for ep in self.endpoints if ep.ejected <= now ]
+            if not healthy:
+                healthy = [ min( self.endpoints, key=lambda ep: ep.ejected ) ]
+            cands = [ ep for ep in healthy if ep not in exclude ] or healthy
+            ep = min( cands, key=self.score )
+            ep.outstanding += 1
+        return ep
+    def release(self,ep,ok,latency=None):
+        """
+        Record the end of a request to `ep`, with `ok` False if it
+        failed, and the latency in seconds if it succeeded.
+        """
+        with self.lock:
+            ep.outstanding -= 1
+            if ok:
+                ep.failures = 0
+                ep.ejections = 0
+                if latency is not None:
+                    ep.ewma = latency if ep.ewma is None else \
+                        ep.alpha*latency + (1-ep.alpha)*ep.ewma
+                return
+            ep.failures += 1
+            if ep.failures >= self.ejectafter:
+                t = self.ejecttime * 2**ep.ejections
+                print( f"Ejecting {ep.url} for {t} seconds." )
+                ep.ejected = time.time() + t
+                ep.ejections += 1
+                ep.failures = 0
+    def stats(self):
+        with self.lock:
+            return [ ep.asdict() for ep in self.endpoints ]
+
+def parseEndpoints(urls):
+    """Return the list of `Endpoint` objects for the `url` config value."""
+    if isinstance( urls, str ):
+        urls = [ urls ]
+    r = []
+    for u in urls:
+        if isinstance( u, str ):
+            r.append( Endpoint( u ) )
+        else:
+            r.append( Endpoint( u["url"], u.get( "weight", 1 ),
+                                u.get( "OPENAI_API_KEY" ) ) )
+    return r
+
+def getBalancer(urls,sandbox={}):
+    """
+    Return the balancer for the list of endpoints `urls`, configured
+    by sandbox, creating it on first use, so that statistics are shared
+    between calls.
+    """
+    key = json.dumps( [ urls, sandbox.get( "balance", "least" ) ], sort_keys=True )
+    with _lock:
+        b = _balancers.get( key )
+        if b is None:
+            b = Balancer( parseEndpoints( urls ),
+                          sandbox.get( "balance", "least" ),
+                          int( sandbox.get( "eject_after", 3 ) ),
+                          float( sandbox.get( "eject_time", 30.0 ) ) )
+            _balancers[key] = b
+    return b
@@ -0,0 +1,221 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Offline batch runs through the OpenAI Batch API.
+
+A batch run with the Batch API has three steps.
+
+1.  The requests which the batch processor would make are collected,
+    by running the grading code with a `Collector` active.  `queryAI()`
+    records the request and raises `Collected` instead of querying
+    the model.  The requests are written to a JSONL file in the Batch
+    format, using the cache key of the request as `custom_id`.
+2.  The file is submitted to a backend, which is polled until the
+    batch is complete, and the output is downloaded.
+3.  The batch processor is run again with the output loaded in the
+    collector, so that `queryAI()` takes the response from the batch
+    output and parses it as usual.  Requests which failed in the batch
+    are made synchronously.
+
+The backend is chosen by the `batch_backend` key in the sandbox:
+
++ `openai` - the OpenAI Batch API at `batch_url` (default derived from `url`)
++ `file` - a local stand-in, which processes the batch in a background
+  thread with synchronous requests to `url` and keeps its files in
+  `batch_dir` (default `~/.cache/chatrunner/batches`)
+
+The poll interval is given by `batch_poll` in seconds (default 30).
+"""
+
+import os, json, time, threading
+
+from . import client
+
+class Collected(Exception):
+    """Raised by `queryAI()` when a request has been collected."""
+
+_collector = None
+
+class Collector:
+    """
+    Collects requests in `requests`, mapping the key to the request
+    body, and holds the responses from the batch output in `responses`,
+    mapping the key to the response body.  The collector is `collecting`
+    until the output is loaded.
+    """
+    def __init__(self):
+        self.requests = {}
+        self.responses = {}
+        self.collecting = True
+        self.lock = threading.Lock()
+    def add(self,key,data):
+        data = { k: v for k, v in data.items()
+                 if k not in [ "stream", "stream_options" ] }
+        with self.lock:
+            self.requests[key] = data
+    def lookup(self,key):
+        """Return the response body for the key, or None."""
+        with self.lock:
+            return self.responses.get( key )
+    def load(self,lines):
+        """
+        Load responses from the output of a batch, as an iterable of lines.
+        Returns the number of failed requests.
+        """
+        self.collecting = False
+        failed = 0
+        for line in lines:
+            if not line.strip(): continue
+            obj = json.loads( line )
+            resp = obj.get( "response" ) or {}
+            if obj.get( "error" ) or resp.get( "status_code" ) != 200:
+                failed += 1
+                continue
+            with self.lock:
+                self.responses[obj["custom_id"]] = resp["body"]
+        return failed
+    def write(self,fn,endpoint="/v1/chat/completions"):
+        """Write the collected requests as a Batch input file."""
+        with open( fn, "w" ) as f:
+            for key, data in self.requests.items():
+                f.write( json.dumps( { "custom_id": key, "method": "POST",
+                                       "url": endpoint, "body": data } ) + "\n" )
+        return len( self.requests )
+
+def current():
+    """Return the active collector, or None."""
+    return _collector
+
+class active:
+    """
+    Context manager making `collector` active in the process,
+    including the worker threads of the batch processor.
+    """
+    def __init__(self,collector):
+        self.collector = collector
+    def __enter__(self):
+        global _collector
+        self.old = _collector
+        _collector = self.collector
+        return self.collector
+    def __exit__(self,*a):
+        global _collector
+        _collector = self.old
+
+class FileBackend:
+    """
+    Local stand-in for the Batch API.  The batch is processed in a
+    background thread, posting each request to the `url` in sandbox,
+    and the status is kept in a JSON file in the batch directory.
+    """
+    def __init__(self,sandbox={}):
+        self.sandbox = sandbox
+        self.dir = os.path.expanduser( sandbox.get( "batch_dir",
+                                       "~/.cache/chatrunner/batches" ) )
+        os.makedirs( self.dir, exist_ok=True )
+    def path(self,bid,ext):
+        return os.path.join( self.dir, f"{bid}.{ext}" )
+    def setStatus(self,bid,status):
+        tmp = self.path( bid, "status.tmp" )
+        with open( tmp, "w" ) as f:
+            json.dump( { "id": bid, "status": status }, f )
+        os.replace( tmp, self.path( bid, "status.json" ) )
+    def submit(self,fn):
+        bid = "batch_" + os.urandom(16).hex()
+        with open( fn ) as f, open( self.path( bid, "input.jsonl" ), "w" ) as g:
+            g.write( f.read() )
+        self.setStatus( bid, "in_progress" )
+        threading.Thread( target=self.process, args=(bid,), daemon=True ).start()
+        return bid
+    def process(self,bid):
+        headers = { "Content-Type": "application/json" }
+        if "OPENAI_API_KEY" in self.sandbox:
+            headers["Authorization"] = f"Bearer {self.sandbox['OPENAI_API_KEY']}"
+        url = self.sandbox.get( "url" )
+        with open( self.path( bid, "input.jsonl" ) ) as f, \
+             open( self.path( bid, "output.jsonl" ), "w" ) as g:
+            for line in f:
+                req = json.loads( line )
+                try:
+                    r = client.post( url, self.sandbox, headers=headers,
+                                     data=json.dumps( req["body"] ).encode() )
+                    resp = { "status_code": r.status_code, "body": r.json() }
+                    err = None
+                except Exception as e:
+                    resp = None
+                    err = { "message": str(e) }
+                g.write( json.dumps( { "custom_id": req["custom_id"],
+                                       "response": resp, "error": err } ) + "\n" )
+        self.setStatus( bid, "completed" )
+    def status(self,bid):
+        with open( self.path( bid, "status.json" ) ) as f:
+            return json.load( f )["status"]
+    def output(self,bid):
+        with open( self.path( bid, "output.jsonl" ) ) as f:
+            return f.read().splitlines()
+
+class OpenAIBackend:
+    """The OpenAI Batch API."""
+    def __init__(self,sandbox={}):
+        self.sandbox = sandbox
+        url = sandbox.get( "batch_url" )
+        if url is None:
+            url = sandbox.get( "url", "https://api.openai.com/v1/chat/completions" )
+            if not isinstance( url, str ):
+                raise Exception( "Give batch_url when url is a list." )
+            url = url.split( "/chat/completions" )[0]
+        self.url = url.rstrip( "/" )
+        self.headers = {}
+        if "OPENAI_API_KEY" in sandbox:
+            self.headers["Authorization"] = f"Bearer {sandbox['OPENAI_API_KEY']}"
+    def request(self,method,path,**kw):
+        url = self.url + path
+        # File uploads need the requests transport.
+        session = client.getSession( url, dict( self.sandbox, transport="requests" ) )
+        r = session.request( method, url, headers=self.headers,
+                             timeout=client.getTimeout( self.sandbox ), **kw )
+        if r.status_code != 200:
+            print( r.content )
+            raise Exception( f"Batch API {method} {path} returns {r.status_code}." )
+        return r
+    def submit(self,fn):
+        with open( fn, "rb" ) as f:
+            r = self.request( "POST", "/files", data={ "purpose": "batch" },
+                              files={ "file": ( os.path.basename(fn), f ) } )
+        fid = r.json()["id"]
+        r = self.request( "POST", "/batches",
+                          json={ "input_file_id": fid,
+                                 "endpoint": "/v1/chat/completions",
+                                 "completion_window": "24h" } )
+        return r.json()["id"]
+    def status(self,bid):
+        obj = self.request( "GET", f"/batches/{bid}" ).json()
+        self.last = obj
+        return obj["status"]
+    def output(self,bid):
+        fid = self.last.get( "output_file_id" )
+        if not fid:
+            return []
+        return self.request( "GET", f"/files/{fid}/content" ).text.splitlines()
+
+backends = { "openai": OpenAIBackend, "file": FileBackend }
+
+def getBackend(sandbox):
+    name = sandbox.get( "batch_backend", "openai" )
+    if name not in backends:
+        raise Exception( f"Unknown batch backend {name}." )
+    return backends[name]( sandbox )
+
+def wait(backend,bid,interval=30.0):
+    """
+    Poll the backend until the batch is finished.  Returns the output
+    lines, or raises an exception if the batch did not complete.
+    """
+    while True:
+        status = backend.status( bid )
+        if status == "completed":
+            return backend.output( bid )
+        if status in [ "failed", "expired", "cancelled" ]:
+            raise Exception( f"Batch {bid} {status}." )
+        print( f"Batch {bid} is {status}." )
+        time.sleep( interval )
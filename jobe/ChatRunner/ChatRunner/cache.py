@@ -0,0 +1,146 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Content-addressed on-disk cache for responses from the LLM.
+
+The key is a hash of the complete request (URL, model, messages,
+generation parameters) and the JSON schema.  The value stored is the
+message content extracted from the response, i.e. the input to
+`dumpResponse()`.
+
+The cache is configured in the sandbox dict:
+
++ `cache` - one of `off` (default), `read`, `write`, or `readwrite`
++ `cachedir` - directory for the cache (default `~/.cache/chatrunner`)
++ `cache_size` - maximum size of the cache in MB (default 100)
++ `cache_ttl` - time to live for entries in seconds (default 30 days)
++ `cache_salt` - additional key material, used by the batch processor
+  to keep repeated queries of the same answer apart
+
+When the cache exceeds its size, the least recently used entries
+are evicted.
+"""
+
+import os, json, time, threading
+
+modes = { "off": (False,False), "read": (True,False),
+          "write": (False,True), "readwrite": (True,True) }
+
+stats = { "hits": 0, "misses": 0, "writes": 0 }
+_lock = threading.Lock()
+_caches = {}
+
+def cacheMode(sandbox):
+    """Return a pair of booleans (read,write) for the cache mode in sandbox."""
+    mode = sandbox.get( "cache", "off" )
+    if mode not in modes:
+        raise Exception( f"Unknown cache mode {mode}." )
+    return modes[mode]
+
+def makeKey(url,data,schema="",salt=None):
+    """Return the cache key for a request."""
+    obj = { "url": url, "data": data, "schema": schema, "salt": salt }
+    s = json.dumps( obj, sort_keys=True, ensure_ascii=False )
+    import hashlib
+    return hashlib.sha256( s.encode() ).hexdigest()
+
+def count(name):
+    with _lock:
+        stats[name] += 1
+
+def statString():
+    """Return the hit/miss counters as a human readable string."""
+    return ( f"Cache hits: {stats['hits']}, misses: {stats['misses']}, "
+           + f"writes: {stats['writes']}" )
+
+class ResponseCache:
+    """
+    A bounded directory of cached responses, one file per key.
+    The file modification time is used as the last access time for
+    LRU eviction.
+    """
+    def __init__(self,cachedir,maxsize=100*2**20,ttl=30*24*3600):
+        self.dir = cachedir
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs( self.dir, exist_ok=True )
+    def path(self,key):
+        return os.path.join( self.dir, key[:2], key + ".json" )
+    def get(self,key):
+        """Return the cached content for key or None."""
+        fn = self.path(key)
+        try:
+            with open(fn, 'r') as file:
+                obj = json.load( file )
+        except (OSError, ValueError):
+            return None
+        if time.time() - obj.get( "created", 0 ) > self.ttl:
+            self.remove(fn)
+            return None
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+        return obj["content"]
+    def put(self,key,content,**meta):
+        """Store content under key, evicting old entries if necessary."""
+        fn = self.path(key)
+        obj = { "created": time.time(), "content": content }
+        obj.update( meta )
+        s = json.dumps( obj, ensure_ascii=False )
+        os.makedirs( os.path.dirname(fn), exist_ok=True )
+        tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, 'w') as file:
+            file.write( s )
+        os.replace( tmp, fn )
+        with self.lock:
+            if self.size is None:
+                self.size = sum( n for _, _, n in self.entries() )
+            else:
+                self.size += len( s.encode() )
+            if self.size > self.maxsize:
+                self.evict()
+    def remove(self,fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+    def entries(self):
+        """Return a list of (mtime,filename,size) for all entries."""
+        r = []
+        for d, _, files in os.walk( self.dir ):
+            for f in files:
+                if not f.endswith( ".json" ): continue
+                fn = os.path.join( d, f )
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                r.append( ( st.st_mtime, fn, st.st_size ) )
+        return r
+    def evict(self):
+        """Remove least recently used entries until the cache is below 90%
+        of its maximum size."""
+        entries = sorted( self.entries() )
+        size = sum( n for _, _, n in entries )
+        limit = 0.9*self.maxsize
+        for _, fn, n in entries:
+            if size <= limit: break
+            self.remove(fn)
+            size -= n
+        self.size = size
+
+def getCache(sandbox):
+    """Return the `ResponseCache` configured by sandbox."""
+    cachedir = os.path.expanduser(
+            sandbox.get( "cachedir", "~/.cache/chatrunner" ) )
+    with _lock:
+        c = _caches.get( cachedir )
+        if c is None:
+            c = ResponseCache( cachedir,
+                    maxsize=float( sandbox.get( "cache_size", 100 ) )*2**20,
+                    ttl=float( sandbox.get( "cache_ttl", 30*24*3600 ) ) )
+            _caches[cachedir] = c
+    return c
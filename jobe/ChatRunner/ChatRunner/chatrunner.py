@@ -5,9 +5,12 @@ This is the main library, defining the classes and auxiliary
 function for ChatRunner.
 """
 
-import subprocess, base64, json, os
-from .query import Test, queryAI
-from .helper import getfn
+import subprocess, base64, json, os, time
+from .query import Test, queryAI, dumpResponse, isMalformed
+from .helper import getfn, getResource, countTokens
+from .literature import selectLiterature
+from . import metrics
+from . import dedup
 from typing import List
 
 class Table:
@@ -65,6 +68,10 @@ class TestResults:
       self.frac = 0
       self.tableHeader = None
       self.resultstable = None
+      self.otherOutput = None
+      self.html = None
+      self.md = None
+      self.retry = None
       self.debug = debug
 
       if exitCode != 0:
@@ -89,80 +96,128 @@ class TestResults:
 
       self.numTests = len(self.testresults)
 
+   @classmethod
+   def fromFrames(cls, frames : str, output : str = "", exitCode : int = 0):
+      """
+      Make a `TestResults` object from the result frames of the
+      test program (see `testrunner`), one JSON object per line,
+      and its diagnostic output.  The exit code and output given
+      in the end frame, if any, take precedence.
+      Diagnostic output is kept as a single `nontest`, and so are
+      frames which cannot be parsed.
+      """
+      tests = []
+      for line in frames.splitlines():
+          if not line.strip(): continue
+          t = Test()
+          try:
+              obj = json.loads( line )
+          except ValueError:
+              obj = None
+          if isinstance( obj, dict ) and obj.get( "end" ):
+              exitCode = obj.get( "exitCode", exitCode )
+              output = obj.get( "output", output )
+              continue
+          if isinstance( obj, dict ) and isinstance( obj.get( "Testobject" ), dict ):
+              t.result = obj["Testobject"]
+          else:
+              t.setNontest( line )
+          tests.append( t )
+      if output and output.strip():
+          t = Test()
+          t.setNontest( output )
+          tests.append( t )
+      return cls( ob=tests, exitCode=exitCode )
+
+   tryAgainText = "Det tok for lang tid å lage tilbakemelding. Prøv igjen om litt."
+
+   @classmethod
+   def tryAgain(cls, message : str = None):
+      """
+      Make a `TestResults` object asking the student to try again,
+      used when there is too little time left to query the AI.
+      The message is kept in `retry`.
+      """
+      if message is None: message = cls.tryAgainText
+      t = Test()
+      t.setNontest( message )
+      r = cls( ob=[ t ], exitCode=2 )
+      r.retry = message
+      return r
+
    def debugPrintResults(self): return debugPrintResults(self.testresults)
    def finalise(self,debug=False):
       """
-      Finalise the TestResults object, running makeResultTable()
-      and mark().
+      Finalise the TestResults object, making the results table,
+      the grade, and the renderings with `scan()`.
       """
 
       tableHeader = ["iscorrect", "Test", "Beskrivelse"]
     
-      self.makeResultTable( tableHeader )
-      self.mark()
+      with metrics.phase( "finalise" ):
+          self.scan( tableHeader )
       if debug:
           print( "=== testResults (marked) ===" )
           print( self.getMarkdownResult() )
       # Format results
       return self
 
-   def makeResultTable( self, tableHeader ):
+   tableRemap = { "iscorrect": "passed",
+                  "Test": "name",
+                  "Beskrivelse": "description" }
+
+   def scan( self, tableHeader ):
       """
-      This function creates the `resultstable` attribute by
-      formatting the test results
+      Make a single pass over the test results, creating the
+      `resultstable` attribute (a `Table` with the given header),
+      the grade `frac` as the fraction of marks for passed tests,
+      the list of other output, and the free-form feedback in
+      HTML and Markdown.
       """
       self.tableHeader = tableHeader
-      resultstable = []
-
-      tableRemap = {"iscorrect": "passed",
-                  "Test": "name",
-                  "Beskrivelse": "description"}
-
-      for header in tableHeader:
-          if header not in tableRemap.keys():
-              tableRemap.update({header:header})
-
-      # self.tableRemap = tableRemap
+      columns = [ self.tableRemap.get( h, h ) for h in tableHeader ]
       if self.debug: self.debugPrintResults()
 
-      for test in self.testresults:
-         row = []
-         for column in self.tableHeader:
-            try:
-               row.append(test.result[tableRemap[column]])
-            except:
-               row = []
-               break
-         if self.debug: print( i, row )
-         if row != []:
-            resultstable.append(row)
-
-      self.resultstable = Table(resultstable,tableHeader)
-   def getOtherOutput(self):
-       return [ x.asdict() for x in self.testresults if not x.isTest() ]
-
-   def mark(self):
-      """Compute the grade `frac` from the testResult."""
+      rows = []
+      other = []
+      html = []
+      md = []
       total_marks = 0
       obtained_marks = 0
       for test in self.testresults:
-         if "mark" in test.result.keys():
-            mark = test.result["mark"]
-            total_marks += mark
-         else:
-            mark = 0
-         if test.result["passed"]:
-            obtained_marks += mark
-      if total_marks != 0:
-         self.frac = obtained_marks/total_marks
-      else:
-         self.frac = 0
+         row = [ test.get( c ) for c in columns ]
+         if None not in row:
+            rows.append( row )
+         if test.mark is not None:
+            total_marks += test.mark
+            if test.passed:
+               obtained_marks += test.mark
+         if not test.isTest():
+            other.append( test.asdict() )
+         h = test.formatResult()
+         if h is not None:
+            html.append( h )
+            md.append( test.formatMarkdown() )
+
+      self.resultstable = Table(rows,tableHeader)
+      self.frac = obtained_marks/total_marks if total_marks != 0 else 0
+      self.otherOutput = other
+      self.html = "\n".join( html )
+      self.md = "\n".join( md )
+
+   def getOtherOutput(self):
+       if self.otherOutput is None:
+           return [ x.asdict() for x in self.testresults if not x.isTest() ]
+       return self.otherOutput
 
    def getMarkdownResult(self, graderstate=None):
+       with metrics.phase( "render" ):
+           return self.markdownResult( graderstate )
+   def markdownResult(self, graderstate=None):
        ol = self.getOtherOutput()
        if ol:
            prehtml = ( "# Other output / error-messages from testgrader\n\n"
-              + "\n".join(ol) + "\n" )
+              + "\n".join( map( json.dumps, ol ) ) + "\n" )
        else: prehtml = ""
        if graderstate:
            gs = "# Graderstate\n\n" + str(graderstate)
@@ -178,8 +233,11 @@ class TestResults:
        """
        Return the test results as a `dict`.
        """
-       rl = [ test.asdict() for test in self.testresults ]
-       rl = [ x for x in rl if not "gpt_svar" in x.keys() ]
+       with metrics.phase( "render" ):
+           return self.feedbackObject( graderstate )
+   def feedbackObject(self, graderstate=None):
+       rl = [ test.asdict() for test in self.testresults
+              if test.get( "gpt_svar" ) is None ]
        ol = self.getOtherOutput()
        obj = { "fraction": self.frac,
                "testresults": self.resultstable.asList(),
@@ -193,7 +251,7 @@ class TestResults:
       """
       Return the contents of the TestResults as a string.
       """
-      contents = { "TestResultsObj": self.getFeedbackObjedt( other_lines=True ) }
+      contents = { "TestResultsObj": self.getFeedbackObject() }
       return json.dumps(contents)
    def getCodeRunnerOutput(self,
                            graderstate=None,
@@ -202,15 +260,20 @@ class TestResults:
        Return the test results as used by CodeRunner.
        This is string representation of a JSON object.
        """
+       with metrics.phase( "render" ):
+           return self.codeRunnerOutput( graderstate, other_lines )
+   def codeRunnerOutput(self, graderstate=None, other_lines=False ):
        if other_lines:
           ol = self.getOtherOutput()
        else: ol = []
        if ol:
               prehtml = f"""<h2>Other output / error-messages from testgrader </h2>
          <p><br>
-         {"<br>".join( ol )}
+         {"<br>".join( map( json.dumps, ol ) )}
          </p></br>"""
        else: prehtml = ""
+       if self.retry:
+          prehtml = f"<p>{self.retry}</p>"
        obj = { "fraction": self.frac,
                "testresults": self.resultstable.asList(),
                "prologuehtml": prehtml,
@@ -222,14 +285,14 @@ class TestResults:
        return [ x.asdict() for x in self.testresults ]
    def phtml(self):
        """Return freeform feedback in HTML."""
-       rl = [ test.formatResult() for test in self.testresults ]
-       rl = [ x for x in rl if x is not None ]
-       return "\n".join( rl )
+       if self.html is None:
+           self.scan( self.tableHeader or [] )
+       return self.html
    def pmd(self):
        """Return freeform feedback in Markdown."""
-       rl = [ test.formatMarkdown() for test in self.testresults ]
-       rl = [ x for x in rl if x is not None ]
-       return "\n".join( rl )
+       if self.md is None:
+           self.scan( self.tableHeader or [] )
+       return self.md
 
 def debugPrintResults(testResults):
     """Print a list of Test objects for debugging purposes."""
@@ -280,17 +343,65 @@ class GraderState:
     def addFeedback(self,svar):
        self.graderstate["svar"].append(svar)
        self.graderstate["step"] += 1
-    def getHistory(self,debug=None):
-        """Return the feedback history as a conversation for OpenAI API."""
+    def withdrawAnswer(self):
+       """Remove the last answer, which did not get feedback."""
+       self.graderstate["studans"].pop()
+    def addReuse(self,**record):
+       """Record that the feedback at the current step is reused."""
+       record["step"] = self.graderstate["step"]
+       self.graderstate.setdefault( "reuse", [] ).append( record )
+    def getHistory(self,keep=None,debug=None):
+        """Return the feedback history as a conversation for OpenAI API.
+
+        If `keep` is given, only the last `keep` answers with feedback
+        are given verbatim.  Older answers are omitted and the feedback
+        is replaced by a summary of the test results.
+        """
         gs = self.graderstate
         ans = [ { "role": "user", "content": x } for x in gs["studans"] ]
         res = [ { "role": "assistant", "content": x } for x in gs["svar"] ]
         if len(ans) != len(res) + 1:
                 raise Exception("Should have had feedback for all but last student answer")
+        if keep is not None:
+            keep = max( 0, keep )
+            for i in range( len(res) - keep ):
+                ans[i]["content"] = f"[Svar nr. {i+1} er utelatt.]"
+                res[i]["content"] = summariseFeedback( res[i]["content"] )
         r = ans + res
         r[::2] = ans
         r[1::2] = res
         return r
+    def compact(self,keep):
+        """
+        Replace all but the last `keep` answers and feedback items
+        in the graderstate by summaries, to limit its size.
+        """
+        gs = self.graderstate
+        keep = max( 0, keep )
+        for i in range( len(gs["svar"]) - keep ):
+            gs["studans"][i] = ""
+            gs["svar"][i] = json.dumps( { "summary":
+                                          summariseFeedback( gs["svar"][i] ) } )
+
+def summariseFeedback(svar):
+    """
+    Return a compact summary of a feedback item from the graderstate,
+    giving the name and result of each test.
+    """
+    try:
+        content = json.loads( svar )
+    except (ValueError, TypeError):
+        content = svar
+    if isinstance( content, dict ) and "summary" in content:
+        return content["summary"]
+    if not isinstance( content, str ):
+        content = json.dumps( content )
+    tests = [ t for t in dumpResponse( content ) if t.isTest() ]
+    if not tests:
+        return "Tidligere tilbakemelding: ingen tester."
+    return "Tidligere tilbakemelding: " + "; ".join(
+        f'{t.name}: {"bestått" if t.passed else "ikke bestått"}'
+        for t in tests )
 
 class Engine:
     def __init__(self,problem,studans=None,
@@ -306,30 +417,99 @@ class Engine:
         self.graderstate = GraderState(gs,studans)
         self.literatur = literatur
         self.sandbox = sandbox
+        self.qid = qid
         self.debug = debug
+        self.deadline = None
+        if sandbox.get( "timelimit" ):
+            started = float( sandbox.get( "started" ) or time.time() )
+            self.deadline = ( started + float( sandbox["timelimit"] )
+                            - float( sandbox.get( "deadline_margin", 2.0 ) ) )
+    def remaining(self):
+        """Return the time in seconds left until the deadline, or None."""
+        if self.deadline is None: return None
+        return self.deadline - time.time()
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+    def prefixLayout(self):
+        """
+        Return True if `prompt_layout = "prefix"` is set in the sandbox.
+        Then the system prompt holds only the content which is the same
+        for every answer to the question, in a fixed order, so that it
+        can be served from the prompt cache of the provider, and the
+        per-student content follows in later messages.
+        """
+        return self.sandbox.get( "prompt_layout", "default" ) == "prefix"
+    def template(self):
+        """Return the prompt template, which is part of the dedup key."""
+        return getResource( "prompt-prefix.md" if self.prefixLayout() else "prompt.md" )
+    def getAnswer(self):
+        """
+        Return the user message with the student answer.  With the
+        prefix layout, the previous answer, if any, is included here
+        instead of in the system prompt.
+        """
+        prev = self.graderstate.graderstate["studans"][:-1]
+        if not self.prefixLayout() or not prev:
+            return self.studans
+        return ( f"Studentens forrige svar:\n{prev[-1]}\n\n"
+               + f"Studentens svar:\n{self.studans}" )
     def getPrompt(self,debug=None):
+        if debug is None: debug = self.debug
+        if self.prefixLayout():
+            prompt = getResource( "prompt-prefix.md" )
+            prompt = prompt.format( problem=self.problem,
+                                    criteria=self.criteria,
+                                    literatur=self.getLiterature() )
+            self.promptTokens = countTokens( prompt ) + countTokens( self.getAnswer() )
+            metrics.label( prompt_estimate=self.promptTokens )
+            if debug:
+                print( f"[getPrompt] prompt tokens: {self.promptTokens} (estimate), "
+                       + f"static prefix: {countTokens( prompt )}" )
+            return prompt
         gs = self.graderstate
-        mdfn=getfn("prompt.md")
         try:
            prevans = gs[ "studans" ][-1]
         except:
            prevans = "Ingen tidligere svar gitt"
 
-        with open(mdfn, 'r') as file:
-            prompt = file.read()
+        prompt = getResource( "prompt.md" )
         prompt = prompt.format( problem=self.problem,
-                            literatur=self.literatur,
+                            literatur=self.getLiterature(),
                             prevans=prevans,
                            )
+        self.promptTokens = countTokens( prompt ) + countTokens( self.studans )
+        metrics.label( prompt_estimate=self.promptTokens )
+        if debug:
+            print( f"[getPrompt] prompt tokens: {self.promptTokens} (estimate)" )
         return prompt
+    def getLiterature(self):
+        """
+        Return the literature for the prompt, restricted to the passages
+        most relevant to the problem, criteria and answer if `lit_topk`
+        is configured.  With the prefix layout, the answer is not used,
+        so that the selection is the same for every answer.
+        """
+        if self.prefixLayout():
+            query = "\n".join( [ self.problem, self.criteria ] )
+        else:
+            query = "\n".join( [ self.problem, self.criteria, self.studans ] )
+        return selectLiterature( self.literatur, query, self.sandbox )
     def getHistory(self,debug=None):
-        return self.graderstate.getHistory()
+        """
+        Return the conversation history, keeping only the last
+        `history` turns verbatim if this is set in the sandbox.
+        """
+        keep = self.sandbox.get( "history" )
+        if keep is not None: keep = int( keep )
+        return self.graderstate.getHistory( keep )
     def getGraderState(self,debug=None):
         return self.graderstate
     def queryAI(self,debug=None):
         if debug is None: debug = self.debug
-        prompt = self.getPrompt()
-        response = queryAI(self.sandbox, prompt, self.studans, debug=debug)
+        with metrics.phase( "prompt" ):
+            prompt = self.getPrompt()
+        response = queryAI(self.sandbox, prompt, self.getAnswer(), debug=debug,
+                           deadline=self.deadline)
         if debug: 
             print( "== prompt ==" )
             print( prompt )
@@ -340,6 +520,93 @@ class Engine:
         testResults.finalise()
         self.testResults = testResults
         return testResults
+    def run(self,debug=None):
+        """
+        Return the test results for the answer, within the deadline
+        given by `timelimit` in the sandbox, if any, counted from
+        `started` (as given by `time.time()`) if given, e.g. by the
+        thin client of the daemon, and otherwise from now.
+
+        With less than `min_time` seconds (default 3) left, or if the
+        query fails at the deadline, a result asking the student to try
+        again is returned.  With less than `fallback_time` seconds
+        (default 10) left, the `fallback_model` is used if configured,
+        at `fallback_url` if given.
+        """
+        if debug is None: debug = self.debug
+        remaining = self.remaining()
+        if remaining is not None:
+            if remaining < float( self.sandbox.get( "min_time", 3.0 ) ):
+                return self.tryAgain(debug)
+            fallback = self.sandbox.get( "fallback_model" )
+            if fallback and remaining < float( self.sandbox.get( "fallback_time", 10.0 ) ):
+                if debug:
+                    print( f"[run] {remaining:.1f}s left, using {fallback}" )
+                self.sandbox = dict( self.sandbox, model=fallback )
+                if self.sandbox.get( "fallback_url" ):
+                    self.sandbox["url"] = self.sandbox["fallback_url"]
+                metrics.label( fallback=fallback )
+        try:
+            testResults = self.queryOrReuse(debug)
+        except Exception as e:
+            if not self.expired(): raise
+            if debug:
+                print( f"[run] {type(e).__name__} at the deadline: {e}" )
+            return self.tryAgain(debug)
+        if testResults.exitCode != 0 and self.expired():
+            return self.tryAgain(debug)
+        return testResults
+    def tryAgain(self,debug=None):
+        if debug is None: debug = self.debug
+        if debug:
+            print( "[run] out of time; asking the student to try again" )
+        testResults = TestResults.tryAgain()
+        testResults.finalise()
+        self.testResults = testResults
+        metrics.label( tryagain=True )
+        return testResults
+    def queryOrReuse(self,debug=None):
+        """
+        Return the test results for the answer, querying the AI with
+        `queryAI()`, unless `dedup` is set in the sandbox and a
+        near-duplicate of the answer to the same question has been
+        graded before with the same model, criteria and prompt.  Then
+        its results are reused, and the reuse is recorded in the
+        graderstate.  Only complete results, which were parsed without
+        repair failures, are added to the index.  Repeated queries with
+        a `cache_salt` are never deduplicated.
+        """
+        if debug is None: debug = self.debug
+        mode = dedup.dedupMode( self.sandbox )
+        if mode == "off" or "cache_salt" in self.sandbox:
+            return self.queryAI(debug)
+        index = dedup.getIndex( self.sandbox, self.qid, self.problem,
+                                self.criteria, self.template() )
+        hit = index.query( self.studans )
+        if hit is None:
+            testResults = self.queryAI(debug)
+            tests = testResults.testresults
+            if ( testResults.exitCode == 0 and not isMalformed( tests )
+                 and not any( t.type == "partial" for t in tests ) ):
+                index.add( self.studans, "\n".join(
+                    [ t.dump() for t in testResults.testresults
+                      if t.type != "nontest" ] ) )
+            return testResults
+        entry, sim = hit
+        if debug:
+            print( f"[run] reusing feedback (similarity {sim:.3f})" )
+        testResults = TestResults.fromFrames( entry["frames"] )
+        if mode == "draft":
+            note = Test()
+            note.setNontest( "Foreløpig tilbakemelding, gjenbrukt fra et svært likt svar." )
+            testResults.testresults.append( note )
+        testResults.finalise()
+        self.testResults = testResults
+        self.graderstate.addReuse( mode=mode, qid=self.qid,
+                                   similarity=round( sim, 3 ),
+                                   source=entry["hash"][:12] )
+        metrics.label( dedup=mode )
+        return testResults
     def advanceGraderstate(self,debug=None):
         """
         Advance the graderstate, adding the response from the AI.
@@ -348,13 +615,18 @@ class Engine:
         if debug is None: debug = self.debug
 
         res = self.testResults
+        if res.retry:
+            self.graderstate.withdrawAnswer()
+            return self.graderstate
 
-        xs = [ test for test in res.testresults if test.result["name"] == "svardata" ]
+        xs = [ test for test in res.testresults if test.name == "svardata" ]
         if len(xs) == 0:
             raise Exception( "No feedback" )
         if len(xs) > 1:
             raise Exception( "Multiple feedback entries" )
-        self.graderstate.addFeedback(xs[0].result["gpt_svar"])
+        self.graderstate.addFeedback(xs[0].get("gpt_svar"))
+        if self.sandbox.get( "history_compact" ) and "history" in self.sandbox:
+            self.graderstate.compact( int( self.sandbox["history"] ) )
         return self.graderstate
     def getResult(self,debug=None):
         return self.testResults
@@ -362,21 +634,29 @@ class Engine:
         return self.testResults.getMarkdownResult(*arg,**kw,graderstate=self.graderstate)
 
 class NewEngine(Engine):
+    def template(self):
+        return getResource( getfn("prompt2.md") )
     def getPrompt(self,mdfn=getfn("prompt2.md"),debug=None):
         if debug is None: debug = self.debug
-        with open(mdfn, 'r') as file:
-            template = file.read()
+        template = getResource( mdfn )
         print( f"[getPrompt] mdfn={mdfn}" )
         sys = template.format( problem=self.problem
                              , criteria=self.criteria
-                             , literatur=self.literatur )
+                             , literatur=self.getLiterature() )
         prompt = [ { "role" : "system",  "content" : sys } ]
         prompt.extend( self.getHistory() )
+        self.promptTokens = countTokens( prompt )
+        metrics.label( prompt_estimate=self.promptTokens )
+        if debug:
+            print( f"[getPrompt] prompt tokens: {self.promptTokens} (estimate)" )
         return prompt
 
     def queryAI(self,debug=None):
         if debug is None: debug = self.debug
-        response = queryAI(self.sandbox, self.getPrompt(), debug=debug)
+        with metrics.phase( "prompt" ):
+            prompt = self.getPrompt()
+        response = queryAI(self.sandbox, prompt, debug=debug,
+                           deadline=self.deadline)
         if debug: debugPrintResults(response)
 
         testResults = TestResults(ob=response)
@@ -387,16 +667,20 @@ class NewEngine(Engine):
 class DumpEngine(Engine):
     """DumpEngine tests the extra step of dumping and reparsing
     the response, as is required with the `SandboxEngine` but
-    without using the sandbox (subprocess).
+    without using the sandbox (subprocess).  The dump uses the
+    same frames as the protocol with the test program.
     """
     def queryAI(self,debug=None):
         if debug is None: debug = self.debug
-        response = queryAI(self.sandbox, self.getPrompt(), self.studans, debug=debug)
+        with metrics.phase( "prompt" ):
+            prompt = self.getPrompt()
+        response = queryAI(self.sandbox, prompt, self.getAnswer(), debug=debug,
+                           deadline=self.deadline)
         if debug: debugPrintResults(response)
         # Dump the result as a string and have `TestResults` reparse it,
         # in the way that is required for `subprocess` in `runAnswer()`.
         output = "\n".join( [ x.dump() for x in response ] )
-        testResults = TestResults(output)
+        testResults = TestResults.fromFrames(output)
         testResults.finalise()
         self.testResults = testResults
         return testResults
@@ -413,28 +697,29 @@ def testProgram(problem,studans,literatur={},criteria="",gs="",sandbox={},qid=0,
     and the language models from the command line.
     """
 
-    if debug:
-        print( f"[testProgram] debug; mode={mode}." )
-
-    if mode == "baseline":
-       eng = Engine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
-    elif mode == "new":
-        eng = NewEngine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
-    elif mode == "dump":
-        eng = DumpEngine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
-    else:
-        raise Exception( f"Unknown mode {mode}." )
-    testResults = eng.queryAI()
-    if debug: testResults.debugPrintResults()
-    eng.advanceGraderstate( )
-    if debug: print( eng.getGraderState() )
-    if outfile:
-        with open(outfile, 'w') as f:
-            tr = eng.getResult().asdict()
-            json.dump(tr, f, indent=4) 
-    if raw:
-       return eng.getResult()
-    elif markdown:
-       return eng.getMarkdownResult( )
-    else:
-       return eng.getResult().getCodeRunnerOutput( other_lines=True )
+    with metrics.record( sandbox, model=sandbox.get( "model" ), mode=mode ):
+        if debug:
+            print( f"[testProgram] debug; mode={mode}." )
+
+        if mode == "baseline":
+           eng = Engine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
+        elif mode == "new":
+            eng = NewEngine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
+        elif mode == "dump":
+            eng = DumpEngine(problem,studans,literatur,criteria,gs,sandbox,qid,debug)
+        else:
+            raise Exception( f"Unknown mode {mode}." )
+        testResults = eng.run()
+        if debug: testResults.debugPrintResults()
+        eng.advanceGraderstate( )
+        if debug: print( eng.getGraderState() )
+        if outfile:
+            with open(outfile, 'w') as f:
+                tr = eng.getResult().asdict()
+                json.dump(tr, f, indent=4) 
+        if raw:
+           return eng.getResult()
+        elif markdown:
+           return eng.getMarkdownResult( )
+        else:
+           return eng.getResult().getCodeRunnerOutput( other_lines=True )
@@ -0,0 +1,320 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Managed HTTP client for the connection to the LLM.
+
+A session is kept per endpoint, so that the TCP connection
+and TLS handshake are reused between queries in the same process.
+Connection parameters are read from the sandbox dict:
+
++ `pool_size` - maximum number of pooled connections per endpoint (default 10)
++ `connect_timeout` - timeout in seconds to establish the connection (default 5)
++ `read_timeout` - timeout in seconds waiting for the server (default 120)
++ `transport` - `requests` (default) or `http` for the lightweight
+  transport in the `lite` module, using only the standard library
+
+Failed requests (connection errors and the status codes in
+`RETRY_STATUS`) are retried with exponential backoff and full jitter,
+honouring `Retry-After` from the server.  A read timeout, where the
+server may have processed (and billed) the request, is only retried
+with `retry_timeouts`.  Retries are recorded in the metrics labels
+`retries` and `retry_reason`, not printed, since the output of the
+test program is shown to the student.
+
++ `retries` - maximum number of retries (default 2)
++ `retry_timeouts` - also retry read timeouts (default false)
++ `backoff` - base delay in seconds (default 0.5)
++ `backoff_max` - maximum delay in seconds (default 30)
++ `call_timeout` - deadline in seconds for the call including retries
+
+Optionally, a hedged duplicate request is sent if the first one
+has not answered in time, and the first response is used:
+
++ `hedge` - delay in seconds, or `p95` to use the 95th percentile
+  of recent latencies to the endpoint (after `hedge_min` calls,
+  default 20)
+
+The URL may also be a list of endpoints, balanced as described
+in the `balancer` module.
+
+Modules which are only needed for some features are imported on first
+use, to keep the start-up time of the sandboxed test program low.
+"""
+
+import json, time, random, threading
+from collections import deque
+from urllib.parse import urlsplit
+
+from . import metrics, balancer
+
+RETRY_STATUS = ( 408, 429, 500, 502, 503, 504 )
+
+_sessions = {}
+_latencies = {}
+_executor = None
+_lock = threading.Lock()
+
+def endpointKey(url):
+    """Return the (scheme, host, port) key used to pool connections for `url`."""
+    u = urlsplit(url)
+    return ( u.scheme, u.hostname, u.port )
+
+def getTimeout(sandbox):
+    """Return the (connect, read) timeout tuple configured in sandbox."""
+    return ( float( sandbox.get( "connect_timeout", 5.0 ) ),
+             float( sandbox.get( "read_timeout", 120.0 ) ) )
+
+def getTransport(sandbox={}):
+    transport = sandbox.get( "transport", "requests" )
+    if transport not in [ "requests", "http" ]:
+        raise Exception( f"Unknown transport {transport}." )
+    return transport
+
+def transientErrors(sandbox={}):
+    """Return the exception classes which cause a retry for the transport."""
+    if getTransport(sandbox) == "http":
+        from .lite import TRANSIENT
+        return TRANSIENT
+    import requests
+    return ( requests.ConnectionError, requests.Timeout )
+
+def readTimeout(e,sandbox={}):
+    """
+    Return True if the exception `e` is a timeout waiting for the
+    response.  With the `http` transport, a connect timeout cannot be
+    told apart and counts as well.
+    """
+    if getTransport(sandbox) == "http":
+        return isinstance( e, TimeoutError )
+    import requests
+    from urllib3.exceptions import ReadTimeoutError
+    # A timeout reading the body is raised as a ConnectionError.
+    return isinstance( e, requests.ReadTimeout ) or \
+        any( isinstance( a, ReadTimeoutError ) for a in e.args )
+
+def getSession(url,sandbox={}):
+    """
+    Return the session for the endpoint of `url`, creating it
+    on first use.  The pool size is only read when the session is created.
+    """
+    transport = getTransport(sandbox)
+    key = ( transport, ) + endpointKey(url)
+    with _lock:
+        session = _sessions.get( key )
+        if session is None:
+            size = int( sandbox.get( "pool_size", 10 ) )
+            if transport == "http":
+                from .lite import LiteSession
+                session = LiteSession( size )
+            else:
+                import requests
+                from .pooladapter import PoolAdapter
+                adapter = PoolAdapter( pool_connections=1, pool_maxsize=size )
+                session = requests.Session()
+                session.mount( "http://", adapter )
+                session.mount( "https://", adapter )
+            _sessions[key] = session
+    return session
+
+def retryAfter(response):
+    """Return the delay in seconds requested by `Retry-After`, or None."""
+    v = response.headers.get( "Retry-After" )
+    if not v: return None
+    try:
+        return max( 0.0, float(v) )
+    except ValueError:
+        pass
+    import email.utils
+    try:
+        t = email.utils.parsedate_to_datetime( v )
+        return max( 0.0, t.timestamp() - time.time() )
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt,sandbox={},response=None):
+    """
+    Return the delay before retry number `attempt` (from 0),
+    with full jitter, but no less than `Retry-After` in the response.
+    """
+    base = float( sandbox.get( "backoff", 0.5 ) )
+    cap = float( sandbox.get( "backoff_max", 30.0 ) )
+    delay = random.uniform( 0, min( cap, base * 2**attempt ) )
+    if response is not None:
+        ra = retryAfter( response )
+        if ra is not None:
+            delay = max( delay, ra )
+    return delay
+
+def latencyKey(url):
+    if isinstance( url, str ):
+        return endpointKey(url)
+    return json.dumps( url, sort_keys=True )
+
+def recordLatency(url,seconds):
+    with _lock:
+        _latencies.setdefault( latencyKey(url), deque( maxlen=500 ) ).append( seconds )
+
+def hedgeDelay(url,sandbox={}):
+    """Return the delay before a hedged request is sent, or None."""
+    h = sandbox.get( "hedge" )
+    if not h: return None
+    if h != "p95":
+        return float( h )
+    with _lock:
+        xs = list( _latencies.get( latencyKey(url), [] ) )
+    if len(xs) < int( sandbox.get( "hedge_min", 20 ) ):
+        return None
+    return metrics.percentile( xs, 95 )
+
+def getExecutor():
+    from concurrent.futures import ThreadPoolExecutor
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor( max_workers=32,
+                                            thread_name_prefix="hedge" )
+    return _executor
+
+def hedged(send,delay):
+    """
+    Call `send()` to make the request, and again if there is no response
+    after `delay` seconds.  Return the first successful response;
+    the other one is closed when it arrives.
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+    rec = metrics.current()
+    def call():
+        with metrics.attach( rec ):
+            return send()
+    ex = getExecutor()
+    futures = [ ex.submit( call ) ]
+    done, _ = wait( futures, timeout=delay )
+    if not done:
+        metrics.label( hedged=True )
+        futures.append( ex.submit( call ) )
+    error = None
+    pending = set( futures )
+    while pending:
+        done, pending = wait( pending, return_when=FIRST_COMPLETED )
+        for f in done:
+            if f.exception() is not None:
+                error = error or f.exception()
+                continue
+            for g in pending:
+                g.add_done_callback( lambda g: g.exception() or g.result().close() )
+            return f.result()
+    raise error
+
+def sendBalanced(balancer,sandbox,kw,exclude):
+    """
+    Send the request to an endpoint chosen by the balancer, avoiding
+    those in `exclude`, to which the chosen endpoint is added.
+    The endpoint is released when the response has been read,
+    or, for a streamed response, when it is closed.
+    """
+    ep = balancer.acquire( exclude )
+    exclude.append( ep )
+    if ep.key:
+        headers = dict( kw.get( "headers" ) or {} )
+        headers["Authorization"] = f"Bearer {ep.key}"
+        kw = dict( kw, headers=headers )
+    t0 = time.perf_counter()
+    try:
+        response = getSession(ep.url,sandbox).post(ep.url,**kw)
+    except BaseException:
+        # Release on any error, lest the endpoint stay outstanding.
+        balancer.release( ep, False )
+        raise
+    ok = response.status_code not in RETRY_STATUS
+    latency = time.perf_counter() - t0 if ok else None
+    if not kw.get( "stream" ):
+        balancer.release( ep, ok, latency )
+        return response
+    close = response.close
+    released = []
+    def closing():
+        if not released:
+            released.append( True )
+            balancer.release( ep, ok, latency )
+        close()
+    response.close = closing
+    return response
+
+def post(url,sandbox={},deadline=None,**kw):
+    """
+    Make a POST request to `url` using the pooled session for the endpoint.
+    Keyword arguments are passed to the `post()` method of the session.
+
+    If `url` is a list of endpoints, each attempt goes to an endpoint
+    chosen by the `balancer` module, preferring one not tried before.
+
+    The request is retried as configured in the sandbox, until
+    the `deadline` (as given by `time.time()`) or `call_timeout`.
+    If the deadline is reached, the last response is returned,
+    or the last exception is raised.
+    """
+    if "call_timeout" in sandbox:
+        t = time.time() + float( sandbox["call_timeout"] )
+        deadline = t if deadline is None else min( deadline, t )
+    retries = int( sandbox.get( "retries", 2 ) )
+    timeout = kw.pop( "timeout", getTimeout(sandbox) )
+    if isinstance( url, str ):
+        session = getSession(url,sandbox)
+        send = lambda: session.post(url,**kw)
+    else:
+        b = balancer.getBalancer( url, sandbox )
+        tried = []
+        send = lambda: sendBalanced(b,sandbox,kw,tried)
+    attempt = 0
+    with metrics.phase( "http" ):
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception( f"Deadline exceeded before request to {url}." )
+                if isinstance( timeout, tuple ):
+                    kw["timeout"] = ( min( timeout[0], remaining ),
+                                      min( timeout[1], remaining ) )
+                else:
+                    kw["timeout"] = min( timeout, remaining )
+            else:
+                kw["timeout"] = timeout
+            response = None
+            t0 = time.perf_counter()
+            try:
+                delay = hedgeDelay(url,sandbox)
+                if delay is None:
+                    response = send()
+                else:
+                    response = hedged(send,delay)
+            except transientErrors(sandbox) as e:
+                if attempt >= retries: raise
+                if readTimeout( e, sandbox ) and not sandbox.get( "retry_timeouts" ):
+                    raise
+                metrics.label( retry_reason=f"{type(e).__name__}: {e}" )
+                error = e
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= retries:
+                    break
+                metrics.label( retry_reason=f"status {response.status_code}" )
+            wait_ = backoff( attempt, sandbox, response )
+            if deadline is not None and time.time() + wait_ >= deadline:
+                if response is None: raise error
+                break
+            if response is not None:
+                response.close()
+            attempt += 1
+            metrics.label( retries=attempt )
+            with metrics.phase( "backoff" ):
+                time.sleep( wait_ )
+    if response.status_code == 200:
+        recordLatency( url, time.perf_counter() - t0 )
+    metrics.add( "ttfb", response.elapsed.total_seconds() )
+    return response
+
+def closeAll():
+    """Close all pooled sessions.  New sessions are created on demand."""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
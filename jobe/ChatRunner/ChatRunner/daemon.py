@@ -0,0 +1,355 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+A long-lived local grading service, and the thin client used by the
+CodeRunner template.
+
+Without the daemon, every attempt starts an interpreter, imports
+ChatRunner, loads the templates and opens a new connection to the
+LLM API.  The daemon, run on the Jobe host with
+`python -m ChatRunner serve`, does this once and grades answers
+in-process, as `runAnswer()` with the in-process `Engine`, so that
+the HTTP sessions, template and literature caches, and dedup indices
+stay warm.  The student answer is only ever data, as in the test
+program (see `testrunner`).
+
+The daemon speaks HTTP with JSON bodies, on a Unix socket
+(`unix:/path`, the default) or on localhost (`http://127.0.0.1:8765`):
+
++ `POST /grade` - the job, an object with the arguments of
+  `runAnswer()` (`problem`, `studans`, `literatur`, `criteria`, `gs`,
+  `sandbox`, `qid`), returning `{"output": ...}`, the CodeRunner output
++ `GET /stats` - queue depth, jobs in flight, and counts of jobs
+  served, failed and rejected
+
+With `--workers`, the queries are instead run in a pool of persistent
+worker processes (see `workerpool`), which isolates them from the
+daemon and lets a query which overruns its time be killed.
+
+Jobs are run by a fixed number of threads (`--threads`); at most
+`--queue` jobs wait for a thread, and further jobs are rejected with
+status 503.  The `[server]` section of the config given with `-C`
+is the sandbox of every job, including the API, URL and key.
+A job may only set the keys in `allowed` (the per-question options,
+which neither choose a URL nor where files are written), and the
+further keys listed in `daemon_allow` in the config, e.g. `url`.
+Otherwise, any local process could send the configured key to a URL
+of its choice, or make the daemon write files (metrics, caches) where
+it wants.  Other keys are dropped, and logged the first time they are
+seen.  Empty values from the client are ignored.  The time of the request is passed as `started`,
+so that the deadline from `timelimit` includes the time spent in
+the queue.  The Unix socket has mode 660 by default; the Jobe users
+must be in its group, or `--mode` must be given.
+
+The client, `gradeRemote()`, uses only the standard library, and
+falls back to `runAnswer()` in its own process if the daemon is not
+running or fails to grade the answer.  With little time left,
+`runAnswer()` asks the student to try again (see `Engine.run()`).
+"""
+
+import os, sys, json, time, socket, argparse, threading
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+DEFAULT = "unix:/run/chatrunner/chatrunner.sock"
+
+allowed = [ "model", "timelimit", "started", "fallback_model", "fallback_time",
+            "min_time", "history", "history_compact", "prompt_layout",
+            "dedup", "dedup_threshold", "lit_topk", "lit_budget",
+            "stream", "requery", "options", "num_ctx" ]
+
+class Busy(Exception):
+    """Raised when the queue of the daemon is full."""
+
+class DaemonError(Exception):
+    """Raised by the client when the daemon returns an error status."""
+    def __init__(self,status,message):
+        super().__init__( f"ChatRunner daemon returns {status}: {message}" )
+        self.status = status
+
+def parseAddress(address):
+    """
+    Return ("unix", path) or ("tcp", (host, port)) for a daemon address,
+    given as `unix:/path`, a path, or `http://host:port`.
+    """
+    if address.startswith( "unix:" ):
+        return "unix", address[5:]
+    if address.startswith( "http://" ):
+        u = urlsplit( address )
+        return "tcp", ( u.hostname or "127.0.0.1", u.port or 8765 )
+    if address.startswith( "/" ):
+        return "unix", address
+    raise Exception( f"Invalid daemon address {address}." )
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+    def __init__(self,socketPath,timeout=None):
+        super().__init__( "localhost", timeout=timeout )
+        self.socketPath = socketPath
+    def connect(self):
+        self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        self.sock.settimeout( self.timeout )
+        self.sock.connect( self.socketPath )
+
+def call(address,method,path,body=None,timeout=60.0):
+    """Send a request to the daemon and return the decoded JSON response."""
+    kind, where = parseAddress( address )
+    if kind == "unix":
+        conn = UnixHTTPConnection( where, timeout )
+    else:
+        conn = http.client.HTTPConnection( *where, timeout=timeout )
+    try:
+        data = None if body is None else json.dumps( body ).encode()
+        conn.request( method, path, body=data,
+                      headers={ "Content-Type": "application/json" } )
+        resp = conn.getresponse()
+        payload = json.loads( resp.read() or b"{}" )
+    finally:
+        conn.close()
+    if resp.status != 200:
+        raise DaemonError( resp.status, payload.get( "error" ) )
+    return payload
+
+def gradeRemote(problem,studans,literatur={},criteria="",gs="",sandbox=None,qid=0,
+                daemon=None):
+    """
+    Grade the answer in the daemon at the address `daemon`, returning
+    the CodeRunner output as `runAnswer()` does.  Without an address,
+    or if the daemon is not running, is full, fails or times out,
+    `runAnswer()` is used locally, and if this fails too, the student
+    is asked to try again.  The timeout is one second after
+    the deadline of the daemon, within the `deadline_margin`.
+    """
+    sandbox = dict( sandbox or {}, started=time.time() )
+    if daemon:
+        job = { "problem": problem, "studans": studans, "literatur": literatur,
+                "criteria": criteria, "gs": gs, "sandbox": sandbox, "qid": qid }
+        if sandbox.get( "timelimit" ):
+            timeout = max( 1.0, float( sandbox["timelimit"] ) + 1.0
+                                - float( sandbox.get( "deadline_margin", 2.0 ) ) )
+        else:
+            timeout = 60.0
+        try:
+            return call( daemon, "POST", "/grade", job, timeout )["output"]
+        except ( OSError, http.client.HTTPException, ValueError, DaemonError ):
+            pass
+    from .sandbox import runAnswer
+    if not daemon:
+        return runAnswer( problem, studans, literatur, criteria, gs=gs,
+                          sandbox=sandbox, qid=qid )
+    try:
+        return runAnswer( problem, studans, literatur, criteria, gs=gs,
+                          sandbox=sandbox, qid=qid )
+    except Exception:
+        # E.g. the API config is only in the daemon.
+        return tryAgain( problem, studans, literatur, criteria, gs, sandbox, qid )
+
+def tryAgain(problem,studans,literatur,criteria,gs,sandbox,qid):
+    """Return the CodeRunner output asking the student to try again."""
+    from .sandbox import Engine
+    eng = Engine( problem, studans, literatur, criteria, gs, sandbox, qid )
+    eng.tryAgain()
+    eng.advanceGraderstate()
+    return eng.getResult().getCodeRunnerOutput( other_lines=True )
+
+class Grader:
+    """
+    The jobs of the daemon: a pool of `threads` threads running
+    `runAnswer()` in-process, with at most `queue` jobs waiting,
+    and the counters reported by `stats()`.
+    """
+    def __init__(self,config={},threads=8,queue=64,workers=0):
+        from concurrent.futures import ThreadPoolExecutor
+        self.config = config
+        self.threads = threads
+        self.queue = queue
+        self.workers = workers
+        if workers > 0:
+            from .workerpool import getPool
+            getPool( workers )
+        self.executor = ThreadPoolExecutor( max_workers=threads )
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queued = 0
+        self.inflight = 0
+        self.served = 0
+        self.errors = 0
+        self.rejected = 0
+        self.busy = 0.0
+        self.dropped = set()
+    def sandbox(self,sandbox):
+        """
+        Return the sandbox of a job: the config, with the keys of the
+        job which are `allowed` or listed in `daemon_allow`.
+        """
+        keys = set( allowed ) | set( self.config.get( "daemon_allow", [] ) )
+        dropped = { k for k, v in sandbox.items()
+                    if k not in keys and v not in ( "", None ) }
+        with self.lock:
+            new = dropped - self.dropped
+            self.dropped |= new
+        if new:
+            print( f"[daemon] ignoring sandbox keys {sorted(new)}; see daemon_allow" )
+        sandbox = dict( self.config, **{ k: v for k, v in sandbox.items()
+                                         if k in keys and v not in ( "", None ) } )
+        if self.workers > 0:
+            sandbox["workers"] = self.workers
+        return sandbox
+    def grade(self,job):
+        """Run the job and return the CodeRunner output.  Raises `Busy`."""
+        with self.lock:
+            if self.queued >= self.queue:
+                self.rejected += 1
+                raise Busy()
+            self.queued += 1
+        return self.executor.submit( self.run, job ).result()
+    def run(self,job):
+        from .sandbox import runAnswer, Engine, PoolEngine
+        with self.lock:
+            self.queued -= 1
+            self.inflight += 1
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            r = runAnswer( job["problem"], job["studans"], job.get( "literatur", {} ),
+                           job.get( "criteria", "" ), gs=job.get( "gs", "" ),
+                           sandbox=self.sandbox( job.get( "sandbox" ) or {} ),
+                           qid=job.get( "qid", 0 ),
+                           engine=PoolEngine if self.workers > 0 else Engine )
+            ok = True
+            return r
+        finally:
+            with self.lock:
+                self.inflight -= 1
+                self.served += 1
+                self.errors += not ok
+                self.busy += time.perf_counter() - t0
+    def stats(self):
+        with self.lock:
+            return { "queued": self.queued, "inflight": self.inflight,
+                     "threads": self.threads, "served": self.served,
+                     "errors": self.errors, "rejected": self.rejected,
+                     "mean_time": self.busy / self.served if self.served else None,
+                     "uptime": time.time() - self.started, "pid": os.getpid() }
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "ChatRunner"
+    def reply(self,status,obj):
+        data = json.dumps( obj, ensure_ascii=False ).encode()
+        self.send_response( status )
+        self.send_header( "Content-Type", "application/json" )
+        self.send_header( "Content-Length", str( len(data) ) )
+        self.end_headers()
+        self.wfile.write( data )
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply( 200, self.server.grader.stats() )
+        else:
+            self.reply( 404, { "error": f"Unknown path {self.path}" } )
+    def do_POST(self):
+        if self.path != "/grade":
+            return self.reply( 404, { "error": f"Unknown path {self.path}" } )
+        try:
+            job = json.loads( self.rfile.read( int( self.headers.get( "Content-Length", 0 ) ) ) )
+        except ValueError as e:
+            return self.reply( 400, { "error": f"Invalid job: {e}" } )
+        try:
+            output = self.server.grader.grade( job )
+        except Busy:
+            self.reply( 503, { "error": "The grading queue is full." } )
+        except Exception as e:
+            print( f"[daemon] {type(e).__name__}: {e}" )
+            self.reply( 500, { "error": f"{type(e).__name__}: {e}" } )
+        else:
+            self.reply( 200, { "output": output } )
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+    def log_message(self,format,*args):
+        if self.server.verbose:
+            super().log_message( format, *args )
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def makeServer(address,grader,mode=0o660,verbose=False):
+    """Return an HTTP server for the grader, listening at `address`."""
+    kind, where = parseAddress( address )
+    if kind == "unix":
+        if os.path.exists( where ):
+            try:
+                call( address, "GET", "/stats", timeout=1.0 )
+            except ( ConnectionError, FileNotFoundError ):
+                os.unlink( where )
+            else:
+                raise Exception( f"A daemon is already listening at {where}." )
+        os.makedirs( os.path.dirname( where ) or ".", exist_ok=True )
+        server = UnixHTTPServer( where, Handler )
+        os.chmod( where, mode )
+    else:
+        server = ThreadingHTTPServer( where, Handler )
+    server.grader = grader
+    server.verbose = verbose
+    return server
+
+def serve(address,grader,mode=0o660,verbose=False):
+    """
+    Serve until interrupted or terminated, removing the socket on exit.
+    With `metrics_prom` in the config, the Prometheus textfile is
+    rewritten every `metrics_prom_interval` seconds (default 60).
+    """
+    import signal
+    from . import metrics
+    server = makeServer( address, grader, mode, verbose )
+    signal.signal( signal.SIGTERM, lambda *a: sys.exit( 0 ) )
+    prom = grader.config.get( "metrics_prom" )
+    if prom:
+        metrics.startProm( prom, float( grader.config.get( "metrics_prom_interval", 60 ) ) )
+    print( f"ChatRunner daemon listening at {address} with {grader.threads} threads." )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        grader.executor.shutdown( wait=False, cancel_futures=True )
+        if prom:
+            metrics.writeProm( prom )
+        kind, where = parseAddress( address )
+        if kind == "unix" and os.path.exists( where ):
+            os.unlink( where )
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog = 'chatrunner serve',
+        description = 'Local ChatRunner grading daemon' )
+    parser.add_argument('-d','--daemon',default=DEFAULT,
+                        help=f"Address, unix:/path or http://127.0.0.1:port (default {DEFAULT}).")
+    parser.add_argument('-C','--config',help="Config file with defaults for the sandbox.")
+    parser.add_argument('-j','--threads',type=int,default=8,
+                        help="Number of answers graded concurrently.")
+    parser.add_argument('-w','--workers',type=int,default=0,
+                        help="Run the queries in a pool of worker processes (default in-process).")
+    parser.add_argument('--queue',type=int,default=64,
+                        help="Maximum number of waiting answers.")
+    parser.add_argument('--mode',default="660",
+                        help="Permissions of the Unix socket (octal).")
+    parser.add_argument('--status',action="store_true",
+                        help="Print the stats of a running daemon and exit.")
+    parser.add_argument('-v','--verbose',action="store_true",help="Log every request.")
+    args = parser.parse_args( argv[1:] )
+
+    if args.status:
+        print( json.dumps( call( args.daemon, "GET", "/stats", timeout=5.0 ), indent=2 ) )
+        return 0
+    config = {}
+    if args.config:
+        from .helper import readobject
+        config = readobject( args.config ).get( "server", {} )
+    serve( args.daemon, Grader( config, args.threads, args.queue, args.workers ),
+           int( args.mode, 8 ), args.verbose )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main( [ "serve" ] + sys.argv[1:] ) )
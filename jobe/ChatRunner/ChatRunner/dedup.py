@@ -0,0 +1,177 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Near-duplicate detection of student answers with MinHash.
+
+Answers are normalised (case and whitespace), split into overlapping
+character shingles, and summarised by a MinHash signature, whose
+agreement estimates the Jaccard similarity of the shingle sets.
+For each question, an index of the answers graded so far is kept
+on disk, with the dumped test results (see `Test.dump()`), and
+candidates are found by locality sensitive hashing on bands of
+the signature.
+
+The index is configured in the sandbox dict:
+
++ `dedup` - one of `off` (default), `reuse` (return the results of
+  a near-duplicate without querying the model), or `draft` (as
+  `reuse`, but with a note that the feedback is preliminary)
++ `dedup_threshold` - minimum estimated similarity (default 0.9)
++ `dedup_dir` - directory for the indices (default `~/.cache/chatrunner/dedup`)
++ `dedup_size` - maximum number of answers per question (default 1000)
+
+The index is keyed on the question id and a hash of the question
+text, the criteria, the prompt template and the settings which change
+the prompt (`model`, `prompt_layout`, `lit_topk`, `lit_budget`).
+Dedup is skipped for the repeated queries of the batch processor,
+which have a `cache_salt`.  Reuse is recorded in the graderstate
+under `reuse`.
+"""
+
+import os, json, time, hashlib, threading
+
+K = 5
+PERM = 64
+BANDS = 16
+PRIME = (1 << 61) - 1
+MASK = (1 << 32) - 1
+
+modes = [ "off", "reuse", "draft" ]
+
+def _params():
+    r = []
+    for i in range(PERM):
+        h = hashlib.sha256( f"minhash{i}".encode() ).digest()
+        a = int.from_bytes( h[:8], "big" ) % (PRIME-1) + 1
+        b = int.from_bytes( h[8:16], "big" ) % PRIME
+        r.append( (a,b) )
+    return r
+
+_perm = _params()
+_lock = threading.Lock()
+_indices = {}
+
+def normalise(text):
+    return " ".join( text.lower().split() )
+
+def textHash(text):
+    return hashlib.sha1( normalise(text).encode() ).hexdigest()
+
+def shingles(text,k=K):
+    """Return the set of hashed character k-shingles of the normalised text."""
+    text = normalise(text)
+    if len(text) <= k:
+        text = text.ljust( k )
+    return { int.from_bytes( hashlib.blake2b( text[i:i+k].encode(),
+                                              digest_size=4 ).digest(), "big" )
+             for i in range( len(text) - k + 1 ) }
+
+def signature(text):
+    """Return the MinHash signature of the text as a list of integers."""
+    sh = shingles( text )
+    return [ min( (a*x + b) % PRIME for x in sh ) & MASK for a, b in _perm ]
+
+def similarity(s1,s2):
+    """Return the estimated Jaccard similarity of two signatures."""
+    return sum( x == y for x, y in zip(s1,s2) ) / len(s1)
+
+def bands(sig):
+    r = PERM // BANDS
+    return [ (i,) + tuple( sig[i*r:(i+1)*r] ) for i in range(BANDS) ]
+
+class Index:
+    """
+    The graded answers to one question, stored in the JSON file `fn`.
+    Each entry holds the hash and signature of the answer and the
+    dumped test results.
+    """
+    def __init__(self,fn,threshold=0.9,size=1000):
+        self.fn = fn
+        self.threshold = threshold
+        self.size = size
+        self.lock = threading.Lock()
+        self.load()
+    def load(self):
+        try:
+            with open( self.fn ) as f:
+                self.entries = json.load( f )
+        except (OSError, ValueError):
+            self.entries = []
+        self.mtime = self.stat()
+        self.buckets = {}
+        for i, e in enumerate( self.entries ):
+            for b in bands( e["sig"] ):
+                self.buckets.setdefault( b, [] ).append( i )
+    def stat(self):
+        try:
+            return os.stat( self.fn ).st_mtime_ns
+        except OSError:
+            return None
+    def query(self,text):
+        """
+        Return the most similar entry and its similarity, or None if
+        no entry reaches the threshold.
+        """
+        h = textHash( text )
+        sig = signature( text )
+        with self.lock:
+            if self.stat() != self.mtime:
+                self.load()
+            best, sim = None, 0.0
+            cands = { i for b in bands( sig ) for i in self.buckets.get( b, [] ) }
+            for i in cands:
+                e = self.entries[i]
+                s = 1.0 if e["hash"] == h else similarity( sig, e["sig"] )
+                if s > sim:
+                    best, sim = e, s
+        if best is None or sim < self.threshold:
+            return None
+        return best, sim
+    def add(self,text,frames):
+        """Add a graded answer to the index and save it."""
+        e = { "hash": textHash( text ), "sig": signature( text ),
+              "frames": frames, "time": time.time() }
+        with self.lock:
+            if self.stat() != self.mtime:
+                self.load()
+            self.entries.append( e )
+            if len(self.entries) > self.size:
+                self.entries = self.entries[-self.size:]
+            self.save()
+            self.load()
+    def save(self):
+        os.makedirs( os.path.dirname( self.fn ), exist_ok=True )
+        tmp = f"{self.fn}.{os.getpid()}.{threading.get_ident()}"
+        with open( tmp, "w" ) as f:
+            json.dump( self.entries, f, ensure_ascii=False )
+        os.replace( tmp, self.fn )
+
+def dedupMode(sandbox):
+    mode = sandbox.get( "dedup", "off" )
+    if mode not in modes:
+        raise Exception( f"Unknown dedup mode {mode}." )
+    return mode
+
+def indexKey(sandbox,problem,criteria="",template=""):
+    """Return the hash of what, besides the answer, the feedback depends on."""
+    key = [ normalise(problem), criteria, template,
+            str( sandbox.get( "model", "" ) ),
+            str( sandbox.get( "prompt_layout", "default" ) ),
+            str( sandbox.get( "lit_topk", 0 ) ),
+            str( sandbox.get( "lit_budget", 2000 ) ) ]
+    return hashlib.sha1( "\0".join( key ).encode() ).hexdigest()
+
+def getIndex(sandbox,qid,problem,criteria="",template=""):
+    """
+    Return the index for question `qid` with text `problem`, graded
+    with the given criteria and prompt template.
+    """
+    d = os.path.expanduser( sandbox.get( "dedup_dir", "~/.cache/chatrunner/dedup" ) )
+    fn = os.path.join( d, f"{qid}-{indexKey(sandbox,problem,criteria,template)[:12]}.json" )
+    with _lock:
+        idx = _indices.get( fn )
+        if idx is None:
+            idx = Index( fn, float( sandbox.get( "dedup_threshold", 0.9 ) ),
+                         int( sandbox.get( "dedup_size", 1000 ) ) )
+            _indices[fn] = idx
+    return idx
@@ -1,11 +1,63 @@
 import os
-import toml
 import json
+import threading
+from . import metrics
 
 def getfn(fn):
     dir = os.path.dirname(os.path.abspath(__file__))
     return( os.path.join( dir, fn ) )
 
+def countTokens(text):
+    """
+    Return an estimate of the number of tokens in `text`, which may
+    also be a list of messages.  It assumes four characters per token.
+    """
+    if isinstance( text, list ):
+        return sum( countTokens( m["content"] ) for m in text )
+    return ( len(text) + 3 ) // 4
+
+_resources = {}
+_reslock = threading.Lock()
+
+def getResource(fn,parse=None):
+    """
+    Return the contents of a resource file, parsed by the function
+    `parse` if given.  Relative filenames refer to the package directory.
+    The result is kept for the lifetime of the process and reloaded
+    only if the modification time of the file changes.
+    Parsed objects are shared and must not be modified.
+    """
+    with metrics.phase( "template" ):
+        if not os.path.isabs(fn):
+            fn = getfn(fn)
+        mtime = os.stat(fn).st_mtime_ns
+        key = ( fn, parse )
+        entry = _resources.get( key )
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        with open(fn, 'r') as file:
+            obj = file.read()
+        if parse is not None:
+            obj = parse(obj)
+        with _reslock:
+            _resources[key] = ( mtime, obj )
+        return obj
+
+def makeResponseFormat(text):
+    """
+    Return the `response_format` object for the schema in `text`,
+    together with its JSON serialisation.
+    """
+    obj = { "type": "json_schema", "json_schema": json.loads(text) }
+    return ( obj, json.dumps(obj) )
+
+def getResponseFormat():
+    """
+    Return the `response_format` request fragment as a pair of the
+    object and its pre-serialised JSON string.
+    """
+    return getResource( "schema.json", makeResponseFormat )
+
 
 def readobject(fn):
     """
@@ -14,6 +66,7 @@ def readobject(fn):
     either .json or .toml.
     """
     if fn[-5:] == ".toml":
+        import toml
         print( "Load file", fn )
         r = toml.load(fn)
     elif fn[-5:] == ".json":
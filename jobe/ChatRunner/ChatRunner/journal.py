@@ -0,0 +1,110 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+JSONL journal for batch runs.
+
+Each result from the batch processor is appended to the journal as
+soon as it arrives, as one JSON object per line with a key identifying
+the question, answer, model and repetition.  An interrupted run can be
+resumed by skipping the keys already in the journal, and the TOML output
+is composed from the journal one question at a time.
+"""
+
+import os, json, hashlib, threading
+import toml
+
+def textHash(text):
+    """Return a short hash identifying a question or answer text."""
+    return hashlib.sha1( text.encode() ).hexdigest()[:12]
+
+def makeKey(qno,q,ano,a,model,rep):
+    """
+    Return the journal key for repetition `rep` with the given model
+    of answer `a` (number `ano`) to question `q` (number `qno`).
+    The texts are hashed, so that a changed input file does not match
+    stale results.
+    """
+    return ( qno, textHash(q["question"]), ano, textHash(a["ans"]), model, rep )
+
+class Journal:
+    """
+    A journal file.  Only the keys and file offsets are kept in memory;
+    the results are read back from disk when needed.
+    An existing journal with results is only replaced with `overwrite`.
+    """
+    def __init__(self,fn,resume=False,overwrite=False):
+        self.fn = fn
+        self.index = {}
+        self.lock = threading.Lock()
+        if not resume and not overwrite and os.path.exists(fn) \
+           and os.path.getsize(fn) > 0:
+            raise Exception( f"Journal {fn} holds results; use --resume to continue "
+                             "the run or --overwrite to discard them." )
+        if resume and os.path.exists(fn):
+            self.scan()
+            mode = "a"
+        else:
+            mode = "w"
+        self.file = open( fn, mode + "b" )
+        if mode == "a" and self.file.tell() > 0:
+            # Terminate a partial line written before a crash.
+            with open( fn, "rb" ) as f:
+                f.seek( -1, os.SEEK_END )
+                if f.read(1) != b"\n":
+                    self.file.write( b"\n" )
+    def scan(self):
+        """Index the records in an existing journal file."""
+        with open( self.fn, "rb" ) as f:
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line: break
+                try:
+                    rec = json.loads( line )
+                except ValueError:
+                    continue
+                self.index[ tuple( rec["key"] ) ] = pos
+    def __contains__(self,key):
+        return key in self.index
+    def __len__(self):
+        return len(self.index)
+    def append(self,key,feedback):
+        """Write a result to the journal and flush it to disk."""
+        line = json.dumps( { "key": key, "feedback": feedback },
+                           ensure_ascii=False ).encode() + b"\n"
+        with self.lock:
+            pos = self.file.tell()
+            self.file.write( line )
+            self.file.flush()
+            os.fsync( self.file.fileno() )
+            self.index[ tuple(key) ] = pos
+    def get(self,key):
+        """Return the result for `key` or None."""
+        pos = self.index.get( key )
+        if pos is None: return None
+        with open( self.fn, "rb" ) as f:
+            f.seek( pos )
+            return json.loads( f.readline() )["feedback"]
+    def close(self):
+        self.file.close()
+
+def compose(qalist,journal,models,count,outfile):
+    """
+    Write the TOML output for the batch run, taking the feedback
+    for each answer from the journal.  The feedback list is ordered
+    by repetition and model as in the batch run.  Questions are written
+    one at a time, so that only the feedback for one question is in memory.
+    Missing results are skipped.
+    """
+    with open( outfile, "w" ) as f:
+        top = { k: v for k, v in qalist.items() if k != "questions" }
+        if top:
+            f.write( toml.dumps( top ) )
+        for qno, q in enumerate( qalist["questions"] ):
+            for ano, a in enumerate( q["answers"] ):
+                fb = [ journal.get( makeKey( qno, q, ano, a, m, r ) )
+                       for r in range(count) for m in models ]
+                a["feedback"] = [ x for x in fb if x is not None ]
+            f.write( toml.dumps( { "questions": [ q ] } ) )
+            for a in q["answers"]:
+                del a["feedback"]
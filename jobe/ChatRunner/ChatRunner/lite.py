@@ -0,0 +1,131 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Lightweight HTTP transport using `http.client` from the standard library.
+
+It provides the subset of the `requests` session and response
+interface which is used by the `client` and `query` modules, and
+is selected with `transport = "http"` in the sandbox.  It avoids the
+import cost of `requests`, which dominates the start-up time of
+the sandboxed test program.  Idle connections are kept for reuse
+up to the pool size.  Unlike `requests`, it ignores `HTTPS_PROXY`,
+`NO_PROXY` and `REQUESTS_CA_BUNDLE`, and uses the system CA store,
+so it is only used when selected.
+"""
+
+import json, time, threading, datetime
+import http.client
+from urllib.parse import urlsplit
+
+from . import metrics
+
+TRANSIENT = ( OSError, http.client.HTTPException )
+
+class LiteResponse:
+    """Response with the attributes of a `requests.Response` used by ChatRunner."""
+    def __init__(self,session,conn,resp,url,elapsed):
+        self.session = session
+        self.conn = conn
+        self.raw = resp
+        self.url = url
+        self.status_code = resp.status
+        self.headers = resp.headers
+        self.elapsed = datetime.timedelta( seconds=elapsed )
+        self.body = None
+        self.done = False
+    @property
+    def content(self):
+        if self.body is None:
+            self.body = self.raw.read()
+            self.finish()
+        return self.body
+    @property
+    def text(self):
+        return self.content.decode()
+    def json(self):
+        return json.loads( self.content )
+    def iter_lines(self):
+        while True:
+            line = self.raw.readline()
+            if not line: break
+            yield line.rstrip( b"\r\n" )
+        self.finish()
+    def finish(self):
+        """Return the connection to the session after the body is read."""
+        if self.done: return
+        self.done = True
+        if self.raw.will_close:
+            self.conn.close()
+        else:
+            self.session.release( self.conn )
+    def close(self):
+        if self.done: return
+        self.done = True
+        self.conn.close()
+
+class LiteSession:
+    """Session keeping up to `size` idle connections to one endpoint."""
+    def __init__(self,size=10):
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+    def connection(self,u,timeout,reuse=True):
+        """Return a connection and a flag which is True if it is reused."""
+        if reuse:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop(), True
+        if u.scheme == "https":
+            cls = http.client.HTTPSConnection
+        else:
+            cls = http.client.HTTPConnection
+        return cls( u.hostname, u.port, timeout=timeout ), False
+    def release(self,conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append( conn )
+                return
+        conn.close()
+    def post(self,url,data=None,headers=None,stream=False,timeout=None):
+        """
+        Make a POST request.  The body of the response is read before
+        returning unless `stream` is true.
+        """
+        u = urlsplit( url )
+        path = u.path or "/"
+        if u.query:
+            path += "?" + u.query
+        if isinstance( timeout, tuple ):
+            connect, read = timeout
+        else:
+            connect = read = timeout
+        reuse = True
+        while True:
+            conn, reused = self.connection( u, connect, reuse )
+            t0 = time.perf_counter()
+            try:
+                if conn.sock is None:
+                    with metrics.phase( "connect" ):
+                        conn.connect()
+                conn.sock.settimeout( read )
+                conn.request( "POST", path, body=data, headers=headers or {} )
+                resp = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                # The server may have closed an idle connection.
+                conn.close()
+                if not reused: raise
+                reuse = False
+            except BaseException:
+                conn.close()
+                raise
+        r = LiteResponse( self, conn, resp, url, time.perf_counter() - t0 )
+        if not stream:
+            r.content
+        return r
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
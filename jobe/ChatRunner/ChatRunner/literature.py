@@ -0,0 +1,193 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Relevance-ranked selection of literature for the prompt.
+
+The literature is split into passages, either the sections of a
+JSON object (such as `literature.json`) or paragraph groups of
+a plain text (such as `exphil-lit.txt`), and a BM25 index is built
+over the passages.  The index is built once per literature text,
+kept in memory, and cached on disk.
+
+Selection is enabled by the following keys in the sandbox dict:
+
++ `lit_topk` - the maximum number of passages to include
++ `lit_budget` - the maximum number of tokens of literature (default 2000)
++ `lit_cachedir` - directory for cached indices
+  (default `~/.cache/chatrunner/literature`)
+"""
+
+import os, re, json, math, hashlib, threading
+from collections import Counter
+from .helper import countTokens
+
+_indices = {}
+_lock = threading.Lock()
+
+def tokenize(text):
+    return re.findall( r"\w+", text.lower() )
+
+def splitText(text,chunk=200):
+    """
+    Split plain text into passages of consecutive paragraphs, with
+    at most `chunk` words each unless a single paragraph is longer.
+    """
+    r = []
+    cur = []
+    n = 0
+    for par in re.split( r"\n\s*\n", text ):
+        par = par.strip()
+        if not par: continue
+        w = len( par.split() )
+        if cur and n + w > chunk:
+            r.append( "\n\n".join( cur ) )
+            cur, n = [], 0
+        cur.append( par )
+        n += w
+    if cur:
+        r.append( "\n\n".join( cur ) )
+    return r
+
+def splitObject(obj,path=()):
+    """
+    Split a literature object into passages.  Returns a list of
+    (path,object) pairs, where each object is a dict without
+    nested dicts, or a leaf value.
+    """
+    if not isinstance( obj, dict ):
+        return [ ( path, obj ) ]
+    if not any( isinstance( v, dict ) for v in obj.values() ):
+        return [ ( path, obj ) ]
+    r = []
+    for k, v in obj.items():
+        r.extend( splitObject( v, path + (k,) ) )
+    return r
+
+class LiteratureIndex:
+    """
+    BM25 index over the passages of a literature text.
+    The `passages` list holds (path,text) pairs, where path is
+    None for plain text.
+    """
+    k1 = 1.5
+    b = 0.75
+    def __init__(self,passages):
+        self.passages = passages
+        self.tf = [ Counter( tokenize( t ) ) for _, t in passages ]
+        self.length = [ sum( c.values() ) for c in self.tf ]
+        df = Counter()
+        for c in self.tf:
+            df.update( c.keys() )
+        self.df = dict( df )
+    @classmethod
+    def fromLiterature(cls,literatur):
+        """Build the index for a literature object or string."""
+        if isinstance( literatur, str ):
+            try:
+                literatur = json.loads( literatur )
+            except ValueError:
+                pass
+        if isinstance( literatur, str ):
+            passages = [ ( None, t ) for t in splitText( literatur ) ]
+        else:
+            passages = [ ( "/".join( p ), json.dumps( o, ensure_ascii=False ) )
+                         for p, o in splitObject( literatur ) ]
+        return cls( passages )
+    def asdict(self):
+        return { "passages": self.passages,
+                 "tf": [ dict(c) for c in self.tf ],
+                 "df": self.df }
+    @classmethod
+    def fromdict(cls,obj):
+        self = cls.__new__(cls)
+        self.passages = [ tuple(p) for p in obj["passages"] ]
+        self.tf = [ Counter(c) for c in obj["tf"] ]
+        self.length = [ sum( c.values() ) for c in self.tf ]
+        self.df = obj["df"]
+        return self
+    def scores(self,query):
+        """Return the BM25 score of each passage for the query text."""
+        n = len( self.passages )
+        if n == 0: return []
+        avg = sum( self.length ) / n or 1
+        terms = set( tokenize( query ) )
+        r = []
+        for tf, length in zip( self.tf, self.length ):
+            s = 0.0
+            for t in terms:
+                f = tf.get( t )
+                if not f: continue
+                df = self.df[t]
+                idf = math.log( 1 + (n - df + 0.5)/(df + 0.5) )
+                s += idf * f*(self.k1+1) / ( f + self.k1*(1 - self.b + self.b*length/avg) )
+            r.append( s )
+        return r
+    def select(self,query,k=5,budget=2000):
+        """
+        Return the indices of the best passages for the query,
+        at most `k` and within `budget` tokens, in document order.
+        """
+        scores = self.scores( query )
+        ranked = sorted( range(len(scores)), key=lambda i: -scores[i] )
+        r = []
+        used = 0
+        for i in ranked[:k]:
+            n = countTokens( self.passages[i][1] )
+            if used + n > budget: continue
+            r.append( i )
+            used += n
+        return sorted( r )
+    def render(self,selected):
+        """Return the selected passages as text for the prompt."""
+        ps = [ self.passages[i] for i in selected ]
+        if ps and ps[0][0] is not None:
+            obj = { p: json.loads(t) for p, t in ps }
+            return json.dumps( obj, ensure_ascii=False, indent=1 )
+        return "\n\n".join( t for _, t in ps )
+
+def literatureKey(literatur):
+    if not isinstance( literatur, str ):
+        literatur = json.dumps( literatur, sort_keys=True, ensure_ascii=False )
+    return hashlib.sha256( literatur.encode() ).hexdigest()
+
+def getIndex(literatur,sandbox={}):
+    """
+    Return the index for the literature, from memory or the disk
+    cache if possible.
+    """
+    key = literatureKey( literatur )
+    idx = _indices.get( key )
+    if idx is not None:
+        return idx
+    cachedir = os.path.expanduser( sandbox.get( "lit_cachedir",
+                                   "~/.cache/chatrunner/literature" ) )
+    fn = os.path.join( cachedir, key + ".json" )
+    try:
+        with open( fn, "r" ) as f:
+            idx = LiteratureIndex.fromdict( json.load( f ) )
+    except (OSError, ValueError, KeyError):
+        idx = LiteratureIndex.fromLiterature( literatur )
+        try:
+            os.makedirs( cachedir, exist_ok=True )
+            tmp = f"{fn}.{os.getpid()}"
+            with open( tmp, "w" ) as f:
+                json.dump( idx.asdict(), f, ensure_ascii=False )
+            os.replace( tmp, fn )
+        except OSError:
+            pass
+    with _lock:
+        _indices[key] = idx
+    return idx
+
+def selectLiterature(literatur,query,sandbox={}):
+    """
+    Return the literature to include in the prompt for the given
+    query text.  The literature is returned unchanged unless `lit_topk`
+    is set in sandbox.
+    """
+    k = int( sandbox.get( "lit_topk", 0 ) )
+    if k <= 0 or not literatur:
+        return literatur
+    idx = getIndex( literatur, sandbox )
+    budget = int( sandbox.get( "lit_budget", 2000 ) )
+    return idx.render( idx.select( query, k, budget ) )
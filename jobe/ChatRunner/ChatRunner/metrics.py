@@ -0,0 +1,226 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Latency and token instrumentation.
+
+A metrics record is opened for each grading call with `record()`,
+and phases within the call are timed with `phase()`.  Phases may be
+nested, e.g. `prompt` includes `template`.  The phases currently
+recorded are
+
++ `template` - loading templates and schema
++ `prompt` - building the prompt
++ `connect` - establishing a new connection (TCP and TLS)
++ `ttfb` - time from sending the request until the response headers
++ `http` - the complete HTTP request, including the body unless streamed,
+  and any retries
++ `backoff` - waiting between retries
++ `stream` - a streamed request, until the last chunk is read
++ `extract` - extracting the message content from the response
++ `dumpresponse` - parsing the tests from the message content
++ `sandbox` - running the test program in the sandbox
++ `finalise` - `TestResults.finalise()`
++ `render` - formatting the output
++ `total` - the complete call
+
+The token counts reported by the server (`usage` from OpenAI,
+`prompt_eval_count` and `eval_count` from Ollama) are recorded
+as `prompt_tokens` and `completion_tokens`.  The number of prompt
+tokens served from the prompt cache of the server is recorded as
+`cached_tokens`, when it is reported (`prompt_tokens_details` from
+OpenAI and vLLM, `timings.cache_n` from llama.cpp).
+
+Finished records are kept in memory for `summary()` (up to a limit,
+dropping the oldest) and written to
+the JSONL file given by the `metrics` key in the sandbox.  The
+aggregated data are written to a Prometheus textfile by `writeProm()`
+at the end of a batch run, or every `metrics_prom_interval` seconds
+by `startProm()` in the daemon (`metrics_prom` in its config).
+A CodeRunner attempt is a short-lived process, and writes no textfile.
+"""
+
+import os, json, math, time, threading, contextlib
+from collections import deque
+
+_local = threading.local()
+_lock = threading.Lock()
+records = deque( maxlen=100000 )
+
+def current():
+    """Return the active record of this thread or None."""
+    return getattr( _local, "record", None )
+
+def newRecord(**labels):
+    """
+    Return a new, empty record.  It is only stored if it is used
+    through `record()`, so it can be attached with `attach()` to
+    suppress recording.
+    """
+    return { "time": time.time(), "labels": labels,
+             "phases": {}, "usage": {} }
+
+@contextlib.contextmanager
+def record(sandbox={},**labels):
+    """
+    Context manager for a metrics record.  If a record is already
+    active in the thread, it is reused and only the labels are added.
+    """
+    rec = current()
+    if rec is not None:
+        rec["labels"].update( labels )
+        yield rec
+        return
+    rec = newRecord( **labels )
+    _local.record = rec
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        rec["phases"]["total"] = time.perf_counter() - t0
+        _local.record = None
+        finish( rec, sandbox )
+
+@contextlib.contextmanager
+def attach(rec):
+    """
+    Context manager making `rec` the active record of this thread,
+    for work done on behalf of a call in another thread.
+    """
+    old = current()
+    _local.record = rec
+    try:
+        yield rec
+    finally:
+        _local.record = old
+
+@contextlib.contextmanager
+def phase(name):
+    """Context manager timing a phase of the active record."""
+    rec = current()
+    if rec is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        add( name, time.perf_counter() - t0 )
+
+def add(name,seconds):
+    """Add time to a phase of the active record."""
+    rec = current()
+    if rec is None: return
+    rec["phases"][name] = rec["phases"].get( name, 0.0 ) + seconds
+
+def label(**labels):
+    """Add labels to the active record."""
+    rec = current()
+    if rec is not None:
+        rec["labels"].update( labels )
+
+def setUsage(obj):
+    """
+    Record the token usage from a response object (or stream chunk)
+    from OpenAI or Ollama.
+    """
+    rec = current()
+    if rec is None or not isinstance( obj, dict ): return
+    usage = obj.get( "usage" )
+    if usage:
+        rec["usage"]["prompt_tokens"] = usage.get( "prompt_tokens" )
+        rec["usage"]["completion_tokens"] = usage.get( "completion_tokens" )
+        details = usage.get( "prompt_tokens_details" ) or {}
+        if details.get( "cached_tokens" ) is not None:
+            rec["usage"]["cached_tokens"] = details["cached_tokens"]
+    elif "prompt_eval_count" in obj or "eval_count" in obj:
+        rec["usage"]["prompt_tokens"] = obj.get( "prompt_eval_count" )
+        rec["usage"]["completion_tokens"] = obj.get( "eval_count" )
+    timings = obj.get( "timings" )
+    if isinstance( timings, dict ) and timings.get( "cache_n" ) is not None:
+        rec["usage"]["cached_tokens"] = timings["cache_n"]
+
+def finish(rec,sandbox={}):
+    """Store a finished record and write it to the configured sinks."""
+    with _lock:
+        records.append( rec )
+        fn = sandbox.get( "metrics" )
+        if fn:
+            with open( fn, "a" ) as f:
+                f.write( json.dumps( rec ) + "\n" )
+
+def percentile(xs,p):
+    """Return the p-th percentile of xs, by the nearest rank method."""
+    xs = sorted( xs )
+    if not xs: return None
+    k = max( 0, min( len(xs)-1, math.ceil( p/100*len(xs) ) - 1 ) )
+    return xs[k]
+
+def aggregate():
+    """
+    Return a dict mapping (model,phase) to the list of observed
+    durations, and a dict mapping model to summed token counts.
+    """
+    times = {}
+    tokens = {}
+    with _lock:
+        recs = list( records )
+    for rec in recs:
+        m = rec["labels"].get( "model", "" )
+        for ph, t in rec["phases"].items():
+            times.setdefault( (m,ph), [] ).append( t )
+        tk = tokens.setdefault( m, { "prompt_tokens": 0, "completion_tokens": 0,
+                                     "cached_tokens": 0 } )
+        for k in tk:
+            tk[k] += rec["usage"].get( k ) or 0
+    return times, tokens
+
+def summary():
+    """Return a Markdown table of latency percentiles per model and phase."""
+    times, tokens = aggregate()
+    lines = [ "| model | phase | n | p50 | p95 | p99 |",
+              "| :- | :- | -: | -: | -: | -: |" ]
+    for (m,ph), xs in sorted( times.items() ):
+        ps = [ f"{percentile(xs,p):.3f}" for p in (50,95,99) ]
+        lines.append( f"| {m} | {ph} | {len(xs)} | " + " | ".join(ps) + " |" )
+    lines.append( "" )
+    for m, tk in sorted( tokens.items() ):
+        lines.append( f"+ Tokens {m}: prompt {tk['prompt_tokens']}, "
+                      + f"completion {tk['completion_tokens']}, "
+                      + f"cached {tk['cached_tokens']}" )
+    return "\n".join( lines )
+
+def writeProm(fn):
+    """Write the aggregated metrics as a Prometheus textfile."""
+    times, tokens = aggregate()
+    lines = [ "# TYPE chatrunner_phase_seconds summary" ]
+    for (m,ph), xs in sorted( times.items() ):
+        l = f'model="{m}",phase="{ph}"'
+        for q in (50,95,99):
+            lines.append( f'chatrunner_phase_seconds{{{l},quantile="{q/100}"}} '
+                          + f"{percentile(xs,q)}" )
+        lines.append( f"chatrunner_phase_seconds_sum{{{l}}} {sum(xs)}" )
+        lines.append( f"chatrunner_phase_seconds_count{{{l}}} {len(xs)}" )
+    lines.append( "# TYPE chatrunner_tokens_total counter" )
+    for m, tk in sorted( tokens.items() ):
+        for k, v in tk.items():
+            lines.append( f'chatrunner_tokens_total{{model="{m}",kind="{k}"}} {v}' )
+    tmp = f"{fn}.{os.getpid()}.{threading.get_ident()}"
+    with open( tmp, "w" ) as f:
+        f.write( "\n".join( lines ) + "\n" )
+    os.replace( tmp, fn )
+
+def startProm(fn,interval=60.0):
+    """
+    Rewrite the Prometheus textfile every `interval` seconds in a
+    background thread, for a long-lived process.
+    """
+    def loop():
+        while True:
+            time.sleep( interval )
+            try:
+                writeProm( fn )
+            except OSError as e:
+                print( f"Writing {fn} failed: {e}" )
+    t = threading.Thread( target=loop, daemon=True )
+    t.start()
+    return t
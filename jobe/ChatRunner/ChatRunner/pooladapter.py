@@ -0,0 +1,38 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Transport adapter for `requests` recording the connection time.
+
+This is kept apart from the `client` module, so that `requests`
+and `urllib3` are only imported when the `requests` transport is used.
+"""
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with metrics.phase( "connect" ):
+            super().connect()
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with metrics.phase( "connect" ):
+            super().connect()
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class PoolAdapter(HTTPAdapter):
+    """
+    Transport adapter using connection classes which record the time
+    to establish new connections in the metrics.
+    """
+    def init_poolmanager(self,*a,**kw):
+        super().init_poolmanager(*a,**kw)
+        self.poolmanager.pool_classes_by_scheme = {
+                "http": TimedHTTPConnectionPool,
+                "https": TimedHTTPSConnectionPool }
@@ -17,12 +17,19 @@ if __name__ == "__main__":
         epilog = '')
     parser.add_argument('file',help="Feedback file")
     parser.add_argument('outfile',help="Output file")
+    parser.add_argument('--run',type=int,
+                        help="Run to print from an SQLite store (default: latest).")
+    parser.add_argument('--model',help="Print feedback from this model only.")
     args = parser.parse_args()
 
     if args.file is None:
         raise Exception( "No file given" )
-    with open( args.file, "rb" ) as f:
-        feedback = tomllib.load( f )
+    if args.file.endswith( ( ".sqlite", ".db" ) ):
+        from . import store
+        feedback = store.qalist( args.file, run=args.run, model=args.model )
+    else:
+        with open( args.file, "rb" ) as f:
+            feedback = tomllib.load( f )
 
     # feedback = toml.load( args.file )
 
@@ -49,10 +56,11 @@ if __name__ == "__main__":
                         result.append( f"+ **Ubrukte felt:** {ks}" )
             result.append( "" )
             for fno, fb in enumerate( a["feedback"] ):
+                if args.model and fb.get( "model" ) != args.model: continue
                 result.append( f"#### Feedback no. {qno+1}-{ano+1}-{fno+1}" )
                 result.append( "" )
-                result.append( f"+ **fraction:** {fb["fraction"]:.2f}" )
-                result.append( f"+ **model:** {fb["model"]}" )
+                result.append( f"+ **fraction:** {fb['fraction']:.2f}" )
+                result.append( f"+ **model:** {fb['model']}" )
                 if fb.get( "otherfeedback", None):
                     result.append( f"+ other feedback exists" )
                 ks = set( fb.keys() ) - fbKeys
@@ -60,20 +68,20 @@ if __name__ == "__main__":
                         result.append( f"+ **Ubrukte felt:** {ks}" )
                 result.append( "" )
                 for tno, tst in enumerate( fb["testfeedback"] ):
-                    result.append( f"##### Test {tno+1}: {tst["name"]}" )
+                    result.append( f"##### Test {tno+1}: {tst['name']}" )
                     result.append( "" )
                     if "description" in tst:
-                        result.append( f"+ **description:** {tst["description"]}" )
+                        result.append( f"+ **description:** {tst['description']}" )
                     if "passed" in tst:
-                        result.append( f"+ **passed:** {tst["passed"]}" )
+                        result.append( f"+ **passed:** {tst['passed']}" )
                     if "mark" in tst:
-                        result.append( f"+ **mark:** {tst["mark"]}" )
+                        result.append( f"+ **mark:** {tst['mark']}" )
                     ks = set( tst.keys() ) - testKeys
                     if len(ks)>0:
                         result.append( f"+ **Ubrukte felt:** {ks}" )
                     if "resultat" in tst:
                         result.append( "" )
-                        result.append( f"> {tst["resultat"]}" )
+                        result.append( f"> {tst['resultat']}" )
                     result.append( "" )
 
     with open(args.outfile, "w") as f:
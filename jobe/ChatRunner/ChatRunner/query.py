@@ -8,10 +8,11 @@ by the LLM, as well as the query routine `queryAI()`.  Other definitions
 should be considered internal.
 """
 
-import requests, re, json
-from .helper import getfn
+import re, json, time
+from .helper import getResponseFormat
+from . import client, cache, metrics, batchapi
 
-def queryAI(sandbox, prompt, ans=None, debug=False ):
+def queryAI(sandbox, prompt, ans=None, debug=False, deadline=None ):
    """
    Query the languagemodel.  It returns a list of `Test` objects.
 
@@ -21,8 +22,24 @@ def queryAI(sandbox, prompt, ans=None, debug=False ):
 
    Otherwise, `prompt` should be a template text for the system prompt
    and `ans` should be just the last student answer.
+
+   The request gives up at the `deadline` (as given by `time.time()`).
+   If `stream` is set in the sandbox, the response is streamed and
+   tests are parsed as they arrive.  Reading stops at the `deadline`,
+   or `stream_timeout` seconds from now if set in the sandbox, and
+   the tests received so far are returned.
+
+   If the JSON in the response cannot be found or repaired (see
+   `parseTests()`), the request is repeated up to `requery` times
+   (default 0) as given in the sandbox.
+
+   If a `batchapi.Collector` is active, the response is taken from
+   the batch output, or, while collecting, the request is recorded
+   and `batchapi.Collected` is raised.
    """
 
+   if sandbox is None:
+       sandbox = {}
    if ans is None:
        if not isinstance( prompt, list ):
           raise Exception( "Prompt should be a list of LLM messages." )
@@ -32,22 +49,208 @@ def queryAI(sandbox, prompt, ans=None, debug=False ):
        if not isinstance( prompt, str ):
            raise Exception( "Prompt should be string." )
 
-   response = chatRequest(sandbox, prompt, ans, debug=debug )
+   data = requestData(sandbox, prompt, ans)
+   readcache, writecache = cache.cacheMode(sandbox)
+   collector = batchapi.current()
+   if readcache or writecache or collector is not None:
+       key = cache.makeKey( requestURL(sandbox), data, getResponseFormat()[1],
+                            sandbox.get( "cache_salt" ) )
+   svar = None
+   if readcache:
+       svar = cache.getCache(sandbox).get(key)
+       cache.count( "misses" if svar is None else "hits" )
+       metrics.label( cache="miss" if svar is None else "hit" )
+   cached = svar is not None
+   if svar is None and collector is not None:
+       body = collector.lookup(key)
+       if body is not None:
+           svar = extractAnswer(body, sandbox, debug=debug)
+           metrics.label( batch=True )
+       elif collector.collecting:
+           collector.add(key, data)
+           raise batchapi.Collected(key)
+
+   if svar is None and data["stream"]:
+       if deadline is None and "stream_timeout" in sandbox:
+           deadline = time.time() + float( sandbox["stream_timeout"] )
+       svar, tests, complete = streamAI(sandbox, data, deadline, debug=debug)
+       if debug:
+           print( "queryAI() svar:", type(svar) )
+           print( svar )
+       if complete and not tests:
+           with metrics.phase( "dumpresponse" ):
+               tests = dumpResponse( svar )
+       if complete and writecache and not isMalformed( tests ):
+           cache.getCache(sandbox).put(key, svar, model=data["model"])
+           cache.count( "writes" )
+       r = [ dumpSvardata( svar ) ]
+       r.extend( tests )
+       if not complete:
+           r.append( dumpPartial( len(tests) ) )
+       return r
+
+   fetch = lambda: fetchAnswer(sandbox, prompt, ans, data, deadline, debug)
+   if svar is None:
+       svar = fetch()
+   elif debug:
+       print( "queryAI() using cached response" )
+   if debug:
+       print( "queryAI() svar:", type(svar) )
+       print( svar )
+
+   with metrics.phase( "dumpresponse" ):
+       tests = dumpResponse( svar )
+
+   # Re-query only if the response could not be repaired.
+   requery = int( sandbox.get( "requery", 0 ) )
+   n = 0
+   while isMalformed( tests ) and n < requery and collector is None:
+       if deadline is not None and time.time() >= deadline: break
+       n += 1
+       print( f"queryAI() malformed response, re-query {n}/{requery}" )
+       metrics.label( requery=n )
+       svar = fetch()
+       with metrics.phase( "dumpresponse" ):
+           tests = dumpResponse( svar )
+
+   # A malformed response is not cached, lest it be replayed.
+   if writecache and not cached and not isMalformed( tests ):
+       cache.getCache(sandbox).put(key, svar, model=data["model"])
+       cache.count( "writes" )
+
+   r = [ dumpSvardata( svar ) ]
+   r.extend( tests )
+   return r
+
+def fetchAnswer(sandbox, prompt, ans, data, deadline=None, debug=False):
+   """Send the request `data` to the LLM and return the answer text."""
+   response = chatRequest(sandbox, prompt, ans, debug=debug, data=data,
+                          deadline=deadline )
+   checkStatus( response )
+   with metrics.phase( "extract" ):
+       return extractAnswer(response, sandbox, debug=debug)
 
+def checkStatus(response):
+   """Raise an exception if the HTTP response is not OK."""
    status = response.status_code 
    if status != 200:
        print( response )
        print( response.content )
        raise Exception( f"HTTP requests returns {status}." )
 
-   svar = extractAnswer(response, sandbox, debug=debug)
-   if debug:
-       print( "queryAI() svar:", type(svar) )
-       print( svar )
-
-   r = [ dumpSvardata( svar ) ]
-   r.extend( dumpResponse( svar ) )
-   return r
+def streamAI(sandbox, data, deadline=None, debug=False):
+   """
+   Make a streaming request to the LLM and parse tests as they arrive.
+   Returns a tuple (svar,tests,complete) of the content received,
+   the list of `Test` objects, and a flag which is False if the deadline
+   was reached before the response was complete.
+   """
+   t0 = time.perf_counter()
+   response = chatRequest(sandbox, None, debug=debug, data=data, stream=True,
+                          deadline=deadline )
+   try:
+       checkStatus( response )
+       parts = []
+       tests = []
+       scanner = ArrayScanner()
+       try:
+           for chunk in streamContent( response, sandbox ):
+               parts.append( chunk )
+               for obj in scanner.feed( chunk ):
+                   if isinstance( obj, dict ):
+                       tests.append( makeTest( obj ) )
+               if deadline is not None and time.time() >= deadline:
+                   if debug:
+                       print( f"streamAI() deadline reached after {len(tests)} tests" )
+                   return ( "".join( parts ), tests, False )
+       except client.transientErrors(sandbox) as e:
+           # A stalled stream times out at the deadline; keep what we have.
+           if deadline is None or time.time() < deadline: raise
+           print( f"streamAI() {type(e).__name__} at the deadline after {len(tests)} tests" )
+           return ( "".join( parts ), tests, False )
+       return ( "".join( parts ), tests, True )
+   finally:
+       response.close()
+       metrics.add( "stream", time.perf_counter() - t0 )
+
+def streamContent(response,sandbox={}):
+   """
+   Generate the message content from a streamed response, chunk by chunk.
+   OpenAI uses server sent events (`data:` lines), while Ollama sends
+   one JSON object per line.
+   """
+   api = sandbox.get( "API", "ollama" ).lower()
+   for line in response.iter_lines():
+       if not line: continue
+       line = line.decode()
+       if api in [ "openai", "openapi" ]:
+           if not line.startswith( "data:" ): continue
+           line = line[5:].strip()
+           if line == "[DONE]": return
+           obj = json.loads( line )
+           metrics.setUsage( obj )
+           if not obj.get( "choices" ): continue
+           content = obj["choices"][0].get( "delta", {} ).get( "content" )
+       else:
+           obj = json.loads( line )
+           content = obj.get( "message", {} ).get( "content" )
+           metrics.setUsage( obj )
+           if obj.get( "done" ):
+               if content: yield content
+               return
+       if content:
+           yield content
+
+class ArrayScanner:
+   """
+   Incremental parser for a JSON list arriving in chunks.
+   Text before the first `[` is skipped, and each element of the
+   list is parsed as soon as it is complete.
+   """
+   def __init__(self):
+      self.buffer = ""
+      self.pos = 0
+      self.depth = 0
+      self.instring = False
+      self.escape = False
+      self.start = None
+      self.closed = False
+
+   def feed(self, text):
+      """Add text and return the list of elements completed by it."""
+      r = []
+      self.buffer += text
+      buf = self.buffer
+      while self.pos < len(buf) and not self.closed:
+         c = buf[self.pos]
+         if self.instring:
+            if self.escape:
+               self.escape = False
+            elif c == "\\":
+               self.escape = True
+            elif c == '"':
+               self.instring = False
+         elif c == '"':
+            self.instring = self.depth > 0
+         elif c == "[" or ( c == "{" and self.depth > 0 ):
+            self.depth += 1
+            if self.depth == 2:
+               self.start = self.pos
+         elif c in "]}" and self.depth > 0:
+            self.depth -= 1
+            if self.depth == 1 and self.start is not None:
+               r.append( self.element( buf[self.start:self.pos+1] ) )
+               self.start = None
+            elif self.depth == 0:
+               self.closed = True
+         self.pos += 1
+      return [ x for x in r if x is not None ]
+
+   def element(self, text):
+      try:
+         return json.loads( text, strict=False )
+      except json.JSONDecodeError:
+         return None
 
 class Test:
    """
@@ -57,46 +260,98 @@ class Test:
 
    A `Test` may also contain the raw response from the LLM, in which
    case it has name «gpt_svar».
+
+   The common fields are kept in slots, with None for fields which
+   are not set (except `passed`), and other keys in `extra`.
+   The `result` property gives all the fields as a dict.
    """
+   __slots__ = ( "name", "passed", "mark", "description", "resultat",
+                 "type", "extra" )
+   fields = __slots__[:-1]
+   name: str
+   passed: bool
+   mark: int
+   description: str
+   resultat: str
+   type: str
+   extra: dict
+
    def __init__(self, testName=None, content=None):
-      self.result = {"name": testName, "passed": False}
+      self.clear( testName )
       if content:
           self.load( content )
 
+   def clear(self, testName=None):
+      self.name = testName
+      self.passed = False
+      self.mark = None
+      self.description = None
+      self.resultat = None
+      self.type = None
+      self.extra = None
+
    def addResult(self, field_name, field_data):
       """
       Add resultdata. Data has a key (field_name) and value (field_data)
       """
-      self.result.update({field_name: field_data})
+      if field_name in Test.fields:
+         setattr( self, field_name, field_data )
+      elif self.extra is None:
+         self.extra = { field_name: field_data }
+      else:
+         self.extra[field_name] = field_data
 
    def addResults(self, res_dict):
       for k, v in res_dict.items():
          self.addResult(k,v)
 
    def pass_test(self, passed):
-      self.result["passed"] = passed
+      self.passed = passed
    def testType(self):
-       return self.result.get("type","test")
+       return self.type or "test"
 
    def asdict(self):
-      return self.result
+      r = { "name": self.name, "passed": self.passed }
+      for k in Test.fields[2:]:
+         v = getattr( self, k )
+         if v is not None:
+            r[k] = v
+      if self.extra:
+         r.update( self.extra )
+      return r
+   @property
+   def result(self):
+      return self.asdict()
+   @result.setter
+   def result(self, obj):
+      self.clear( obj.get( "name" ) )
+      self.addResults( { k: v for k, v in obj.items() if k != "name" } )
+   def get(self, key, default=None):
+      """Return a field or extra key, like `dict.get()` on `result`."""
+      if key in Test.fields:
+         v = getattr( self, key )
+         return default if v is None else v
+      if self.extra is None:
+         return default
+      return self.extra.get( key, default )
    def __str__(self):
-      return json.dumps(self.result, indent=4)
+      return json.dumps(self.asdict(), indent=4)
 
    def __repr__(self):
-      return json.dumps({"Testobject": self.result}, indent=4)
+      return self.dump()
 
    def load(self, str_repr):
       try:
          obj = json.loads(str_repr)
          self.result = obj["Testobject"]
-      except:
-         self.result = {
-                 "name" : "nontest",
-                 "type" : "nontest",
-                 "content" : str_repr
-                 }
-      print( self )
+      except (ValueError, KeyError, TypeError, AttributeError):
+         self.setNontest( str_repr )
+
+   def setNontest(self, text):
+      """Make this a container for output which is not a test."""
+      self.clear( "nontest" )
+      self.type = "nontest"
+      self.extra = { "content" : text }
 
    def isTest(self):
        """
@@ -105,28 +360,28 @@ class Test:
        """
        return self.testType() == "test"
    def dump(self):
-      return self.__repr__()
+      """
+      Return the test as a single line of JSON, as used in the
+      protocol with the test program (see `testrunner`).
+      """
+      return json.dumps({"Testobject": self.asdict()}, ensure_ascii=False)
    def formatMarkdown(self):
       """Return a string presenting the test result in Markdown."""
-      result = self.result
-      feedback = False
-      if result["passed"]:
-          header = f'## Passed: {result["name"]}\n'
-      elif "resultat" in result.keys():
-          header = f'## Failed: {result["name"]}\n'
+      if self.passed:
+          header = f'## Passed: {self.name}\n'
+      elif self.resultat is not None:
+          header = f'## Failed: {self.name}\n'
       else: return None
-      return ( header + f'\n{result["resultat"]}\n' )
+      return ( header + f'\n{self.resultat}\n' )
    def formatResult(self):
       """Return a string presenting the test result in HTML."""
-      result = self.result
-      feedback = False
-      if result["passed"]:
+      if self.passed:
             color = "Lime"
-      elif "resultat" in result.keys():
+      elif self.resultat is not None:
             color = "Red"
       else: return None
-      return ( f'<h2 style="background-color:{color};">{result["name"]}</h2>'
-           + f'\n<p>{result["resultat"]} </p>' )
+      return ( f'<h2 style="background-color:{color};">{self.name}</h2>'
+           + f'\n<p>{self.resultat} </p>' )
 
 
 def dumpSvardata(svar):
@@ -153,38 +408,158 @@ def makeTest(test) -> Test:
             ob.addResult(k,v)
     return ob
 
+def dumpPartial(n):
+    """
+    Create a Test object recording that the response was cut off
+    at the deadline after `n` tests.
+    """
+    ob = Test(testName="Partial response")
+    ob.addResult( "description", f"Svaret ble avbrutt etter {n} tester." )
+    ob.addResult( "type", "partial" )
+    return ob
+
+_decoder = json.JSONDecoder( strict=False )
+_start = re.compile( r"[\[{]" )
+_object = re.compile( r'\[\s*\{|\{\s*"' )
+
+def testList(obj,single=False):
+    """
+    Return the list of tests in a decoded JSON value, unwrapping an
+    object holding the list (e.g. `{"tests": [...]}`), or a single
+    test if `single` is True, or None if the value is not a list of tests.
+    """
+    if isinstance( obj, list ):
+        return obj if all( isinstance( x, dict ) for x in obj ) else None
+    if not isinstance( obj, dict ):
+        return None
+    if single and ( "testName" in obj or "iscorrect" in obj ):
+        return [ obj ]
+    for v in obj.values():
+        if isinstance( v, list ) and v and all( isinstance( x, dict ) for x in v ):
+            return v
+    return None
+
+def scanJSON(text,single=False):
+    """
+    Return the first list of tests in `text`, found by decoding a JSON
+    value at each `[` or `{` in turn, or None.  Text around the value,
+    such as prose or code fences, is ignored.
+    """
+    pos = 0
+    while True:
+        m = _start.search( text, pos )
+        if m is None: return None
+        try:
+            obj, end = _decoder.raw_decode( text, m.start() )
+        except json.JSONDecodeError:
+            pos = m.start() + 1
+            continue
+        r = testList( obj, single )
+        if r is not None: return r
+        pos = end if end > m.start() + 1 else m.start() + 1
+
+def repairJSON(text):
+    """
+    Repair common faults in JSON from small models, in a single pass
+    from the first list of objects or object (else the first bracket): trailing commas, Python literals
+    (`True`, `False`, `None`), and truncation, where the incomplete
+    last element is dropped and the open brackets are closed.
+    Newlines in strings are accepted by the non-strict decoder.
+    Returns the repaired text, or None if there is no JSON.
+    """
+    m = _object.search( text ) or _start.search( text )
+    if m is None: return None
+    out = []
+    stack = []
+    complete = None
+    instring = escape = False
+    i = m.start()
+    literals = { "True": "true", "False": "false", "None": "null" }
+    while i < len(text):
+        c = text[i]
+        if instring:
+            out.append( c )
+            if escape: escape = False
+            elif c == "\\": escape = True
+            elif c == '"': instring = False
+        elif c == '"':
+            out.append( c )
+            instring = True
+        elif c in "[{":
+            stack.append( "]" if c == "[" else "}" )
+            out.append( c )
+        elif c in "]}":
+            while out and out[-1] in " \t\r\n,":
+                out.pop()
+            if not stack: break
+            out.append( stack.pop() )
+            if not stack: break
+            complete = ( len(out), list(stack) )
+        elif c.isalpha():
+            j = i
+            while j < len(text) and text[j].isalpha(): j += 1
+            out.append( literals.get( text[i:j], text[i:j] ) )
+            i = j
+            continue
+        else:
+            out.append( c )
+        i += 1
+    if stack:
+        # Truncated: keep the complete elements and close the brackets.
+        if complete is None: return None
+        n, stack = complete
+        out = out[:n]
+        while out and out[-1] in " \t\r\n,":
+            out.pop()
+        out.extend( reversed( stack ) )
+    return "".join( out )
+
+def parseTests(svar):
+    """
+    Return a tuple (tests, repaired) of the list of tests, as dicts,
+    in the response `svar` and a flag which is True if the JSON had to
+    be repaired.  Raises ValueError if no list of tests is found.
+    """
+    r = scanJSON( svar )
+    if r is not None:
+        return r, False
+    if _start.search( svar ) is None:
+        raise ValueError( "No JSON list found in response string." )
+    text = repairJSON( svar )
+    # A single test is accepted only after repair, lest the first
+    # element of a broken list be taken for the whole.
+    r = scanJSON( text, True ) if text else None
+    if r is None:
+        raise ValueError( "Malformed JSON result." )
+    return r, True
+
 def dumpResponse(svar,debug=False):
     """
     Parse JSON list from the LLM and create Test objects.
+    The list is found and repaired if necessary by `parseTests()`;
+    if this fails, a single malformed Test is returned.
     """
-
-    # Extract JSON list, stripping leading and trailing characters.
     try:
-       svar_fetched = re.search(r"\[.*\]", svar, flags=re.DOTALL).group(0)
-    except Exception as e:
-        ob = Test(testName="No JSON list found in response string.")
+        testlist, repaired = parseTests( svar )
+    except ValueError as e:
+        ob = Test(testName=str(e).rstrip("."))
         ob.addResult( "rawfeedback", svar )
         ob.addResult( "decodeerror", str(e) )
         ob.addResult( "type", "malformed" )
         if debug:
             print( ob )
         return [ ob ]
-
-    # Parse the JSON string
-    try:
-       testlist = json.loads(svar_fetched,strict=False)
-    except json.JSONDecodeError as e:
-        ob = Test(testName="Malformed JSON result")
-        ob.addResult( "rawfeedback", svar_fetched )
-        ob.addResult( "decodeerror", str(e) )
-        ob.addResult( "type", "malformed" )
-        if debug:
-            print( ob )
-        return [ ob ]
+    if repaired:
+        metrics.label( repaired=True )
+        if debug: print( "dumpResponse() repaired the JSON" )
 
     # Create Test objects and return
     return [ makeTest(test) for test in testlist ]
 
+def isMalformed(tests):
+    """Return True if the tests from `dumpResponse()` show a parse failure."""
+    return any( t.type == "malformed" for t in tests )
+
 def extractAnswer(response,sandbox={},debug=False):
     """
     Extract the message content from the AI response.
@@ -192,11 +567,15 @@ def extractAnswer(response,sandbox={},debug=False):
     It considers the API given by the sandbox, and handles OpenAI 
     and Ollama differently.
 
+    The response may be given as a `requests` response or as the
+    decoded response body, e.g. from the output of a batch job.
+
     Returns a string representing a JSON list, where each element
     is an object representing a test as created by the LLM.
     """
     api = sandbox.get( "API", "ollama" ).lower()
-    svar = response.json()
+    svar = response if isinstance( response, dict ) else response.json()
+    metrics.setUsage( svar )
     if api in [ "openai", "openapi" ]:
        svar = svar["choices"][0]
        if debug: print( "== Using OpenAPI" )
@@ -210,18 +589,45 @@ def extractAnswer(response,sandbox={},debug=False):
     return svar
 
 
-def chatRequest(sandbox,prompt,ans=None,debug=False):
+def requestURL(sandbox):
+    """Return the URL of the LLM API given by sandbox."""
+    return sandbox.get("url", "https://api.openai.com/v1/chat/completions")
+
+def modelSetting(sandbox,key,default=None):
     """
-    Make the request to the LLM, using connection parameters
-    from sandbox, and the given prompt and student answer ans.
-    The return value is that produced by requests.request().
+    Return the setting `key` for the configured model, taken from the
+    `model_options` table in sandbox, which maps model names to tables
+    of settings, or else from sandbox.
+    """
+    m = ( sandbox.get( "model_options" ) or {} ).get( sandbox.get( "model" ) ) or {}
+    return m.get( key, sandbox.get( key, default ) )
+
+def ollamaOptions(sandbox,data):
+    """
+    Add `keep_alive` and `options` (including `num_ctx`) to the request
+    body `data` for Ollama, as configured for the model.  The `options`
+    from `model_options` are merged over those in sandbox.
+    """
+    ka = modelSetting( sandbox, "keep_alive" )
+    if ka is not None:
+        data["keep_alive"] = ka
+    opts = dict( sandbox.get( "options" ) or {} )
+    m = ( sandbox.get( "model_options" ) or {} ).get( sandbox.get( "model" ) ) or {}
+    opts.update( m.get( "options" ) or {} )
+    ctx = modelSetting( sandbox, "num_ctx" )
+    if ctx is not None:
+        opts["num_ctx"] = int( ctx )
+    if opts:
+        data["options"] = opts
+    return data
+
+def requestData(sandbox,prompt,ans=None):
+    """
+    Return the request body for the LLM, as a dict, given
+    the prompt and student answer ans.
     """
     if sandbox is None:
         sandbox = {}
-    openai_url = sandbox.get("url", "https://api.openai.com/v1/chat/completions")
-    headers = { "Content-Type": "application/json" }
-    if 'OPENAI_API_KEY' in sandbox:
-         headers["Authorization"] = f"Bearer {sandbox['OPENAI_API_KEY']}"
     if ans is not None:
         if not isinstance( ans, str ):
             raise Exception( f"Student answer should be a string, not {type(ans)}." )
@@ -234,14 +640,42 @@ def chatRequest(sandbox,prompt,ans=None,debug=False):
     data = { 
              "model": sandbox.get( 'model', "gpt-4o" ),
              "format" : "json",
-             "stream" : False,
+             "stream" : bool( sandbox.get( "stream", False ) ),
              "messages": msg,
            }
+    if sandbox.get( "API", "ollama" ).lower() in [ "openai", "openapi" ]:
+        if data["stream"]:
+            data["stream_options"] = { "include_usage": True }
+    else:
+        ollamaOptions( sandbox, data )
     if ans is None:
-        with open(getfn("schema.json"), 'r') as file:
-            schema = json.load( file )
-            data["response_format"] = { "type": "json_schema", "json_schema": schema } 
+        data["response_format"] = getResponseFormat()[0]
+    return data
+
+def chatRequest(sandbox,prompt,ans=None,debug=False,data=None,stream=False,
+                deadline=None):
+    """
+    Make the request to the LLM, using connection parameters
+    from sandbox, and the given prompt and student answer ans.
+    The request body may be given as `data` if it has already been
+    made by `requestData()`.
+    If `stream` is true, the body of the response is not read in advance.
+    The return value is that produced by requests.request().
+
+    Connections are pooled per endpoint by the `client` module,
+    which also applies the timeouts and retry policy configured in sandbox,
+    and gives up at the `deadline` (as given by `time.time()`).
+    """
+    if sandbox is None:
+        sandbox = {}
+    openai_url = requestURL(sandbox)
+    headers = { "Content-Type": "application/json" }
+    if 'OPENAI_API_KEY' in sandbox:
+         headers["Authorization"] = f"Bearer {sandbox['OPENAI_API_KEY']}"
+    if data is None:
+        data = requestData(sandbox,prompt,ans)
     if debug:
         print( json.dumps( data, indent=2 ) )
-    return requests.post(openai_url, headers=headers, json=data)
-
+    body = json.dumps(data).encode()
+    return client.post(openai_url, sandbox, deadline=deadline,
+                       headers=headers, data=body, stream=stream)
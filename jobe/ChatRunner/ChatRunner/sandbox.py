@@ -5,82 +5,125 @@ ChatRunner from Moodle.  This is similar to `chatrunner.testProgram()`,
 but runs the test in a sandbox.
 
 It is implemented by subclassign `Engine()` and overriding the
-`queryAI()` method to use the sandbox.  
+`queryAI()` method to use the sandbox.  The test program is the
+`testrunner` module, which receives the job as data; see there
+for the protocol.
+
+The `PoolEngine` runs the test in a pool of persistent worker
+processes (see `workerpool`) instead of a new python process per
+answer.  The pool lives as long as the process, so it is used by the
+daemon (`serve --workers`), not by the CodeRunner template, where
+every attempt is a new process.
 """
 
 from .chatrunner import *
+from . import metrics
+import os, sys, json, subprocess, threading
+
+def readAll(fd,into):
+    with open( fd, "rb" ) as f:
+        into.append( f.read() )
 
-def runTest(prg, timeout=1.0):
+def runTest(job, timeout=1.0):
       """
-      Run the test program as a supprocess catching exceotions.  
+      Run the test program (`testrunner`) as a subprocess, sending
+      the job (prompt, student answer, sandbox) on stdin and reading
+      the result frames from a separate pipe.
       It produces a `TestResults` object, incorporating the test results,
       or appropriate error codes if the program fails.
       """
 
+      r, w = os.pipe()
       try:
-         with open("code.py", "w") as fout:
-             fout.write( prg )
-         sp = subprocess.run(['python3', 'code.py'],
-             stderr = subprocess.STDOUT,
-             universal_newlines=False,
-             timeout=timeout,
-             stdout=subprocess.PIPE )
-         output = sp.stdout.decode()
-         return TestResults(output)
-      except subprocess.CalledProcessError as e:
-         output = e.stdout.decode()
-         return TestResults(output, exitCode=1)
-      except subprocess.TimeoutExpired as e:
-         output = e.stdout
-         if output:
-            output= output.decode()
-         else:
-             output = "Ingen output fra testprogrammet"
-         return TestResults(output, exitCode=2)
-
-def loadtestprogram(ans,prompt,sandbox={},
-                    pyfn="testprogram.py.txt",mdfn="prompt.md"):
-    dir = os.path.dirname(os.path.abspath(__file__))
-    mdfn = os.path.join( dir, mdfn )
-    pyfn = os.path.join( dir, pyfn )
-
-    with open(pyfn, 'r') as file:
-        prg = file.read()
-    return prg.format( prompt=prompt, studans=ans, sandbox=sandbox )
+         proc = subprocess.Popen(
+             [ sys.executable, "-m", "ChatRunner.testrunner", str(w) ],
+             stdin=subprocess.PIPE,
+             stdout=subprocess.PIPE,
+             stderr=subprocess.STDOUT,
+             pass_fds=(w,) )
+      except:
+         os.close( r )
+         raise
+      finally:
+         os.close( w )
+      frames = []
+      reader = threading.Thread( target=readAll, args=(r,frames) )
+      reader.start()
+      try:
+         output, _ = proc.communicate( json.dumps( job ).encode() + b"\n",
+                                       timeout=timeout )
+         exitCode = 0 if proc.returncode == 0 else 1
+      except subprocess.TimeoutExpired:
+         proc.kill()
+         output, _ = proc.communicate()
+         exitCode = 2
+      reader.join()
+      output = output.decode( errors="replace" )
+      frames = frames[0].decode( errors="replace" ) if frames else ""
+      if exitCode == 2 and not frames and not output:
+         output = "Ingen output fra testprogrammet"
+      return TestResults.fromFrames( frames, output, exitCode )
 
 class SandboxEngine(Engine):
+    def timeout(self):
+        """
+        Return the timeout for the test program: the time left until
+        the deadline and a grace period for the test program to report
+        the failure, or 40 seconds without a deadline.
+        """
+        if self.deadline is None: return 40.0
+        return max( 0.0, self.remaining() ) + 0.5
     def queryAI(self,debug=None):
         if debug is None: debug = self.debug
-        test_program = loadtestprogram(
-            self.studans,
-            self.getPrompt(),
-            sandbox=self.sandbox,
-            pyfn="testprogram.py.txt",
-            mdfn="prompt.md")
+        with metrics.phase( "prompt" ):
+            job = { "prompt": self.getPrompt(), "studans": self.getAnswer(),
+                    "sandbox": self.sandbox, "deadline": self.deadline }
 
-        testResults = runTest( test_program, timeout=40.0)
+        with metrics.phase( "sandbox" ):
+            testResults = runTest( job, timeout=self.timeout())
         testResults.finalise()
 
         self.testResults = testResults
         return testResults
 
-def runAnswer(problem,studans,literatur={},criteria="",gs="",sandbox=None,qid=0,debug=False, markdown=False):
+class PoolEngine(SandboxEngine):
+    """
+    Engine running the test program in the process-wide worker pool
+    with `workers` processes (default 4) as given in the sandbox.
+    """
+    def queryAI(self,debug=None):
+        from .workerpool import getPool
+        with metrics.phase( "prompt" ):
+            prompt = self.getPrompt()
+        with metrics.phase( "sandbox" ):
+            testResults = getPool( int( self.sandbox.get( "workers", 4 ) ) ).run(
+                prompt, self.getAnswer(),
+                sandbox=self.sandbox, timeout=self.timeout(),
+                deadline=self.deadline )
+        testResults.finalise()
+        self.testResults = testResults
+        return testResults
+
+def runAnswer(problem,studans,literatur={},criteria="",gs="",sandbox=None,qid=0,debug=False, markdown=False,
+              engine=SandboxEngine):
     """
     Run the CodeGrader in a sandbox, with pre- and post-processing of data.
     It gives Markdown output if debug is True, and Moodle/CodeRunner output
-    by default.
+    by default.  The daemon (see `daemon`) passes `engine=Engine` to
+    query in-process, or `engine=PoolEngine` to use the worker pool.
     """
 
     if sandbox is None:
         raise Exception( "No sandbox received by runAnswer." )
 
-    eng = SandboxEngine(problem,studans,literatur,criteria=criteria,gs=gs,sandbox=sandbox,qid=qid,debug=debug)
-    testResults = eng.queryAI()
-    if debug: testResults.debugPrintResults()
-    eng.advanceGraderstate( )
+    with metrics.record( sandbox, model=sandbox.get( "model" ), mode="moodle" ):
+        eng = engine(problem,studans,literatur,criteria=criteria,gs=gs,sandbox=sandbox,qid=qid,debug=debug)
+        testResults = eng.run()
+        if debug: testResults.debugPrintResults()
+        eng.advanceGraderstate( )
 
-    if debug:
-        print( "== runAnswer in debug mode ==" )
-        return eng.getMarkdownResult( )
-    else:
-       return  eng.getResult().getCodeRunnerOutput( other_lines=True )
+        if debug:
+            print( "== runAnswer in debug mode ==" )
+            return eng.getMarkdownResult( )
+        else:
+           return  eng.getResult().getCodeRunnerOutput( other_lines=True )
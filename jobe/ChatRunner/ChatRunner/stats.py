@@ -0,0 +1,259 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Consistency and model comparison statistics for batch output.
+
+One or more batch outputs, either TOML files as written by the batch
+processor, JSONL journals or SQLite stores (see `store`), are loaded into two long frames:
+
++ `feedback` - one row per feedback object, with the columns
+  `q`, `a`, `model`, `rep` and `fraction`
++ `tests` - one row per test, with the columns `q`, `a`, `model`,
+  `rep`, `test` and `passed`
+
+Questions and answers are identified by their numbers, so several
+files are combined only if they hold the same questions and answers,
+e.g. repeated runs of the same input.  The repetition number `rep`
+counts the feedback objects per answer and model across files.
+
+The fraction is aggregated per model, per question and model, and
+per answer and model.  The agreement between repetitions is given by
+Fleiss' kappa on the per-test pass/fail, where each (answer, test)
+pair is an item and each repetition a rater.  Latency and token
+counts are aggregated per model from a metrics JSONL file (see
+`metrics`), if given.
+
+Everything after loading is done with vectorised pandas operations.
+
+Run as `python -m ChatRunner.stats output.toml [...] [--metrics m.jsonl]`.
+"""
+
+import json
+import tomllib
+import argparse
+
+import numpy as np
+import pandas as pd
+
+keys = [ "q", "a", "model" ]
+
+def feedbackRows(qalist):
+    """
+    Generate (q, a, feedback) for every feedback object in
+    a batch output.
+    """
+    for qno, q in enumerate( qalist["questions"] ):
+        for ano, a in enumerate( q["answers"] ):
+            for fb in a.get( "feedback", [] ):
+                yield qno, ano, fb
+
+def journalRows(fn):
+    """
+    Generate (q, a, feedback) for every record in a journal,
+    in the order of the batch output.
+    """
+    recs = []
+    with open( fn, "rb" ) as f:
+        for line in f:
+            try:
+                recs.append( json.loads( line ) )
+            except ValueError:
+                continue
+    recs.sort( key=lambda r: ( r["key"][0], r["key"][2], r["key"][5] ) )
+    for r in recs:
+        yield r["key"][0], r["key"][2], r["feedback"]
+
+def readRows(fn):
+    if fn.endswith( ".jsonl" ):
+        return journalRows( fn )
+    with open( fn, "rb" ) as f:
+        return feedbackRows( tomllib.load( f ) )
+
+def fileFrames(fn):
+    """
+    Return the feedback and tests frames of one batch output, where
+    the `fb` column of the tests frame is the row number in the
+    feedback frame.
+    """
+    fbcols = { "q": [], "a": [], "model": [], "fraction": [] }
+    tcols = { "fb": [], "test": [], "passed": [] }
+    for n, ( qno, ano, fb ) in enumerate( readRows( fn ) ):
+        fbcols["q"].append( qno )
+        fbcols["a"].append( ano )
+        fbcols["model"].append( fb.get( "model", "" ) )
+        fbcols["fraction"].append( fb.get( "fraction", np.nan ) )
+        for t in fb.get( "testfeedback", [] ):
+            if "gpt_svar" in t or "passed" not in t: continue
+            tcols["fb"].append( n )
+            tcols["test"].append( t.get( "name", "" ) )
+            tcols["passed"].append( bool( t["passed"] ) )
+    return pd.DataFrame( fbcols ), pd.DataFrame( tcols )
+
+def sqliteFrames(fn):
+    """
+    Return the feedback and tests frames of every run in an SQLite
+    store (see `store`), as for `fileFrames()`.
+    """
+    from . import store
+    db = store.connect( fn )
+    try:
+        feedback = pd.read_sql_query(
+            """SELECT f.id, q.qno AS q, a.ano AS a, f.model, f.fraction
+               FROM feedback f JOIN questions q ON f.question = q.id
+               JOIN answers a ON f.answer = a.id
+               ORDER BY f.run, f.rep, f.id""", db )
+        tests = pd.read_sql_query(
+            """SELECT feedback AS fb, name AS test, passed FROM tests
+               WHERE passed IS NOT NULL AND json_extract(extra,'$.gpt_svar') IS NULL
+               ORDER BY feedback, pos""", db )
+    finally:
+        db.close()
+    pos = pd.Series( np.arange( len(feedback) ), index=feedback.pop( "id" ) )
+    tests["fb"] = pos.reindex( tests["fb"] ).to_numpy()
+    tests["passed"] = tests["passed"].astype( bool )
+    return feedback, tests.dropna( subset=[ "fb" ] )
+
+def loadFrames(files):
+    """
+    Return the `feedback` and `tests` frames for the given batch outputs,
+    which may be TOML files, journals or SQLite stores (`.sqlite` or `.db`).
+    Nontests, such as the raw response (`gpt_svar`), are skipped.
+    """
+    fbs, ts = [], []
+    n = 0
+    for fn in files:
+        if fn.endswith( ( ".sqlite", ".db" ) ):
+            fb, t = sqliteFrames( fn )
+        else:
+            fb, t = fileFrames( fn )
+        t["fb"] = t["fb"].astype( int ) + n
+        n += len(fb)
+        fbs.append( fb )
+        ts.append( t )
+    feedback = pd.concat( fbs, ignore_index=True )
+    feedback["fraction"] = feedback["fraction"].astype( float )
+    feedback["rep"] = feedback.groupby( keys ).cumcount()
+    tests = pd.concat( ts, ignore_index=True )
+    tests = feedback[ keys + [ "rep" ] ].iloc[ tests["fb"].to_numpy() ] \
+        .reset_index( drop=True ).join( tests.drop( columns="fb" ) )
+    return feedback, tests
+
+def fractionStats(feedback,by):
+    """Return the count, mean and variance of the fraction grouped by `by`."""
+    return feedback.groupby( by )["fraction"].agg( [ "count", "mean", "var" ] )
+
+def fleissKappa(tests,by=[ "model" ]):
+    """
+    Return Fleiss' kappa for the pass/fail of each test, grouped by `by`,
+    with the repetitions as raters.  Items rated fewer than twice are
+    skipped.  Items may have different numbers of ratings; the agreement
+    of each item is computed from its own count.  A test repeated within
+    one feedback object counts once.
+    """
+    tests = tests.drop_duplicates( keys + [ "rep", "test" ] )
+    items = tests.groupby( by + [ "q", "a", "test" ] )["passed"] \
+        .agg( k="sum", n="count" )
+    items = items[ items["n"] >= 2 ].astype( float )
+    k, n = items["k"], items["n"]
+    items["P"] = ( k*k + (n-k)*(n-k) - n ) / ( n*(n-1) )
+    g = items.groupby( level=by )
+    r = g.agg( items=( "P", "size" ), Pbar=( "P", "mean" ),
+               k=( "k", "sum" ), n=( "n", "sum" ) )
+    p = r["k"] / r["n"]
+    pe = p*p + (1-p)*(1-p)
+    with np.errstate( divide="ignore", invalid="ignore" ):
+        r["kappa"] = np.where( pe < 1, ( r["Pbar"] - pe ) / ( 1 - pe ), np.nan )
+    r["passrate"] = p
+    return r[ [ "items", "passrate", "Pbar", "kappa" ] ]
+
+def loadMetrics(fn):
+    """
+    Return a frame with one row per record in a metrics JSONL file,
+    with the columns `model`, one per phase, and the token counts.
+    """
+    recs = []
+    with open( fn ) as f:
+        for line in f:
+            try:
+                recs.append( json.loads( line ) )
+            except ValueError:
+                continue
+    df = pd.json_normalize( recs )
+    df.columns = [ c.split( "." )[-1] for c in df.columns ]
+    if "model" not in df:
+        df["model"] = ""
+    return df
+
+def metricStats(df):
+    """
+    Return latency percentiles of the `total` and `http` phases and
+    token sums and means per model.
+    """
+    aggs = {}
+    for ph in [ "total", "http" ]:
+        if ph not in df: continue
+        aggs[f"{ph}_p50"] = ( ph, lambda x: x.quantile(0.5) )
+        aggs[f"{ph}_p95"] = ( ph, lambda x: x.quantile(0.95) )
+    for tk in [ "prompt_tokens", "completion_tokens", "cached_tokens" ]:
+        if tk not in df: continue
+        aggs[f"{tk}_sum"] = ( tk, "sum" )
+        aggs[f"{tk}_mean"] = ( tk, "mean" )
+    if not aggs:
+        return None
+    return df.groupby( "model" ).agg( calls=( "model", "size" ), **aggs )
+
+def markdown(df,digits=3):
+    """Return a frame as a Markdown table, including the index."""
+    df = df.reset_index()
+    cols = list( df.columns )
+    lines = [ "| " + " | ".join( str(c) for c in cols ) + " |",
+              "| " + " | ".join( "-:" if pd.api.types.is_numeric_dtype( df[c] )
+                                 else ":-" for c in cols ) + " |" ]
+    fmt = lambda x: f"{x:.{digits}f}" if isinstance( x, float ) else str(x)
+    for row in df.itertuples( index=False ):
+        lines.append( "| " + " | ".join( fmt(x) for x in row ) + " |" )
+    return "\n".join( lines )
+
+def report(feedback,tests,metrics=None):
+    """Return the statistics as a Markdown document."""
+    result = [ "# ChatRunner statistics", "",
+               f"{len(feedback)} feedback objects, {len(tests)} test results.", "" ]
+    sections = [
+        ( "Fraction per model", fractionStats( feedback, [ "model" ] ) ),
+        ( "Agreement per model", fleissKappa( tests, [ "model" ] ) ),
+        ( "Fraction per question", fractionStats( feedback, [ "q", "model" ] ) ),
+        ( "Agreement per question", fleissKappa( tests, [ "q", "model" ] ) ),
+        ( "Fraction per answer", fractionStats( feedback, [ "q", "a", "model" ] ) ),
+    ]
+    if metrics is not None:
+        m = metricStats( metrics )
+        if m is not None:
+            sections.insert( 2, ( "Latency and tokens per model", m ) )
+    for title, df in sections:
+        result += [ f"## {title}", "", markdown( df ), "" ]
+    return "\n".join( result )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = 'ChatRunner.stats',
+        description = 'Consistency and model comparison statistics for batch output',
+        epilog = '')
+    parser.add_argument('file',nargs="+",
+                        help="Batch output (TOML), journal (JSONL) or SQLite files")
+    parser.add_argument('--metrics',help="Metrics JSONL file from the batch run")
+    parser.add_argument('--outfile',help="Markdown output file (default: stdout)")
+    parser.add_argument('--csv',
+                        help="Prefix for CSV dumps of the feedback and tests frames")
+    args = parser.parse_args()
+
+    feedback, tests = loadFrames( args.file )
+    metrics = loadMetrics( args.metrics ) if args.metrics else None
+    if args.csv:
+        feedback.to_csv( args.csv + "feedback.csv", index=False )
+        tests.to_csv( args.csv + "tests.csv", index=False )
+    text = report( feedback, tests, metrics )
+    if args.outfile:
+        with open( args.outfile, "w" ) as f:
+            f.write( text + "\n" )
+    else:
+        print( text )
@@ -0,0 +1,272 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+SQLite store for batch results.
+
+An alternative to the JSONL journal (see `journal`), selected with
+`--sqlite` in batch mode.  A `Store` has the same interface as a
+`journal.Journal`, so that it can be passed to `batchprocess()` and
+`journal.compose()`, and it keeps every run in normalised tables:
+
++ `runs` - one row per batch run, with the start time, the input
+  file and the config (without API keys)
++ `questions` and `answers` - the question/answer set, identified
+  by number and text hash as in the journal key
++ `feedback` - one row per result, with the run, model, repetition
+  and fraction, and the remaining keys of the feedback object as JSON
++ `tests` - one row per test of a feedback object
+
+The feedback table is indexed on (model, question, answer), so that
+results can be compared across runs and models with indexed queries.
+Results are written in transactions of up to `flush` rows, or at
+least every `interval` seconds, so a crash loses at most the last
+few results; they are recomputed by `--resume`.  The database is in
+WAL mode, so it can be read while a batch is running.
+"""
+
+import json, time, sqlite3, threading
+
+from .journal import textHash
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    source TEXT,
+    config TEXT
+);
+CREATE TABLE IF NOT EXISTS questions (
+    id INTEGER PRIMARY KEY,
+    qno INTEGER,
+    hash TEXT,
+    text TEXT,
+    UNIQUE (qno, hash)
+);
+CREATE TABLE IF NOT EXISTS answers (
+    id INTEGER PRIMARY KEY,
+    question INTEGER REFERENCES questions(id),
+    ano INTEGER,
+    hash TEXT,
+    text TEXT,
+    criteria TEXT,
+    UNIQUE (question, ano, hash)
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY,
+    run INTEGER REFERENCES runs(id),
+    question INTEGER REFERENCES questions(id),
+    answer INTEGER REFERENCES answers(id),
+    model TEXT,
+    rep INTEGER,
+    fraction REAL,
+    extra TEXT,
+    UNIQUE (run, answer, model, rep)
+);
+CREATE INDEX IF NOT EXISTS feedback_mqa ON feedback (model, question, answer);
+CREATE TABLE IF NOT EXISTS tests (
+    id INTEGER PRIMARY KEY,
+    feedback INTEGER REFERENCES feedback(id),
+    pos INTEGER,
+    name TEXT,
+    passed INTEGER,
+    mark NUMERIC,
+    description TEXT,
+    resultat TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS tests_feedback ON tests (feedback);
+"""
+
+testColumns = [ "name", "passed", "mark", "description", "resultat" ]
+
+def connect(fn):
+    """Return a connection to the store `fn`, creating the tables if needed."""
+    db = sqlite3.connect( fn, check_same_thread=False, timeout=30.0 )
+    db.execute( "PRAGMA journal_mode=WAL" )
+    db.execute( "PRAGMA synchronous=NORMAL" )
+    db.executescript( schema )
+    return db
+
+def stripKeys(obj):
+    """
+    Return a copy of the config without API keys, also in nested
+    tables such as the endpoints of a `url` list.
+    """
+    if isinstance( obj, dict ):
+        return { k: stripKeys( v ) for k, v in obj.items() if "KEY" not in k.upper() }
+    if isinstance( obj, list ):
+        return [ stripKeys( v ) for v in obj ]
+    return obj
+
+class Store:
+    """
+    A batch run in an SQLite file.  With `resume`, the latest run
+    in the file is continued, otherwise a new run is started.
+    The question/answer set must be added with `addQuestions()`
+    before results are appended.
+    """
+    def __init__(self,fn,resume=False,source=None,config={},flush=50,interval=1.0):
+        self.fn = fn
+        self.db = connect( fn )
+        self.lock = threading.Lock()
+        self.flush = flush
+        self.interval = interval
+        self.pending = []
+        self.last = time.time()
+        self.answers = {}
+        self.index = {}
+        row = self.db.execute( "SELECT max(id) FROM runs" ).fetchone()
+        if resume and row[0] is not None:
+            self.run = row[0]
+            self.scan()
+        else:
+            config = stripKeys( config )
+            with self.db:
+                cur = self.db.execute(
+                    "INSERT INTO runs (started, source, config) VALUES (?,?,?)",
+                    ( time.time(), source, json.dumps( config, default=str ) ) )
+            self.run = cur.lastrowid
+    def scan(self):
+        """Index the results of the current run."""
+        cur = self.db.execute(
+            """SELECT f.id, q.qno, q.hash, a.ano, a.hash, f.model, f.rep
+               FROM feedback f JOIN answers a ON f.answer = a.id
+               JOIN questions q ON f.question = q.id
+               WHERE f.run = ?""", ( self.run, ) )
+        for fid, *key in cur:
+            self.index[ tuple(key) ] = fid
+    def addQuestions(self,qalist):
+        """Add the questions and answers of a batch input."""
+        with self.lock, self.db:
+            for qno, q in enumerate( qalist["questions"] ):
+                qh = textHash( q["question"] )
+                self.db.execute(
+                    "INSERT OR IGNORE INTO questions (qno, hash, text) VALUES (?,?,?)",
+                    ( qno, qh, q["question"] ) )
+                qid = self.db.execute(
+                    "SELECT id FROM questions WHERE qno = ? AND hash = ?",
+                    ( qno, qh ) ).fetchone()[0]
+                for ano, a in enumerate( q["answers"] ):
+                    ah = textHash( a["ans"] )
+                    self.db.execute(
+                        """INSERT OR IGNORE INTO answers
+                           (question, ano, hash, text, criteria) VALUES (?,?,?,?,?)""",
+                        ( qid, ano, ah, a["ans"], a.get( "criteria" ) ) )
+                    aid = self.db.execute(
+                        "SELECT id FROM answers WHERE question = ? AND ano = ? AND hash = ?",
+                        ( qid, ano, ah ) ).fetchone()[0]
+                    self.answers[ ( qno, qh, ano, ah ) ] = ( qid, aid )
+    def __contains__(self,key):
+        return tuple(key) in self.index
+    def __len__(self):
+        return len(self.index)
+    def append(self,key,feedback):
+        """
+        Queue a result for writing; the queue is written when it is
+        full or the interval has passed.
+        """
+        key = tuple(key)
+        with self.lock:
+            self.pending.append( ( key, feedback ) )
+            if len(self.pending) >= self.flush or \
+               time.time() - self.last >= self.interval:
+                self.write()
+    def write(self):
+        """Write the queued results in one transaction.  Call with the lock held."""
+        self.last = time.time()
+        if not self.pending: return
+        pending, self.pending = self.pending, []
+        with self.db:
+            for key, fb in pending:
+                qid, aid = self.answers[ key[:4] ]
+                extra = { k: v for k, v in fb.items()
+                          if k not in [ "model", "fraction", "testfeedback" ] }
+                old = self.index.get( key )
+                if old is not None:
+                    self.db.execute( "DELETE FROM tests WHERE feedback = ?", ( old, ) )
+                cur = self.db.execute(
+                    """INSERT OR REPLACE INTO feedback
+                       (run, question, answer, model, rep, fraction, extra)
+                       VALUES (?,?,?,?,?,?,?)""",
+                    ( self.run, qid, aid, key[4], key[5], fb.get( "fraction" ),
+                      json.dumps( extra, ensure_ascii=False ) ) )
+                fid = cur.lastrowid
+                self.db.executemany(
+                    """INSERT INTO tests (feedback, pos, name, passed, mark,
+                       description, resultat, extra) VALUES (?,?,?,?,?,?,?,?)""",
+                    [ ( fid, i ) + tuple( t.get( k ) for k in testColumns )
+                      + ( json.dumps( { k: v for k, v in t.items()
+                                        if k not in testColumns },
+                                      ensure_ascii=False ), )
+                      for i, t in enumerate( fb.get( "testfeedback", [] ) ) ] )
+                self.index[key] = fid
+    def get(self,key):
+        """Return the result for `key` or None."""
+        with self.lock:
+            self.write()
+            fid = self.index.get( tuple(key) )
+            if fid is None: return None
+            return feedbackObject( self.db, fid )
+    def close(self):
+        with self.lock:
+            self.write()
+        self.db.close()
+
+def feedbackObject(db,fid):
+    """Return the feedback object with id `fid`, as in the batch output."""
+    model, fraction, extra = db.execute(
+        "SELECT model, fraction, extra FROM feedback WHERE id = ?",
+        ( fid, ) ).fetchone()
+    fb = json.loads( extra or "{}" )
+    fb["fraction"] = fraction
+    fb["model"] = model
+    tests = []
+    cur = db.execute(
+        f"SELECT {', '.join(testColumns)}, extra FROM tests WHERE feedback = ? ORDER BY pos",
+        ( fid, ) )
+    for row in cur:
+        t = json.loads( row[-1] or "{}" )
+        for k, v in zip( testColumns, row ):
+            if v is not None:
+                t[k] = v
+        if "passed" in t:
+            t["passed"] = bool( t["passed"] )
+        tests.append( t )
+    fb["testfeedback"] = tests
+    return fb
+
+def latestRun(db):
+    return db.execute( "SELECT max(id) FROM runs" ).fetchone()[0]
+
+def qalist(fn,run=None,model=None):
+    """
+    Return the question/answer set with the feedback of a run (default
+    the latest), optionally for one model only, in the format of the
+    batch output.
+    """
+    db = connect( fn )
+    if run is None:
+        run = latestRun( db )
+    sql = "SELECT id, question, answer FROM feedback WHERE run = ?"
+    args = [ run ]
+    if model is not None:
+        sql += " AND model = ?"
+        args.append( model )
+    fbs = {}
+    for fid, qid, aid in db.execute( sql + " ORDER BY rep, id", args ):
+        fbs.setdefault( aid, [] ).append( feedbackObject( db, fid ) )
+    questions = []
+    for qid, text in db.execute( "SELECT id, text FROM questions ORDER BY qno, id" ):
+        answers = []
+        for aid, ans, criteria in db.execute(
+                "SELECT id, text, criteria FROM answers WHERE question = ? ORDER BY ano, id",
+                ( qid, ) ):
+            if aid not in fbs: continue
+            a = { "ans": ans, "feedback": fbs[aid] }
+            if criteria is not None:
+                a["criteria"] = criteria
+            answers.append( a )
+        if answers:
+            questions.append( { "question": text, "answers": answers } )
+    db.close()
+    return { "questions": questions }
@@ -0,0 +1,68 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+The test program run in the sandbox, and its protocol.
+
+The job is sent as one line of JSON on stdin, an object with the
+keys `prompt`, `studans` and `sandbox`, and optionally `deadline`
+(as given by `time.time()`) for the query.  Nothing is compiled from
+the job; the student answer is only ever data.
+
+The results are written as NDJSON on a dedicated file descriptor,
+given on the command line: one frame `{"Testobject": ...}` per test
+(see `Test.dump()`), followed by an end frame
+`{"end": true, "exitCode": n}`.  Anything written to stdout or stderr
+is diagnostic output, which is kept apart from the results and
+cannot corrupt them.  The frames are parsed by `TestResults.fromFrames()`.
+
+The worker processes of `workerpool` use the same protocol, reading
+one job per line, and adding the diagnostic output of the job as
+`output` in the end frame.
+
+The test program runs in a new interpreter for every answer, so
+start-up time matters.  This module imports only what is needed to
+build the request, send it and write the results, i.e. the `query`
+module.  With `transport = "http"` in the sandbox, it also avoids
+the import of `requests` (see `lite`); this is opt-in, since that
+transport has no proxy or custom CA support.
+
+Run as `python3 -m ChatRunner.testrunner FD`.
+"""
+
+import sys, json
+
+def endFrame(exitCode,output=None):
+    obj = { "end": True, "exitCode": exitCode }
+    if output is not None:
+        obj["output"] = output
+    return json.dumps( obj, ensure_ascii=False ) + "\n"
+
+def runJob(job,out):
+    """
+    Query the LLM for the job and write the test frames to the
+    text file `out`.  Returns the exit code.
+    """
+    from .query import queryAI
+    if job.get( "sandbox" ) is None:
+        print( "No sandbox received in test program." )
+        return 1
+    try:
+        tests = queryAI( job["sandbox"], job["prompt"], job["studans"],
+                         deadline=job.get( "deadline" ) )
+    except Exception as e:
+        print( f"{type(e).__name__}: {e}" )
+        return 1
+    for test in tests:
+        out.write( test.dump() + "\n" )
+    return 0
+
+def main(argv):
+    fd = int( argv[1] )
+    job = json.loads( sys.stdin.readline() )
+    with open( fd, "w", encoding="utf-8" ) as out:
+        exitCode = runJob( job, out )
+        out.write( endFrame( exitCode ) )
+    return exitCode
+
+if __name__ == "__main__":
+    sys.exit( main( sys.argv ) )
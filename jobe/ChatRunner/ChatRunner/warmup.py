@@ -0,0 +1,166 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Warm-up of the configured models before an exam.
+
+With Ollama, the first request after the model has been unloaded
+pays the full cost of loading it.  The warm-up
+
+1.  preloads each configured model with an empty chat request,
+    giving the `keep_alive` of the model,
+2.  primes the static prompt prefix of each question in a question
+    bundle (the batch TOML format), with a request generating a single
+    token, so that the server can reuse the cached prefix (this needs
+    `prompt_layout = "prefix"` with the baseline engine), and
+3.  optionally holds the models resident, repeating the preload every
+    `interval` seconds for the duration of the exam window, so that
+    models evicted or lost in a server restart are loaded again.
+
+The requests use the same config as grading, including `keep_alive`,
+`num_ctx` and `options`, which can be given per model in the
+`model_options` table, e.g. in TOML,
+```toml
+keep_alive = "30m"
+[model_options."llama3:70b"]
+num_ctx = 16384
+options = { temperature = 0.2 }
+```
+For OpenAI compatible servers, only the priming applies.
+
+Run as `python -m ChatRunner warmup --config idun.toml --bundle exam.toml`.
+"""
+
+import sys, time, argparse
+
+from .helper import readobject
+from .query import requestData, chatRequest, ollamaOptions
+
+def isOllama(sandbox):
+    return sandbox.get( "API", "ollama" ).lower() not in [ "openai", "openapi" ]
+
+def models(cfg):
+    """Return a list of configs, one per model listed in `cfg`."""
+    ms = cfg["model"]
+    if isinstance( ms, str ):
+        ms = [ ms ]
+    return [ dict( cfg, model=m ) for m in ms ]
+
+def post(sandbox,data):
+    """Send the request body `data` and return the time taken in seconds."""
+    t0 = time.perf_counter()
+    r = chatRequest( sandbox, None, data=data )
+    if r.status_code != 200:
+        print( r.content )
+        raise Exception( f"Warm-up of {sandbox['model']} returns {r.status_code}." )
+    r.content
+    return time.perf_counter() - t0
+
+def preload(sandbox):
+    """
+    Load the model of `sandbox` into memory with an empty chat request
+    (Ollama only).  Returns the time taken.
+    """
+    data = ollamaOptions( sandbox, { "model": sandbox["model"],
+                                     "messages": [], "stream": False } )
+    return post( sandbox, data )
+
+def prefixes(bundle,lit={},mode="baseline",sandbox={}):
+    """
+    Generate the prompt for each distinct question and criteria in the
+    bundle with an empty answer, as made by the engine in `mode`,
+    i.e. a system prompt, or a list of messages with `new`.
+    """
+    from .chatrunner import Engine, NewEngine
+    cls = NewEngine if mode == "new" else Engine
+    seen = set()
+    for q in bundle.get( "questions", [] ):
+        for criteria in [ a.get( "criteria", "" ) for a in q.get( "answers", [] ) ] or [ "" ]:
+            if ( q["question"], criteria ) in seen: continue
+            seen.add( ( q["question"], criteria ) )
+            yield cls( q["question"], "", lit, criteria, "", sandbox ).getPrompt()
+
+def prime(sandbox,prompt):
+    """
+    Send the prompt with an empty answer in a request generating one
+    token, so that the server computes and caches the prefix.
+    Returns the time taken.
+    """
+    sandbox = dict( sandbox, stream=False )
+    if isinstance( prompt, list ):
+        data = requestData( sandbox, prompt )
+    else:
+        data = requestData( sandbox, prompt, "" )
+    if isOllama( sandbox ):
+        data.setdefault( "options", {} )["num_predict"] = 1
+    else:
+        data["max_tokens"] = 1
+    return post( sandbox, data )
+
+def warmup(cfg,bundle=None,lit={},mode="baseline"):
+    """Preload every configured model and prime the prefixes of the bundle."""
+    for c in models( cfg ):
+        if isOllama( c ):
+            print( f"Preloaded {c['model']} in {preload(c):.2f}s." )
+        if bundle is None: continue
+        for i, p in enumerate( prefixes( bundle, lit, mode, c ) ):
+            print( f"Primed question {i+1} on {c['model']} in {prime(c,p):.2f}s." )
+
+def hold(cfg,duration,interval):
+    """Repeat the preload every `interval` seconds for `duration` seconds."""
+    end = time.time() + duration
+    while True:
+        wait = min( interval, end - time.time() )
+        if wait <= 0: break
+        time.sleep( wait )
+        for c in models( cfg ):
+            if not isOllama( c ): continue
+            try:
+                t = preload( c )
+                print( f"Kept {c['model']} resident ({t:.2f}s)." )
+            except Exception as e:
+                print( f"Keep-alive of {c['model']} failed: {e}" )
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog = 'chatrunner warmup',
+        description = 'Preload models and prime prompt prefixes before an exam' )
+    parser.add_argument('-C','--config',required=True,help="Config file.")
+    parser.add_argument('-m','--model',help="Model (default from config).")
+    parser.add_argument('-u','--url',help="URL for the LLM API.")
+    parser.add_argument('-b','--bundle',
+                        help="Question bundle (batch toml file) whose prefixes are primed.")
+    parser.add_argument('-l','--literature',help="Literature file.")
+    parser.add_argument('-E','--mode',default="baseline",
+                        help="Engine mode whose prompts are primed (baseline/new).")
+    parser.add_argument('--keep-alive',dest="keep_alive",
+                        help="Keep-alive for the models, e.g. 3h (overrides config).")
+    parser.add_argument('--hold',type=float,default=0,
+                        help="Seconds to keep the models resident after warm-up.")
+    parser.add_argument('--interval',type=float,default=300,
+                        help="Seconds between keep-alive requests with --hold.")
+    args = parser.parse_args( argv[1:] )
+
+    cfg = readobject( args.config )["server"]
+    if args.model:
+        cfg["model"] = args.model
+    if args.url:
+        cfg["url"] = args.url
+    if args.keep_alive:
+        # The override must also win over the per-model settings.
+        cfg["keep_alive"] = args.keep_alive
+        cfg["model_options"] = { m: dict( o, keep_alive=args.keep_alive )
+                                 for m, o in ( cfg.get( "model_options" ) or {} ).items() }
+    if cfg.get( "url" ) is None and isOllama( cfg ):
+        cfg["url"] = "http://localhost:11434/api/chat"
+    bundle = readobject( args.bundle ) if args.bundle else None
+    lit = {}
+    if args.literature:
+        with open( args.literature ) as f:
+            lit = f.read()
+    warmup( cfg, bundle, lit, args.mode )
+    if args.hold > 0:
+        hold( cfg, args.hold, args.interval )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main( [ "warmup" ] + sys.argv[1:] ) )
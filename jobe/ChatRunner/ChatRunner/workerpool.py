@@ -0,0 +1,199 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+A pool of long-lived worker processes to replace the per-answer
+test program in the sandbox.
+
+Each worker is a separate python process which has imported ChatRunner
+and its dependencies once and keeps its HTTP connections open.
+It uses the protocol of the test program (see `testrunner`):
+a job (prompt, student answer, sandbox) is sent as a line of JSON
+on the worker's stdin, and the worker writes the result frames,
+ending with an end frame holding the exit code and the diagnostic
+output, on a separate pipe.
+A worker which exceeds the timeout is killed and replaced, and
+the job gets the same `TestResults` as a timeout in `runTest()`.
+
+The pool belongs to the process which creates it, so it pays off
+only in a long-lived process, i.e. the daemon (`serve --workers`,
+see `daemon`), through `sandbox.PoolEngine`.  In the CodeRunner
+template, every attempt is a new process, and the pool would only
+add start-up cost.
+
+The worker loop is run with `python3 -m ChatRunner.workerpool FD`.
+"""
+
+import os, sys, json, io, select, subprocess, threading, time
+import contextlib
+
+from .chatrunner import TestResults
+
+class Worker:
+    """A single worker process with pipes for jobs and result frames."""
+    def __init__(self):
+        r, w = os.pipe()
+        try:
+            self.proc = subprocess.Popen(
+                [ sys.executable, "-m", "ChatRunner.workerpool", str(w) ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                pass_fds=(w,) )
+        except:
+            os.close( r )
+            raise
+        finally:
+            os.close( w )
+        self.fd = r
+        self.buffer = b""
+    def alive(self):
+        return self.proc.poll() is None
+    def kill(self):
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+    def send(self,job):
+        self.proc.stdin.write( json.dumps( job ).encode() + b"\n" )
+        self.proc.stdin.flush()
+    def receive(self,timeout):
+        """
+        Read the frames of one job from the worker, up to and
+        including the end frame.  Returns the frames as bytes,
+        None on timeout, and b"" if the worker has died.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            pos = 0
+            while ( n := self.buffer.find( b"\n", pos ) ) >= 0:
+                if self.buffer.startswith( b'{"end":', pos ):
+                    frames, self.buffer = self.buffer[:n+1], self.buffer[n+1:]
+                    return frames
+                pos = n + 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            r, _, _ = select.select( [self.fd], [], [], remaining )
+            if not r:
+                return None
+            chunk = os.read( self.fd, 65536 )
+            if not chunk:
+                return b""
+            self.buffer += chunk
+
+class WorkerPool:
+    """
+    A pool of `size` worker processes.  Workers are started on demand
+    and reused.  The `run()` method can be called from several threads.
+    """
+    def __init__(self,size=4):
+        self.size = size
+        self.idle = []
+        self.count = 0
+        self.cond = threading.Condition()
+    def start(self):
+        """Start workers until the pool is full."""
+        while True:
+            with self.cond:
+                if self.count >= self.size: break
+                self.count += 1
+            w = Worker()
+            self.release( w )
+    def acquire(self):
+        with self.cond:
+            while not self.idle and self.count >= self.size:
+                self.cond.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.count += 1
+        try:
+            return Worker()
+        except:
+            with self.cond:
+                self.count -= 1
+                self.cond.notify()
+            raise
+    def release(self,worker):
+        with self.cond:
+            if worker.alive():
+                self.idle.append( worker )
+            else:
+                self.count -= 1
+            self.cond.notify()
+    def run(self,prompt,studans,sandbox={},timeout=40.0,deadline=None):
+        """
+        Run a job in a worker, returning a `TestResults` object
+        as `runTest()` does.  The `deadline` is passed on to the query.
+        """
+        worker = self.acquire()
+        try:
+            worker.send( { "prompt": prompt, "studans": studans,
+                           "sandbox": sandbox, "deadline": deadline } )
+            frames = worker.receive( timeout )
+            if frames is None:
+                worker.kill()
+                return TestResults.fromFrames( "", "Ingen output fra testprogrammet",
+                                               exitCode=2 )
+            if not frames:
+                worker.kill()
+                return TestResults.fromFrames( "", "Testprogrammet avsluttet uventet",
+                                               exitCode=1 )
+            return TestResults.fromFrames( frames.decode( errors="replace" ) )
+        except (OSError, ValueError) as e:
+            worker.kill()
+            return TestResults.fromFrames( "", str(e), exitCode=1 )
+        finally:
+            self.release( worker )
+    def close(self):
+        with self.cond:
+            for w in self.idle:
+                w.kill()
+            self.count -= len( self.idle )
+            self.idle = []
+
+_pools = {}
+_lock = threading.Lock()
+
+def getPool(size):
+    """
+    Return the process-wide pool with the given number of workers,
+    starting the workers when the pool is created.
+    """
+    with _lock:
+        pool = _pools.get( size )
+        if pool is None:
+            pool = WorkerPool( size )
+            pool.start()
+            _pools[size] = pool
+    return pool
+
+def main(argv):
+    """
+    Worker loop, reading jobs from stdin and writing result frames
+    to the file descriptor given in `argv`.
+    """
+    from .testrunner import runJob, endFrame
+    # Import everything before the first job arrives.
+    from . import query, client
+    import requests
+    with open( int( argv[1] ), "w", encoding="utf-8" ) as out:
+        for line in sys.stdin:
+            if not line.strip(): continue
+            job = json.loads( line )
+            diag = io.StringIO()
+            with contextlib.redirect_stdout( diag ), \
+                 contextlib.redirect_stderr( diag ):
+                try:
+                    exitCode = runJob( job, out )
+                except Exception as e:
+                    print( f"{type(e).__name__}: {e}" )
+                    exitCode = 1
+            out.write( endFrame( exitCode, diag.getvalue() ) )
+            out.flush()
+
+if __name__ == "__main__":
+    main( sys.argv )
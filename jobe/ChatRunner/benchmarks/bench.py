@@ -0,0 +1,199 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Offline benchmarks for ChatRunner against the local mock server.
+
+Each scenario makes a number of grading calls against `mockserver.py`
+and reports throughput, latency percentiles, the mean time per phase
+(from `ChatRunner.metrics`), and the overhead, i.e. the client time
+not spent inside the server.  The scenarios are
+
++ `baseline`, `new`, `dump` - `testProgram()` in the given mode
++ `moodle` - `runAnswer()` through the sandbox subprocess
++ `pool` - `runAnswer()` with the sandbox worker pool (`PoolEngine`), as in the daemon
++ `batch` - `batchprocess()` with `--jobs` concurrent queries
+
+Results can be saved with `--save` and compared with a previous run
+with `--compare`, flagging scenarios where the p50 overhead has grown
+by more than `--threshold` percent.
+
+Run from the `jobe/ChatRunner` directory, e.g.
+`python benchmarks/bench.py -n 50 --latency 0.05`.
+"""
+
+import os, sys, io, json, time, tempfile, argparse, contextlib
+
+here = os.path.dirname( os.path.abspath( __file__ ) )
+pkgdir = os.path.dirname( here )
+sys.path.insert( 0, pkgdir )
+
+from mockserver import MockServer
+from ChatRunner import metrics
+from ChatRunner.chatrunner import testProgram
+from ChatRunner.sandbox import runAnswer, SandboxEngine, PoolEngine
+from ChatRunner.__main__ import batchprocess
+
+PROBLEM = "Forklar oppbyggingen og virkemåten til et optisk mikroskop."
+ANSWER = "Mikroskopet består av mange linser for å forstørre bildet. " * 4
+
+def percentile(xs,p):
+    return metrics.percentile(xs,p)
+
+def timed(f,lat,errors):
+    """Call f, appending the latency to lat or the exception to errors."""
+    t0 = time.perf_counter()
+    try:
+        f()
+    except Exception as e:
+        errors.append( f"{type(e).__name__}: {e}" )
+        return
+    lat.append( time.perf_counter() - t0 )
+
+def runScenario(name,sandbox,n,jobs):
+    """
+    Run a scenario, returning the list of latencies of successful calls,
+    the total time, and the list of errors.
+    """
+    lat = []
+    errors = []
+    if name in [ "baseline", "new", "dump" ]:
+        for _ in range(n):
+            timed( lambda: testProgram( PROBLEM, ANSWER, {}, "", "", sandbox,
+                                        mode=name, raw=True ),
+                   lat, errors )
+    elif name in [ "moodle", "pool" ]:
+        sb = dict( sandbox )
+        engine = SandboxEngine
+        if name == "pool":
+            sb["workers"] = max( 1, jobs )
+            engine = PoolEngine
+        for _ in range(n):
+            timed( lambda: runAnswer( PROBLEM, ANSWER, {}, "", "", dict(sb),
+                                      engine=engine ),
+                   lat, errors )
+    elif name == "batch":
+        qalist = { "questions": [ { "question": PROBLEM,
+                   "answers": [ { "ans": ANSWER + str(i) } for i in range(n) ] } ] }
+        t0 = time.perf_counter()
+        timed( lambda: batchprocess( qalist, {}, cfg=sandbox, count=1,
+                                     jobs=jobs, mode="new", gs="" ),
+               [], errors )
+        total = time.perf_counter() - t0
+        lat = [ r["phases"]["total"] for r in metrics.records ]
+        return lat, total, errors
+    else:
+        raise Exception( f"Unknown scenario {name}." )
+    return lat, sum(lat), errors
+
+def phaseMeans():
+    """Return the mean time per phase over the current metrics records."""
+    sums = {}
+    counts = {}
+    for rec in metrics.records:
+        for ph, t in rec["phases"].items():
+            sums[ph] = sums.get( ph, 0.0 ) + t
+            counts[ph] = counts.get( ph, 0 ) + 1
+    return { ph: sums[ph]/counts[ph] for ph in sums }
+
+def bench(args):
+    srv = MockServer( 0, args.latency, args.rate, args.malformed, seed=1,
+                      errors=args.errors ).start()
+    path = "/v1/chat/completions" if args.api == "openai" else "/api/chat"
+    sandbox = { "API": args.api, "url": srv.baseurl() + path, "model": "mock",
+                "stream": args.stream }
+    env = os.environ.get( "PYTHONPATH" )
+    os.environ["PYTHONPATH"] = pkgdir + ( os.pathsep + env if env else "" )
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir( tmp )
+        try:
+            for name in args.scenarios.split(","):
+                metrics.records.clear()
+                srv.reset()
+                with contextlib.redirect_stdout( io.StringIO() ):
+                    lat, total, errors = runScenario( name, sandbox,
+                                                      args.n, args.jobs )
+                server = sum( srv.servicetimes ) / max( 1, len(srv.servicetimes) )
+                overhead = [ x - server for x in lat ]
+                results[name] = {
+                    "n": len(lat),
+                    "errors": len(errors),
+                    "error": errors[0] if errors else None,
+                    "throughput": len(lat)/total if total else 0,
+                    "p50": percentile(lat,50), "p95": percentile(lat,95),
+                    "p99": percentile(lat,99),
+                    "server": server,
+                    "overhead_p50": percentile(overhead,50),
+                    "phases": phaseMeans() }
+        finally:
+            os.chdir( cwd )
+            srv.stop()
+    return results
+
+def report(results):
+    lines = [ "| scenario | n | errors | calls/s | p50 | p95 | p99 | server | overhead p50 |",
+              "| :- | -: | -: | -: | -: | -: | -: | -: | -: |" ]
+    fmt = lambda x: "-" if x is None else f"{x:.4f}"
+    for name, r in results.items():
+        lines.append( f"| {name} | {r['n']} | {r['errors']} | {r['throughput']:.1f} | "
+                      + f"{fmt(r['p50'])} | {fmt(r['p95'])} | {fmt(r['p99'])} | "
+                      + f"{fmt(r['server'])} | {fmt(r['overhead_p50'])} |" )
+    lines.append( "" )
+    lines.append( "Mean time per phase (s):" )
+    lines.append( "" )
+    for name, r in results.items():
+        ps = ", ".join( f"{ph} {t:.4f}" for ph, t in sorted( r["phases"].items() ) )
+        lines.append( f"+ {name}: {ps}" )
+        if r["error"]:
+            lines.append( f"    + first error: {r['error']}" )
+    return "\n".join( lines )
+
+def compare(results,old,threshold):
+    """Return a list of regressions in overhead relative to `old`."""
+    r = []
+    for name, x in results.items():
+        if name not in old: continue
+        a, b = old[name]["overhead_p50"], x["overhead_p50"]
+        if x["errors"] > old[name]["errors"]:
+            r.append( f"{name}: errors {old[name]['errors']} -> {x['errors']}" )
+        if a and b and a > 0 and (b-a)/a*100 > threshold:
+            r.append( f"{name}: overhead p50 {a:.4f} -> {b:.4f}" )
+    return r
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = 'bench',
+        description = 'Offline benchmarks for ChatRunner' )
+    parser.add_argument('-n',default=20,type=int,
+                        help="Number of calls per scenario.")
+    parser.add_argument('-j','--jobs',default=4,type=int,
+                        help="Concurrency for batch and pool scenarios.")
+    parser.add_argument('-A','--api',default="openai",
+                        help="API of the mock server (openai/ollama).")
+    parser.add_argument('-s','--scenarios',
+                        default="baseline,new,dump,moodle,pool,batch")
+    parser.add_argument('--stream',action="store_true",
+                        help="Use streaming responses.")
+    parser.add_argument('--latency',default=0.0,type=float)
+    parser.add_argument('--rate',default=0.0,type=float)
+    parser.add_argument('--malformed',default=0.0,type=float)
+    parser.add_argument('--errors',default=0.0,type=float)
+    parser.add_argument('--save',help="Save results as JSON.")
+    parser.add_argument('--compare',help="Compare with results saved earlier.")
+    parser.add_argument('--threshold',default=20.0,type=float,
+                        help="Regression threshold in percent.")
+    args = parser.parse_args()
+
+    results = bench( args )
+    print( report( results ) )
+    if args.save:
+        with open( args.save, "w" ) as f:
+            json.dump( results, f, indent=2 )
+    if args.compare:
+        with open( args.compare ) as f:
+            regressions = compare( results, json.load(f), args.threshold )
+        for x in regressions:
+            print( "Regression:", x )
+        if regressions:
+            sys.exit( 1 )
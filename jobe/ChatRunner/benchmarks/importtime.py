@@ -0,0 +1,110 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Start-up benchmark for the sandboxed test program.
+
+For each import set, the import time is measured with `-X importtime`
+(the sum of the cumulative times of the top-level imports), and the
+cold-start time as the median wall-clock time of a new interpreter
+doing the imports.  The import sets are
+
++ `python` - an empty interpreter, for reference
++ `legacy` - the imports of the old test program
+  (`ChatRunner.chatrunner` and `requests`)
++ `fast` - the imports of `ChatRunner.testrunner` with the
+  `http.client` transport
+
+Finally, the complete test program is run against the mock server
+with each transport.
+
+Run from the `jobe/ChatRunner` directory, e.g.
+`python benchmarks/importtime.py -n 20`.
+"""
+
+import os, sys, time, subprocess, argparse, statistics
+
+here = os.path.dirname( os.path.abspath( __file__ ) )
+pkgdir = os.path.dirname( here )
+sys.path.insert( 0, pkgdir )
+
+IMPORTS = {
+    "python": "pass",
+    "legacy": "import ChatRunner.chatrunner, requests",
+    "fast": "import ChatRunner.testrunner, ChatRunner.query, ChatRunner.lite",
+}
+
+def environment():
+    env = dict( os.environ )
+    p = env.get( "PYTHONPATH" )
+    env["PYTHONPATH"] = pkgdir + ( os.pathsep + p if p else "" )
+    return env
+
+def importTime(stmt):
+    """Return the import time in ms reported by `-X importtime`."""
+    sp = subprocess.run( [ sys.executable, "-X", "importtime", "-c", stmt ],
+                         capture_output=True, text=True, env=environment() )
+    total = 0
+    for line in sp.stderr.splitlines():
+        if not line.startswith( "import time:" ): continue
+        parts = line.split( "|" )
+        try:
+            cum = int( parts[1] )
+        except ValueError:
+            continue
+        name = parts[2]
+        if name.strip() and not name[1:].startswith( " " ):
+            total += cum
+    return total / 1000
+
+def coldStart(cmd,n):
+    """Return the median wall-clock time in ms of running `cmd` n times."""
+    env = environment()
+    ts = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        subprocess.run( cmd, capture_output=True, env=env )
+        ts.append( time.perf_counter() - t0 )
+    return statistics.median( ts ) * 1000
+
+def endToEnd(n):
+    """Return the median time in ms of the test program per transport."""
+    from mockserver import MockServer
+    from ChatRunner.sandbox import runTest
+    os.environ["PYTHONPATH"] = environment()["PYTHONPATH"]
+    srv = MockServer( 0 ).start()
+    r = {}
+    try:
+        for transport in [ "requests", "http" ]:
+            sandbox = { "API": "openai", "model": "mock", "transport": transport,
+                        "url": srv.baseurl() + "/v1/chat/completions" }
+            job = { "prompt": "Vurder svaret.", "studans": "Et svar.",
+                    "sandbox": sandbox }
+            ts = []
+            for _ in range(n):
+                t0 = time.perf_counter()
+                runTest( job, timeout=40.0 )
+                ts.append( time.perf_counter() - t0 )
+            r[transport] = statistics.median( ts ) * 1000
+    finally:
+        srv.stop()
+    return r
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = 'importtime',
+        description = 'Start-up benchmark for the ChatRunner test program' )
+    parser.add_argument('-n',default=10,type=int,
+                        help="Number of runs for cold-start medians.")
+    args = parser.parse_args()
+
+    print( "| imports | importtime (ms) | cold start (ms) |" )
+    print( "| :- | -: | -: |" )
+    for name, stmt in IMPORTS.items():
+        it = importTime( stmt )
+        cs = coldStart( [ sys.executable, "-c", stmt ], args.n )
+        print( f"| {name} | {it:.1f} | {cs:.1f} |" )
+    print()
+    print( "| transport | test program (ms) |" )
+    print( "| :- | -: |" )
+    for transport, t in endToEnd( args.n ).items():
+        print( f"| {transport} | {t:.1f} |" )
@@ -0,0 +1,260 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Local stand-in for an OpenAI or Ollama server, for benchmarks and
+offline testing.
+
+It answers `/v1/chat/completions` in the OpenAI format and `/api/chat`
+in the Ollama format, with or without streaming, and returns a fixed
+list of tests as message content.  The behaviour is configurable:
+
++ `latency` - seconds before the first byte of the response
++ `rate` - tokens per second for the content (0 for no delay),
+  assuming four characters per token
++ `malformed` - fraction of responses with broken JSON content
++ `errors` - fraction of requests answered with 503 and `Retry-After`
+
+With `load`, model loading is simulated for the Ollama API: a request
+for a model which is not resident waits `load` seconds, and the model
+stays resident for its `keep_alive` (default 5m, negative for ever).
+A request without messages only loads the model, as in Ollama.
+
+A prompt cache is simulated: the tokens of the first message are
+reported as `cached_tokens` (OpenAI format) if the same first message
+has been seen before.
+
+The time spent on each request is recorded in `servicetimes`, so that
+client overhead can be separated from (simulated) model time.
+
+Run standalone with `python mockserver.py --port 11434`.
+"""
+
+import json, time, random, threading, argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+TESTS = [ { "testName": f"Test {i}",
+            "description": f"Beskrivelse av test {i}",
+            "iscorrect": i % 2 == 0,
+            "resultat": f"Tilbakemelding på test {i}. " * 8 }
+          for i in range(1,6) ]
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self,*a):
+        pass
+
+    def do_POST(self):
+        t0 = time.perf_counter()
+        srv = self.server
+        n = int( self.headers.get( "Content-Length", 0 ) )
+        try:
+            body = json.loads( self.rfile.read(n) )
+        except ValueError:
+            body = {}
+        if self.path.startswith( "/v1/chat/completions" ):
+            api = "openai"
+        elif self.path.startswith( "/api/chat" ):
+            api = "ollama"
+        else:
+            self.send_error( 404 )
+            return
+        if api == "ollama":
+            srv.loadModel( body )
+            if not body.get( "messages" ):
+                self.complete( api, "", body, "load" )
+                srv.record( time.perf_counter() - t0 )
+                return
+        time.sleep( srv.latency )
+        if srv.draw( srv.errors ):
+            self.send_response( 503 )
+            self.send_header( "Retry-After", "0" )
+            self.send_header( "Content-Length", "0" )
+            self.end_headers()
+            srv.record( time.perf_counter() - t0 )
+            return
+        content = srv.content()
+        if body.get( "stream" ):
+            self.stream( api, content, body )
+        else:
+            self.sleepTokens( content )
+            self.complete( api, content, body )
+        srv.record( time.perf_counter() - t0 )
+
+    def sleepTokens(self,text):
+        if self.server.rate > 0:
+            time.sleep( len(text)/4/self.server.rate )
+
+    def usage(self,body,content):
+        p = sum( len( m.get("content","") ) for m in body.get("messages",[]) )//4
+        return p, len(content)//4
+
+    def details(self,body):
+        return { "prompt_tokens_details":
+                 { "cached_tokens": self.server.cached( body ) } }
+
+    def complete(self,api,content,body,reason="stop"):
+        p, c = self.usage( body, content )
+        msg = { "role": "assistant", "content": content }
+        if api == "openai":
+            obj = { "choices": [ { "index": 0, "message": msg,
+                                   "finish_reason": "stop" } ],
+                    "usage": { "prompt_tokens": p, "completion_tokens": c,
+                               "total_tokens": p+c, **self.details( body ) } }
+        else:
+            obj = { "message": msg, "done": True, "done_reason": reason,
+                    "prompt_eval_count": p, "eval_count": c }
+        data = json.dumps( obj ).encode()
+        self.send_response( 200 )
+        self.send_header( "Content-Type", "application/json" )
+        self.send_header( "Content-Length", str(len(data)) )
+        self.end_headers()
+        try:
+            self.wfile.write( data )
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def chunk(self,data):
+        self.wfile.write( b"%x\r\n%s\r\n" % ( len(data), data ) )
+        self.wfile.flush()
+
+    def stream(self,api,content,body):
+        p, c = self.usage( body, content )
+        self.send_response( 200 )
+        if api == "openai":
+            self.send_header( "Content-Type", "text/event-stream" )
+        else:
+            self.send_header( "Content-Type", "application/x-ndjson" )
+        self.send_header( "Transfer-Encoding", "chunked" )
+        self.end_headers()
+        try:
+            for i in range( 0, len(content), 16 ):
+                part = content[i:i+16]
+                self.sleepTokens( part )
+                if api == "openai":
+                    obj = { "choices": [ { "index": 0,
+                                           "delta": { "content": part } } ] }
+                    self.chunk( b"data: " + json.dumps(obj).encode() + b"\n\n" )
+                else:
+                    obj = { "message": { "role": "assistant", "content": part },
+                            "done": False }
+                    self.chunk( json.dumps(obj).encode() + b"\n" )
+            if api == "openai":
+                obj = { "choices": [], "usage": { "prompt_tokens": p,
+                                                  "completion_tokens": c,
+                                                  **self.details( body ) } }
+                self.chunk( b"data: " + json.dumps(obj).encode() + b"\n\n" )
+                self.chunk( b"data: [DONE]\n\n" )
+            else:
+                obj = { "message": { "role": "assistant", "content": "" },
+                        "done": True, "prompt_eval_count": p, "eval_count": c }
+                self.chunk( json.dumps(obj).encode() + b"\n" )
+            self.chunk( b"" )
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def duration(x):
+    """Return an Ollama duration (number of seconds or e.g. `5m`) in seconds."""
+    if isinstance( x, (int,float) ):
+        return float(x)
+    units = { "s": 1, "m": 60, "h": 3600 }
+    if x and x[-1] in units:
+        return float( x[:-1] ) * units[x[-1]]
+    return float(x)
+
+class MockServer(ThreadingHTTPServer):
+    """The mock server.  Use `start()` to serve from a background thread."""
+    daemon_threads = True
+
+    def __init__(self,port=0,latency=0.0,rate=0.0,malformed=0.0,seed=None,
+                 errors=0.0,load=0.0):
+        super().__init__( ( "127.0.0.1", port ), MockHandler )
+        self.latency = latency
+        self.load = load
+        self.resident = {}
+        self.loads = 0
+        self.rate = rate
+        self.malformed = malformed
+        self.errors = errors
+        self.random = random.Random( seed )
+        self.lock = threading.Lock()
+        self.servicetimes = []
+        self.prefixes = set()
+        self.thread = None
+
+    def draw(self,p):
+        """Return True with probability p."""
+        with self.lock:
+            return self.random.random() < p
+
+    def content(self):
+        text = json.dumps( TESTS, ensure_ascii=False )
+        if self.draw( self.malformed ):
+            return text[: len(text)*2//3 ]
+        return text
+
+    def loadModel(self,body):
+        """Simulate loading the model of the request if it is not resident."""
+        model = body.get( "model" )
+        with self.lock:
+            expiry = self.resident.get( model )
+            loaded = expiry is not None and ( expiry < 0 or expiry > time.time() )
+            if not loaded:
+                self.loads += 1
+        if not loaded:
+            time.sleep( self.load )
+        ka = duration( body.get( "keep_alive", "5m" ) )
+        with self.lock:
+            self.resident[model] = -1 if ka < 0 else time.time() + ka
+
+    def cached(self,body):
+        """Return the number of prompt tokens served from the simulated cache."""
+        msgs = body.get( "messages" ) or [ {} ]
+        first = msgs[0].get( "content", "" )
+        with self.lock:
+            if first in self.prefixes:
+                return len(first)//4
+            self.prefixes.add( first )
+        return 0
+
+    def record(self,t):
+        with self.lock:
+            self.servicetimes.append( t )
+
+    def reset(self):
+        with self.lock:
+            self.servicetimes = []
+
+    def baseurl(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread( target=self.serve_forever, daemon=True )
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = 'mockserver',
+        description = 'Mock OpenAI/Ollama server for ChatRunner benchmarks' )
+    parser.add_argument('-p','--port',default=11434,type=int)
+    parser.add_argument('--latency',default=0.0,type=float,
+                        help="Seconds before the first byte.")
+    parser.add_argument('--rate',default=0.0,type=float,
+                        help="Tokens per second (0 for no delay).")
+    parser.add_argument('--malformed',default=0.0,type=float,
+                        help="Fraction of malformed responses.")
+    parser.add_argument('--errors',default=0.0,type=float,
+                        help="Fraction of 503 responses.")
+    parser.add_argument('--load',default=0.0,type=float,
+                        help="Seconds to load a model which is not resident (Ollama).")
+    args = parser.parse_args()
+    srv = MockServer( args.port, args.latency, args.rate, args.malformed,
+                      errors=args.errors, load=args.load )
+    print( f"Serving on {srv.baseurl()}" )
+    srv.serve_forever()
@@ -2,7 +2,7 @@
 
 # This should be copied into the CodeRunner question.
 
-from ChatRunner.sandbox import runAnswer
+from ChatRunner.daemon import gradeRemote
 import json
 
 # Inputs from Moodle
@@ -17,7 +17,10 @@ sandboxparams = {
         "model" : "{{ model }}",
         "API" : "{{ API }}",
         "url" : "{{ url }}",
-        "OPENAI_API_KEY" : "{{ OPENAI_API_KEY }}"
+        "OPENAI_API_KEY" : "{{ OPENAI_API_KEY }}",
+        # Seconds available for the whole run, i.e. the CodeRunner TimeLimit.
+        "timelimit" : "{{ timelimit | default(20) }}",
+        "fallback_model" : "{{ fallback_model | default('') }}",
         }
 
 # Load the problem text
@@ -34,6 +37,9 @@ try:
 except FileNotFoundError:
     criteria = ""
 
-print( runAnswer( problem, studans, literatur, criteria
-                 , gs=graderstate_string
-                 , sandbox=sandboxparams, qid=qid ) )
+# With a daemon address, e.g. unix:/run/chatrunner/chatrunner.sock, the
+# answer is graded by `python -m ChatRunner serve`; otherwise by runAnswer().
+print( gradeRemote( problem, studans, literatur, criteria
+                  , gs=graderstate_string
+                  , sandbox=sandboxparams, qid=qid
+                  , daemon="{{ daemon | default('') }}" ) )
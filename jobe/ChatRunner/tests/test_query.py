@@ -0,0 +1,63 @@
+# (C) 2026: Hans Georg Schaathun <georg@schaathun.net>
+
+"""
+Checks of the parsing and repair of JSON test lists from the LLM
+(`parseTests()`, `scanJSON()`, `repairJSON()` and `dumpResponse()`).
+
+Run as `python -m pytest tests` from `jobe/ChatRunner`.
+"""
+
+import pytest
+
+from ChatRunner.query import parseTests, scanJSON, repairJSON, dumpResponse, isMalformed
+
+tests = [ { "testName": "a", "passed": True }, { "testName": "b", "passed": False } ]
+text = '[{"testName": "a", "passed": true}, {"testName": "b", "passed": false}]'
+
+def test_plain():
+    assert parseTests( text ) == ( tests, False )
+
+def test_fenced():
+    svar = f"Here is the feedback:\n```json\n{text}\n```\nGood luck!"
+    assert parseTests( svar ) == ( tests, False )
+
+def test_wrapper():
+    assert parseTests( '{"tests": ' + text + '}' ) == ( tests, False )
+
+def test_prose_bracket():
+    svar = "See [1] for details.\n" + text
+    assert parseTests( svar ) == ( tests, False )
+
+def test_trailing_comma():
+    svar = '[{"testName": "a", "passed": true,}, {"testName": "b", "passed": false},]'
+    assert parseTests( svar ) == ( tests, True )
+
+def test_python_literals():
+    svar = text.replace( "true", "True" ).replace( "false", "False" )
+    assert repairJSON( svar ) == text
+    assert parseTests( svar ) == ( tests, True )
+
+def test_truncated():
+    svar = text[: text.index( '"b"' ) + 5 ]
+    assert parseTests( svar ) == ( tests[:1], True )
+
+def test_single_after_repair():
+    assert parseTests( '{"testName": "a", "passed": True}' ) == ( tests[:1], True )
+
+def test_inner_dict_not_single():
+    # The first element of a broken list is not taken for the whole.
+    assert scanJSON( '[{"testName": "a"}, {"testName": ' ) is None
+
+def test_none():
+    with pytest.raises( ValueError ):
+        parseTests( "No feedback today." )
+    assert repairJSON( "No feedback today." ) is None
+
+def test_empty():
+    with pytest.raises( ValueError ):
+        parseTests( "" )
+
+def test_malformed():
+    r = dumpResponse( "[{ broken" )
+    assert isMalformed( r )
+    assert not isMalformed( dumpResponse( text ) )